@@ -1,90 +1,869 @@
+import json
 import os
-from flask import Flask, render_template, request, send_file
-from model.inputs import get_project_inputs
-from model.lihtc_calculator import calculate_lihtc_equity_extended
-from model.capital_stack import build_advanced_capital_stack
-from model.cashflow_model import project_cash_flows_enhanced
-from model.utils import calculate_irr, calculate_dscr
-from model.report_generator import generate_excel_report, generate_pdf_report
-from model.chart_generator import plot_cash_flows, plot_irr_curve, plot_capital_stack
-
-# Temporary files
-EXCEL_PATH = "outputs/report.xlsx"
-PDF_PATH = "outputs/report.pdf"
-
-# Chart Directory
+import re
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from io import BytesIO
+import numpy as np
+from flask import (Flask, Response, abort, g, jsonify, render_template, request, send_file, send_from_directory,
+                   stream_template, stream_with_context, url_for)
+from werkzeug.security import safe_join
+from model.inputs import InvalidDeal, get_project_inputs, get_simulation_distributions, get_sensitivity_ranges, validate_deal
+from model.bulk import DEFAULT_CHUNK_SIZE as BULK_CHUNK_SIZE, underwrite_chunk, underwrite_lines
+from model.pipeline import affected_artifacts, run_pipeline, what_if
+from model.records import DealInputs
+from model.store import SUMMARY_COLUMNS, ScenarioStore
+from model.simulation import DEFAULT_CHUNK_SIZE, max_hold_period, run_simulation
+from model.buffers import ResultBuffer, prune_buffer_dirs
+from model.sensitivity import SENSITIVITY_METRICS, default_sensitivity_tables, numeric_input_keys, sensitivity_table, tornado
+from model.cache import ResultCache, input_hash, source_hash
+from model.jobs import JobQueue, QueueFull
+from model.metrics import CallbackMetric, Counter, Histogram, end_trace, log_trace, record_spans, span, start_trace
+from model.metrics import enable as enable_metrics, enable_logging as enable_metrics_logging, enabled as metrics_enabled, render as render_metrics
+
+# Chart Directory (chart files are named after a hash of their data)
 CHART_DIR = "static/charts"
+CHART_FORMAT = os.environ.get("CHART_FORMAT", "png")
+# The chart directory keeps at most CHART_KEEP charts, none older than CHART_MAX_AGE seconds (0 = no age limit)
+CHART_KEEP = int(os.environ.get("CHART_KEEP", 2000))
+CHART_MAX_AGE = float(os.environ.get("CHART_MAX_AGE", 7 * 24 * 3600)) or None
+CHART_WAIT_SECONDS = float(os.environ.get("CHART_WAIT_SECONDS", 60))
+
+# FULL_PRECISION=1 underwrites without intermediate rounding; the templates and reports round for display
+FULL_PRECISION = os.environ.get("FULL_PRECISION", "0") == "1"
+
+# Charts render on background threads while the results page is sent.
+# The renderer (and matplotlib) is only loaded when the first chart is requested.
+_chart_renderer = None
+_chart_renderer_lock = threading.Lock()
+
+# Cache of computed results, keyed by input hash (also the result id in download links)
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.environ.get("RESULT_CACHE_ENTRIES", 128)),
+    max_bytes=int(os.environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.environ.get("RESULT_CACHE_TTL", 3600)),
+    disk_dir=os.environ.get("RESULT_CACHE_DIR")  # optional on-disk tier
+)
+
+# Reports are only built when downloaded, in memory, and memoized per result id
+REPORT_CACHE = ResultCache(
+    max_entries=int(os.environ.get("REPORT_CACHE_ENTRIES", 64)),
+    max_bytes=int(os.environ.get("REPORT_CACHE_BYTES", 128 * 1024 * 1024)),
+    ttl=float(os.environ.get("RESULT_CACHE_TTL", 3600))
+)
+
+# Model runs happen on background jobs; pages and API clients poll /jobs/<job_id>
+JOB_QUEUE = JobQueue(
+    workers=int(os.environ.get("JOB_WORKERS", 4)),
+    max_pending=int(os.environ.get("JOB_MAX_PENDING", 16)),
+    processes=int(os.environ["JOB_PROCESSES"]) if os.environ.get("JOB_PROCESSES") else None
+)
+
+# Saved runs, opened on first use (see model/store.py)
+SCENARIO_DB = os.environ.get("SCENARIO_DB", "scenarios.db")
+_scenario_store = None
+_scenario_store_lock = threading.Lock()
+
+# Saved results page (/results): rows per page, and the columns it sorts on
+RESULTS_PAGE_SIZE = int(os.environ.get("RESULTS_PAGE_SIZE", 100))
+RESULTS_MAX_PAGE_SIZE = int(os.environ.get("RESULTS_MAX_PAGE_SIZE", 5000))
+RESULTS_SORT_COLUMNS = {"irr": "IRR", "dscr": "DSCR", "equity_required": "Equity Required"}
+
+# JSON API batches: deals per request and per streamed chunk (see model/bulk.py)
+API_MAX_DEALS = int(os.environ.get("API_MAX_DEALS", 100_000))
+API_CHUNK_SIZE = int(os.environ.get("API_CHUNK_SIZE", BULK_CHUNK_SIZE))
+
+# Per-draw simulation results, kept as memory-mapped .npy files (see model/buffers.py) that the
+# simulation workers write and the charts and downloads read in place. Runs with more than
+# SIMULATION_KEEP_DRAWS draws keep only their summary; only the newest SIMULATION_KEEP_RUNS are kept
+# (plus any whose jobs the job queue still holds).
+SIMULATION_DIR = os.environ.get("SIMULATION_DIR", "simulations")
+SIMULATION_KEEP_DRAWS = int(os.environ.get("SIMULATION_KEEP_DRAWS", 1_000_000))
+SIMULATION_KEEP_RUNS = int(os.environ.get("SIMULATION_KEEP_RUNS", 16))
+SIMULATION_REPORT_ROWS = int(os.environ.get("SIMULATION_REPORT_ROWS", 20_000))  # draws in the Excel download
+
+# HTTP caching of charts and downloads. ETags come from the input hash (or the chart's data hash)
+# plus ARTIFACT_VERSION, a hash of the model code, so a code change invalidates them too
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ARTIFACT_VERSION = os.environ.get("ARTIFACT_VERSION") or source_hash(os.path.join(APP_DIR, "model"), os.path.join(APP_DIR, "templates"))
+if FULL_PRECISION:
+    ARTIFACT_VERSION += "-full"
+CHART_CACHE_SECONDS = int(os.environ.get("CHART_CACHE_SECONDS", 86400))
+DOWNLOAD_CACHE_SECONDS = int(os.environ.get("DOWNLOAD_CACHE_SECONDS", 3600))
+
+REPORT_TYPES = {
+    "excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "pdf": ("pdf", "application/pdf"),
+}
 
 app = Flask(__name__)
 
+# Stage timings and Prometheus metrics at /metrics (METRICS_ENABLED=0 turns them off),
+# plus an optional JSON timing log line per request and per job (METRICS_LOG=1)
+if os.environ.get("METRICS_ENABLED", "1") != "0":
+    enable_metrics()
+METRICS_LOG = os.environ.get("METRICS_LOG", "0") == "1"
+if METRICS_LOG:
+    enable_metrics_logging()
+
+REQUESTS = Counter("model_http_requests_total", "HTTP requests", ("method", "endpoint", "status"))
+REQUEST_SECONDS = Histogram("model_http_request_duration_seconds", "HTTP request latency", ("endpoint",))
+IRR_NOT_SOLVED = Counter("model_irr_not_solved_total", "IRRs that could not be solved (no sign change or no convergence)", ("source",))
+
+def _cache_lookups():
+    lookups = {}
+    for name, cache in (("result", RESULT_CACHE), ("report", REPORT_CACHE)):
+        stats = cache.stats()
+        for outcome in ("hits", "disk_hits", "misses"):
+            lookups[(name, outcome)] = stats[outcome]
+    return lookups
+
+CallbackMetric("model_cache_lookups_total", "Result and report cache lookups by outcome", "counter", ("cache", "outcome"), _cache_lookups)
+CallbackMetric("model_cache_evictions_total", "Cache entries evicted to stay within size limits", "counter", ("cache",),
+               lambda: {("result",): RESULT_CACHE.stats()["evictions"], ("report",): REPORT_CACHE.stats()["evictions"]})
+CallbackMetric("model_jobs", "Background jobs by status", "gauge", ("status",),
+               lambda: {(status,): count for status, count in JOB_QUEUE.stats().items() if status not in ("workers", "max_pending")})
+
+"""
+Startup time:
+The chart and report modules import matplotlib, reportlab and xlsxwriter,
+which together take most of a second to import. Many processes never need
+them (CLI runs, JSON-only workers), so they are imported the first time a
+chart or report is requested rather than when the app starts.
+
+For pre-forking servers, prefork_warmup() loads them once in the master
+process so every worker starts with them (and matplotlib's font cache)
+already in memory, e.g. in gunicorn.conf.py:
+
+    def on_starting(server):
+        from app import prefork_warmup
+        prefork_warmup()
+"""
+
+def prefork_warmup():
+    from model import report_generator  # noqa: F401 (imported for its side effect of loading xlsxwriter/reportlab)
+    from model.chart_generator import warm_up
+    warm_up()
+
+def get_chart_renderer():
+    # Created lazily, and after any fork: worker threads don't survive fork()
+    global _chart_renderer
+    with _chart_renderer_lock:
+        if _chart_renderer is None:
+            from model.chart_generator import ChartRenderer
+            _chart_renderer = ChartRenderer(CHART_DIR, max_workers=int(os.environ.get("CHART_WORKERS", 2)),
+                                            keep=CHART_KEEP, max_age=CHART_MAX_AGE)
+        return _chart_renderer
+
+def get_scenario_store():
+    global _scenario_store
+    with _scenario_store_lock:
+        if _scenario_store is None:
+            _scenario_store = ScenarioStore(SCENARIO_DB)
+        return _scenario_store
+
+def result_key(inputs):
+    # Results are cached and saved under the hash of the full deal, defaults included
+    return input_hash(DealInputs.from_dict(inputs).to_dict())
+
+def save_scenario(result):
+    # Every new result is kept in the scenario store (once per set of inputs)
+    store = get_scenario_store()
+    scenario_id = store.find(input_hash(result.deal.to_dict()))
+    return scenario_id if scenario_id is not None else store.save(result)
+
+def get_result(result_id):
+    # A cached result, or a saved scenario (e.g. a row of /results) rerun from its inputs, which takes milliseconds
+    result = RESULT_CACHE.get(result_id)
+    if result is None:
+        scenario_id = get_scenario_store().find(result_id) if re.fullmatch(r"[0-9a-f]{32}", result_id) else None
+        if scenario_id is None:
+            abort(404, description="This result has expired. Please run the model again.")
+        result = underwrite(get_scenario_store().get(scenario_id)["inputs"])
+        RESULT_CACHE.put(result_id, result)
+    return result
+
+def underwrite(inputs):
+    # Typed records (see model/records.py); to_dict() gives the dicts the templates and reports use.
+    # The stages and what they depend on are declared in model/pipeline.py
+    return run_pipeline(DealInputs.from_dict(inputs), full_precision=FULL_PRECISION).result
+
+def build_report(result_id, report_type):
+    # Reports are generated on first download and memoized; each result id gets its own report.
+    # Returns (bytes, time built)
+    cache_key = f"{result_id}.{report_type}"
+    cached = REPORT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    result = get_result(result_id).to_dict()
+    capital_stack, lihtc_info, cash_flows = result["capital_stack"], result["lihtc_info"], result["cash_flows"]
+    irr, dscr = result["irr"], result["dscr"]
+
+    from model.report_generator import generate_excel_report, generate_pdf_report
+
+    buffer = BytesIO()
+    if report_type == "excel":
+        # The Excel report also gets sensitivity tables and a tornado ranking
+        with span("sensitivity"):
+            sensitivity_tables = default_sensitivity_tables(result["inputs"])
+            tornado_rows = tornado(result["inputs"])
+        with span("excel_report"):
+            generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, dscr, buffer,
+                                  sensitivity_tables=sensitivity_tables,
+                                  tornado_rows=tornado_rows)
+    else:
+        with span("pdf_report"):
+            generate_pdf_report(capital_stack, lihtc_info, cash_flows, irr, dscr, buffer)
+
+    # Kept with the time it was built (its Last-Modified)
+    report = (buffer.getvalue(), time.time())
+    REPORT_CACHE.put(cache_key, report)
+    return report
+
+"""
+Background jobs:
+Each job function runs on a JOB_QUEUE thread as fn(job, ...). The model
+itself runs in worker processes (job.run_in_process, or the simulation's own
+process pool), so these threads only wait, report progress between chunks
+and stop early when the job is cancelled.
+"""
+
+def underwrite_timed(inputs, timed):
+    # Runs in a job worker process, so its stage timings are sent back with the result
+    if not timed:
+        return underwrite(inputs), []
+    enable_metrics()
+    trace, token = start_trace()
+    try:
+        return underwrite(inputs), trace.spans
+    finally:
+        end_trace(token)
+
+def underwrite_job(job, inputs, fmt=CHART_FORMAT):
+    result_id = result_key(inputs)
+    result = RESULT_CACHE.get(result_id)
+    if result is None:
+        trace, token = start_trace()
+        try:
+            result, spans = job.run_in_process(underwrite_timed, inputs, metrics_enabled())
+            record_spans(spans)
+        finally:
+            end_trace(token)
+        if np.isnan(result.irr):
+            IRR_NOT_SOLVED.inc(source="underwrite")
+        if METRICS_LOG:
+            log_trace(trace, job_id=job.id, kind=job.kind, result_id=result_id)
+        RESULT_CACHE.put(result_id, result)
+        save_scenario(result)
+    return {
+        "result_id": result_id,
+        "irr": result.irr,
+        "dscr": result.dscr,
+        "equity_required": result.capital_stack.equity_required,
+        "result_url": f"/results/{result_id}?chart_format={fmt}",
+    }
+
+def simulation_buffer_path(job_id):
+    return os.path.join(SIMULATION_DIR, job_id)
+
+def simulation_job(job, inputs, distributions, draws, seed):
+    # The workers write every draw's results into the run's buffer; only summaries come back
+    buffer = None
+    if draws <= SIMULATION_KEEP_DRAWS:
+        # A run's buffer is read through its job, so runs the job queue still holds (running,
+        # or finished with results to page through) are kept; only forgotten runs are pruned
+        prune_buffer_dirs(SIMULATION_DIR, SIMULATION_KEEP_RUNS - 1, in_use=JOB_QUEUE.job_ids("simulation"))
+        buffer = ResultBuffer.create(draws, max_hold_period(inputs, distributions), simulation_buffer_path(job.id))
+    spec = buffer.spec if buffer is not None else None
+    try:
+        with span("simulation"):
+            if draws <= DEFAULT_CHUNK_SIZE:
+                # A single chunk: no progress to report, so just run it in a worker process
+                summary = job.run_in_process(run_simulation, inputs, distributions, draws, seed, DEFAULT_CHUNK_SIZE, 1,
+                                             None, None, spec)
+            else:
+                # Reporting progress between chunks also stops the run if the job is cancelled
+                summary = run_simulation(inputs, distributions, draws=draws, seed=seed,
+                                         workers=JOB_QUEUE.processes,
+                                         progress=job.report,
+                                         partial=lambda summary: setattr(job, "partial", summary),
+                                         buffer=spec)
+    except BaseException:
+        if buffer is not None:
+            buffer.unlink()
+        raise
+    if buffer is not None:
+        buffer.close()
+    IRR_NOT_SOLVED.inc(summary["IRR Not Solved"], source="simulation")
+    return {"summary": summary, "seed": seed, "draws_kept": buffer is not None, "result_url": f"/simulate/{job.id}"}
+
+def open_simulation_buffer(job_id):
+    # The run's per-draw results, or None if they weren't kept (or have been pruned)
+    job = JOB_QUEUE.get(job_id)
+    if job is None or job.kind != "simulation" or job.result is None or not job.result.get("draws_kept"):
+        return None
+    try:
+        return ResultBuffer.open(simulation_buffer_path(job_id))
+    except FileNotFoundError:
+        return None
+
+def sensitivity_job(job, inputs, x_key, x_values, y_key, y_values, metric, rows_per_chunk=50):
+    # The table is computed a block of rows at a time, so it can report progress and be cancelled
+    values = np.full((len(y_values), len(x_values)), np.nan)
+    for start in range(0, len(y_values), rows_per_chunk):
+        with span("sensitivity"):
+            block = job.run_in_process(sensitivity_table, inputs, x_key, x_values, y_key, y_values[start:start + rows_per_chunk], metric)
+        values[start:start + rows_per_chunk] = block["values"]
+        job.report(min(start + rows_per_chunk, len(y_values)), len(y_values), {"rows_done": min(start + rows_per_chunk, len(y_values))})
+    return {"metric": metric, "x_key": x_key, "x_values": x_values, "y_key": y_key, "y_values": y_values, "values": values}
+
+def submit_charts(result, fmt):
+    # Queues the charts and returns their URLs straight away; unchanged charts are already on disk
+    capital_stack, cash_flows = result["capital_stack"], result["cash_flows"]
+    renderer = get_chart_renderer()
+    filenames = {
+        "cf_chart": renderer.submit("cash_flows", cash_flows, fmt=fmt),
+        "irr_chart": renderer.submit("irr_curve", cash_flows, capital_stack["Equity Required"], fmt=fmt),
+        "stack_chart": renderer.submit("capital_stack", capital_stack, fmt=fmt),
+    }
+    return {name: url_for("chart", filename=filename) for name, filename in filenames.items()}
+
+def render_results(result_id, result, fmt):
+    result = result.to_dict()
+    try:
+        charts = submit_charts(result, fmt)
+    except ValueError:
+        abort(400, description="Unsupported chart format")
+
+    return render_template("results.html",
+                           result_id=result_id,
+                           capital_stack=result["capital_stack"],
+                           cash_flows=result["cash_flows"],
+                           irr=result["irr"],
+                           dscr=result["dscr"],
+                           debt_service=result["debt_service"],
+                           loan_payoff=result["loan_payoff"],
+                           lihtc_info=result["lihtc_info"],
+                           cf_chart=charts["cf_chart"],
+                           irr_chart=charts["irr_chart"],
+                           stack_chart=charts["stack_chart"])
+
+def not_modified(etag, weak=False, last_modified=None, max_age=0):
+    """
+    A 304 for a client that already holds this version of an artifact, or
+    None. Checked before the artifact is read or built, so a repeat view
+    costs neither bandwidth nor server time.
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=weak)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        matched = int(last_modified) <= request.if_modified_since.timestamp()
+    else:
+        matched = False
+    return response if matched else None
+
+def cacheable(response, etag, weak=False, last_modified=None, max_age=0):
+    # Validators and freshness for a full response; make_conditional() still answers 304/206 for it
+    response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = None  # send_file()'s default
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+def submit_job(kind, fn, *args):
+    # Backpressure: when the queue is full, callers are told to come back later
+    try:
+        return JOB_QUEUE.submit(kind, fn, *args)
+    except QueueFull:
+        abort(429, description="The model is busy. Please try again in a few seconds.")
+
+@app.before_request
+def start_request_trace():
+    g.trace, g.trace_token = start_trace()
+
+@app.after_request
+def record_request(response):
+    trace = g.get("trace")
+    if trace is not None and metrics_enabled():
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+        REQUEST_SECONDS.observe(time.perf_counter() - trace.started, endpoint=endpoint)
+        if METRICS_LOG:
+            log_trace(trace, method=request.method, path=request.path, endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    if "trace_token" in g:
+        end_trace(g.pop("trace_token"))
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape endpoint
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         # For now, use static inputs
         inputs = get_project_inputs()
+        result_id = result_key(inputs)
+        fmt = request.args.get("chart_format", CHART_FORMAT)
+
+        # Identical inputs are served from the cache
+        result = RESULT_CACHE.get(result_id)
+        if result is not None:
+            return render_results(result_id, result, fmt)
 
-        lihtc_info = calculate_lihtc_equity_extended(
-            eligible_basis=inputs["eligible_basis"],
-            applicable_fraction=inputs["applicable_fraction"],
-            credit_rate=inputs["credit_rate"],
-            pricing=inputs["pricing"],
-            credit_type=inputs["credit_type"],
-            include_syndication_fee=inputs["include_syndication_fee"],
-            syndication_fee_percent=inputs["syndication_fee_percent"],
-            use_bridge_loan=inputs["use_bridge_loan"],
-            bridge_loan_interest=inputs["bridge_loan_interest"],
-            bridge_loan_term_years=inputs["bridge_loan_term_years"]
-        )
-
-        capital_stack = build_advanced_capital_stack(inputs, lihtc_info["Net Equity After Fees"])
-
-        cash_flows = project_cash_flows_enhanced(
-            initial_noi=inputs["noi_year_1"],
-            noi_growth_rate=inputs["noi_growth_rate"],
-            debt_service=capital_stack["Loan (DSCR & LTV Constrained)"] * inputs["permanent_loan_rate"],
-            hold_period=inputs["hold_period"],
-            exit_cap_rate=inputs["exit_cap_rate"],
-            selling_cost_percent=inputs["selling_cost_percent"],
-            include_sale=True
-        )
-
-        irr = calculate_irr(cash_flows, capital_stack["Equity Required"])
-        dscr = calculate_dscr(inputs["noi_year_1"], capital_stack["Loan (DSCR & LTV Constrained)"] * inputs["permanent_loan_rate"])
-
-        # Generate reports
-        generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, dscr, EXCEL_PATH)
-        generate_pdf_report(capital_stack, lihtc_info, cash_flows, irr, dscr, PDF_PATH)
-
-        # Generate charts
-        os.makedirs(CHART_DIR, exist_ok=True)
-
-        cf_chart = os.path.join(CHART_DIR, "cash_flows.png")
-        irr_chart = os.path.join(CHART_DIR, "irr_curve.png")
-        stack_chart = os.path.join(CHART_DIR, "capital_stack.png")
-
-        plot_cash_flows(cash_flows, cf_chart)
-        plot_irr_curve(cash_flows, capital_stack["Equity Required"], irr_chart)
-        plot_capital_stack(capital_stack, stack_chart)
-
-        return render_template("results.html",
-                               capital_stack=capital_stack,
-                               cash_flows=cash_flows,
-                               irr=irr,
-                               dscr=dscr,
-                               lihtc_info=lihtc_info,
-                               cf_chart=cf_chart,
-                               irr_chart=irr_chart,
-                               stack_chart=stack_chart)
+        # Otherwise underwrite in the background and let the page poll for it
+        job = submit_job("underwrite", underwrite_job, inputs, fmt)
+        return render_template("job.html", job=job.to_dict(), title="Running the model")
 
     return render_template("index.html")
 
-@app.route("/download/excel")
-def download_excel():
-    return send_file(EXCEL_PATH, as_attachment=True)
+@app.route("/results/<result_id>")
+def results(result_id):
+    return render_results(result_id, get_result(result_id), request.args.get("chart_format", CHART_FORMAT))
+
+@app.route("/results/<result_id>/what-if", methods=["POST"])
+def what_if_result(result_id):
+    """
+    Re-underwrites a result (cached or saved) with some inputs changed, e.g.
+        {"exit_cap_rate": 0.055, "selling_cost_percent": 0.03}
+    Only the stages that depend on the changed inputs are recomputed (see
+    model/pipeline.py), so this runs in the request rather than as a job.
+    The answer lists the stages recomputed and the charts and reports whose
+    contents changed; the others are reused as they are. Changes are checked
+    like API deals (inputs.validate_deal()); bad ones get a 400 with an
+    error per input.
+    """
+    previous = get_result(result_id)
+
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return jsonify({"error": "Expected a JSON object of inputs to change"}), 400
+    try:
+        deal = validate_deal(changes, previous.deal.to_dict())
+    except InvalidDeal as e:
+        return jsonify({"error": str(e), "errors": e.errors}), 400
+    run = what_if(previous, **{key: deal[key] for key in changes if key in deal})
+
+    result = run.result
+    new_id = input_hash(result.deal.to_dict())
+    RESULT_CACHE.put(new_id, result)
+    save_scenario(result)
+    fmt = request.args.get("chart_format", CHART_FORMAT)
+    return jsonify(_json_safe({
+        "result_id": new_id,
+        "irr": result.irr,
+        "dscr": result.dscr,
+        "equity_required": result.capital_stack.equity_required,
+        "recomputed": run.recomputed,
+        "changed_artifacts": affected_artifacts(run.changed),
+        "result_url": f"/results/{new_id}?chart_format={fmt}",
+    }))
+
+@app.route("/charts/<filename>")
+def chart(filename):
+    # Chart names are hashes of their data, so the name (plus the code version) is the ETag;
+    # a browser revalidating a chart it has gets a 304 without waiting for it to render
+    etag = f"{os.path.splitext(filename)[0]}-{ARTIFACT_VERSION}"
+    path = safe_join(CHART_DIR, filename)
+    cached = not_modified(etag, last_modified=os.path.getmtime(path) if path and os.path.exists(path) else None, max_age=CHART_CACHE_SECONDS)
+    if cached is not None:
+        return cached
+
+    # The page is sent before its charts finish rendering, so wait here for this one
+    # (if no renderer was started, the chart can only be one already on disk)
+    if _chart_renderer is not None:
+        try:
+            _chart_renderer.wait(filename, timeout=CHART_WAIT_SECONDS)
+        except FutureTimeoutError:
+            response = Response("The chart is still rendering. Please try again in a few seconds.", status=503, mimetype="text/plain")
+            response.headers["Retry-After"] = "5"
+            return response
+        except Exception:
+            app.logger.exception("Rendering chart %s failed", filename)
+            abort(503, description="The chart could not be rendered.")
+    response = send_from_directory(CHART_DIR, filename, etag=False, conditional=False)
+    return cacheable(response, etag, last_modified=os.path.getmtime(path), max_age=CHART_CACHE_SECONDS)
+
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify(RESULT_CACHE.stats())
+
+@app.route("/simulate", methods=["POST"])
+def simulate():
+    # Monte Carlo mode: distributions of IRR, DSCR and funding gap around the default inputs
+    draws = request.form.get("draws", 10000, type=int)
+    seed = request.form.get("seed", 0, type=int)
+
+    job = submit_job("simulation", simulation_job, get_project_inputs(), get_simulation_distributions(), draws, seed)
+    return render_template("job.html", job=job.to_dict(), title="Running the simulation")
+
+@app.route("/simulate/<job_id>")
+def simulation_results(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if job is None or job.kind != "simulation" or job.result is None:
+        abort(404)
+
+    irr_chart = None
+    buffer = open_simulation_buffer(job_id)
+    if buffer is not None:
+        # The chart reads the IRRs from the buffer itself; only its spec is passed along
+        irr_chart = url_for("chart", filename=get_chart_renderer().submit("irr_distribution", buffer.spec, fmt=CHART_FORMAT))
+        buffer.close()
+
+    return render_template("simulation.html",
+                           summary=job.result["summary"],
+                           distributions=get_simulation_distributions(),
+                           seed=job.result["seed"],
+                           irr_chart=irr_chart,
+                           job_id=job_id if buffer is not None else None)
+
+@app.route("/simulate/<job_id>/download/excel")
+def download_simulation(job_id):
+    # Summary plus a row per draw, read straight from the run's buffer. A run's draws never change
+    etag = f"simulation-{job_id}-{ARTIFACT_VERSION}"
+    cached = not_modified(etag, weak=True, max_age=DOWNLOAD_CACHE_SECONDS)
+    if cached is not None and JOB_QUEUE.get(job_id) is not None:
+        return cached
+
+    cache_key = f"simulation.{job_id}.excel"
+    report = REPORT_CACHE.get(cache_key)
+    if report is None:
+        buffer = open_simulation_buffer(job_id)
+        if buffer is None:
+            abort(404)
+        from model.report_generator import generate_simulation_report
+
+        output = BytesIO()
+        try:
+            with span("simulation_report"):
+                generate_simulation_report(JOB_QUEUE.get(job_id).result["summary"], buffer, output,
+                                           max_rows=SIMULATION_REPORT_ROWS)
+        finally:
+            buffer.close()
+        report = (output.getvalue(), time.time())
+        REPORT_CACHE.put(cache_key, report)
+    data, built_at = report
+    response = send_file(BytesIO(data),
+                         mimetype=REPORT_TYPES["excel"][1],
+                         as_attachment=True,
+                         download_name=f"simulation-{job_id[:8]}.xlsx")
+    return cacheable(response, etag, weak=True, last_modified=built_at, max_age=DOWNLOAD_CACHE_SECONDS)
+
+def _json_values(values):
+    # JSON has no NaN: unsolved cells (e.g. IRR with no equity) become null
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isfinite(values), values, None).tolist()
+
+@app.route("/sensitivity")
+def sensitivity():
+    # Two-way table of any two inputs plus a one-way tornado ranking, as JSON
+    inputs = get_project_inputs()
+    ranges = get_sensitivity_ranges()
+
+    x_key = request.args.get("x", "exit_cap_rate")
+    y_key = request.args.get("y", "noi_growth_rate")
+    metric = request.args.get("metric", "irr")
+    steps = min(request.args.get("steps", 21, type=int), 500)
+    x_min = request.args.get("x_min", ranges.get(x_key, (None, None))[0], type=float)
+    x_max = request.args.get("x_max", ranges.get(x_key, (None, None))[1], type=float)
+    y_min = request.args.get("y_min", ranges.get(y_key, (None, None))[0], type=float)
+    y_max = request.args.get("y_max", ranges.get(y_key, (None, None))[1], type=float)
+    if None in (x_min, x_max, y_min, y_max):
+        return jsonify({"error": "x_min/x_max/y_min/y_max are required for inputs without a default range"}), 400
+
+    try:
+        table = sensitivity_table(inputs, x_key, np.linspace(x_min, x_max, steps), y_key, np.linspace(y_min, y_max, steps), metric)
+        tornado_rows = tornado(inputs, metric=metric, swing=request.args.get("swing", 0.10, type=float))
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"Invalid sensitivity request: {e}"}), 400
+
+    return jsonify({
+        "metric": metric,
+        "x_key": x_key,
+        "x_values": _json_values(table["x_values"]),
+        "y_key": y_key,
+        "y_values": _json_values(table["y_values"]),
+        "values": _json_values(table["values"]),
+        "tornado": [{k: (None if isinstance(v, float) and not np.isfinite(v) else v) for k, v in row.items()} for row in tornado_rows],
+    })
+
+def _json_safe(value):
+    # Job results hold NumPy arrays and NaN (e.g. IRR with no equity); JSON gets lists and null
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return _json_values(value) if value.dtype.kind == "f" else value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+def _job_response(job, status=200):
+    response = jsonify(_json_safe(job.to_dict()))
+    response.status_code = status
+    if status == 202:
+        response.headers["Location"] = url_for("job_status", job_id=job.id)
+    return response
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Queues a model run and returns its job id straight away (202), e.g.
+        {"type": "underwrite"}
+        {"type": "simulation", "draws": 1000000, "seed": 7}
+        {"type": "sensitivity", "x": "exit_cap_rate", "y": "noi_growth_rate", "steps": 200, "metric": "irr"}
+    Poll GET /jobs/<job_id> for status, progress and partial results.
+    Answers 429 when too many jobs are already queued.
+    """
+    params = request.get_json(silent=True) or {}
+    kind = params.get("type", "underwrite")
+    inputs = get_project_inputs()
+
+    try:
+        if kind == "underwrite":
+            args = (underwrite_job, inputs)
+        elif kind == "simulation":
+            args = (simulation_job, inputs, get_simulation_distributions(), int(params.get("draws", 10000)), int(params.get("seed", 0)))
+            if args[3] < 1:
+                raise ValueError("draws must be at least 1")
+        elif kind == "sensitivity":
+            ranges = get_sensitivity_ranges()
+            x_key = params.get("x", "exit_cap_rate")
+            y_key = params.get("y", "noi_growth_rate")
+            metric = params.get("metric", "irr")
+            steps = min(int(params.get("steps", 21)), 1000)
+            if metric not in SENSITIVITY_METRICS:
+                raise ValueError(f"Unknown sensitivity metric: {metric}")
+            for key in (x_key, y_key):
+                if key not in numeric_input_keys(inputs):
+                    raise ValueError(f"Unknown input: {key}")
+            x_values = np.linspace(float(params.get("x_min", ranges.get(x_key, (np.nan,))[0])), float(params.get("x_max", ranges.get(x_key, (0, np.nan))[1])), steps)
+            y_values = np.linspace(float(params.get("y_min", ranges.get(y_key, (np.nan,))[0])), float(params.get("y_max", ranges.get(y_key, (0, np.nan))[1])), steps)
+            if not (np.isfinite(x_values).all() and np.isfinite(y_values).all()):
+                raise ValueError("x_min/x_max/y_min/y_max are required for inputs without a default range")
+            args = (sensitivity_job, inputs, x_key, x_values, y_key, y_values, metric)
+        else:
+            raise ValueError(f"Unknown job type: {kind}")
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        job = JOB_QUEUE.submit(kind, *args)
+    except QueueFull as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 429
+        response.headers["Retry-After"] = "5"
+        return response
+    return _job_response(job, 202)
+
+@app.route("/jobs")
+def job_queue_stats():
+    return jsonify(JOB_QUEUE.stats())
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        abort(404)
+    return _job_response(job)
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    job = JOB_QUEUE.cancel(job_id)
+    if job is None:
+        abort(404)
+    return _job_response(job)
+
+@app.route("/api/underwrite", methods=["POST"])
+def api_underwrite():
+    """
+    Underwrites deals sent as JSON, keyed like get_project_inputs() (missing
+    keys take the defaults, an optional "deal_id" is echoed back):
+        {"exit_cap_rate": 0.055}                 -> one JSON result (400 if the deal is invalid)
+        [{...}, {...}] or {"deals": [{...}, ...]} -> application/x-ndjson, one line per deal
+    Batches are streamed a chunk at a time as each chunk is underwritten.
+    Invalid deals get an {"index": ..., "error": ...} line; the rest of the
+    batch still runs. ?cash_flows=0 leaves out the annual cash flows;
+    ?save=1 keeps the results in the scenario store, tagged with each ?tag=.
+    """
+    body = request.get_json(silent=True)
+    cash_flows = request.args.get("cash_flows", "1") != "0"
+    store = get_scenario_store() if request.args.get("save") == "1" else None
+    tags = request.args.getlist("tag")
+    if isinstance(body, dict) and isinstance(body.get("deals"), list):
+        body = body["deals"]
+
+    if isinstance(body, dict):
+        line = underwrite_chunk([body], cash_flows=cash_flows, store=store, tags=tags)[0]
+        return Response(line, status=400 if "error" in json.loads(line) else 200, mimetype="application/json")
+    if not isinstance(body, list):
+        return jsonify({"error": "Expected a deal object, a list of deals or {\"deals\": [...]}"}), 400
+    if len(body) > API_MAX_DEALS:
+        return jsonify({"error": f"At most {API_MAX_DEALS:,} deals per request"}), 413
+
+    return Response(underwrite_lines(body, API_CHUNK_SIZE, cash_flows, store, tags), mimetype="application/x-ndjson")
+
+def scenario_query(args):
+    # Filters shared by the JSON list and the results page (raises ValueError on bad ones)
+    filters = {}
+    for column in SUMMARY_COLUMNS:
+        low, high = args.get(f"min_{column}", type=float), args.get(f"max_{column}", type=float)
+        if low is not None or high is not None:
+            filters[column] = (low, high)
+    if args.get("max_equity"):
+        filters["equity_required"] = (filters.get("equity_required", (None, None))[0], args.get("max_equity", type=float))
+    return {"tags": [tag for tag in args.getlist("tag") if tag], "filters": filters}
+
+def page_cursor(text):
+    # "VALUE,ID" of the last row of the previous page ("null,ID" for a NULL value)
+    value, _, scenario_id = text.rpartition(",")
+    return (None if value == "null" else float(value)), int(scenario_id)
+
+@app.route("/scenarios")
+def list_scenarios():
+    """
+    Saved scenarios, filtered and sorted, e.g.
+        /scenarios?min_dscr=1.15&min_irr=10&order=equity_required&limit=50
+    Filters: min_irr (percent), min_dscr, max_equity, tag (repeatable), and
+    min_<column>/max_<column> for any other summary column. desc=1 sorts
+    descending; count=1 adds the total number of matches (slower on large stores).
+    Pages: offset=, or after=VALUE,ID (the sort value and id of the last row
+    of the previous page), which stays fast however deep the page is.
+    """
+    args = request.args
+    try:
+        query = scenario_query(args)
+        store = get_scenario_store()
+        scenarios = store.query(order_by=args.get("order", "equity_required"),
+                                descending=args.get("desc") == "1",
+                                limit=min(args.get("limit", 100, type=int), 1000),
+                                offset=args.get("offset", 0, type=int),
+                                after=page_cursor(args["after"]) if args.get("after") else None,
+                                **query)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = {"scenarios": scenarios}
+    if args.get("count") == "1":
+        response["count"] = store.count(**query)
+    return jsonify(response)
+
+@app.route("/results")
+def results_page():
+    """
+    Saved results as an HTML table, streamed: the page header goes out
+    before the first row is read, and rows are written as the database
+    cursor yields them, so the first byte doesn't wait for the page (or the
+    result set) to be built. Sorted and filtered in SQL (same filters as
+    /scenarios; order=irr|dscr|equity_required, desc=1) and paged with
+    keyset cursors, so any page is as quick as the first.
+    """
+    args = request.args
+    order = args.get("order", "irr")
+    descending = args.get("desc", "1" if order in ("irr", "dscr") else "0") == "1"
+    page_size = max(1, min(args.get("page_size", RESULTS_PAGE_SIZE, type=int), RESULTS_MAX_PAGE_SIZE))
+    try:
+        query = scenario_query(args)
+        after = page_cursor(args["after"]) if args.get("after") else None
+        rows = get_scenario_store().iter_query(order_by=order, descending=descending, limit=page_size, after=after, **query)
+        # Check the query before the first byte goes out: errors can't change the status once streaming
+        first = next(rows, None)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    def all_rows():
+        if first is not None:
+            yield first
+            yield from rows
+
+    # Links to the next page keep every filter and the sort
+    params = {key: values for key, values in args.lists() if key != "after"}
+    params.update(order=order, desc="1" if descending else "0", page_size=page_size)
+    return Response(stream_with_context(stream_template(
+        "scenarios.html",
+        rows=all_rows(),
+        order=order,
+        descending=descending,
+        page_size=page_size,
+        sort_columns=RESULTS_SORT_COLUMNS,
+        args=args,
+        next_url=lambda last: url_for("results_page", after=f"{'null' if last[order] is None else repr(last[order])},{last['id']}", **params),
+        first_url=url_for("results_page", **params),
+    )))
+
+@app.route("/scenarios", methods=["POST"])
+def create_scenario():
+    """Saves a cached result: {"result_id": ..., "name": ..., "tags": [...]}. Answers 201 with the scenario id."""
+    params = request.get_json(silent=True) or {}
+    result = RESULT_CACHE.get(str(params.get("result_id", "")))
+    if result is None:
+        abort(404, description="This result has expired. Please run the model again.")
+    scenario_id = get_scenario_store().save(result, tags=params.get("tags", ()), name=params.get("name"))
+    response = jsonify({"id": scenario_id})
+    response.status_code = 201
+    response.headers["Location"] = url_for("scenario", scenario_id=scenario_id)
+    return response
+
+@app.route("/scenarios/<int:scenario_id>")
+def scenario(scenario_id):
+    found = get_scenario_store().get(scenario_id)
+    if found is None:
+        abort(404)
+    return jsonify(_json_safe(found))
+
+@app.route("/scenarios/<int:scenario_id>/tags", methods=["POST"])
+def tag_scenario(scenario_id):
+    # {"add": [...], "remove": [...]}
+    params = request.get_json(silent=True) or {}
+    store = get_scenario_store()
+    if store.get(scenario_id) is None:
+        abort(404)
+    store.tag(scenario_id, *params.get("add", ()))
+    store.untag(scenario_id, *params.get("remove", ()))
+    return jsonify(store.get(scenario_id)["tags"])
+
+@app.route("/scenarios/<int:scenario_id>", methods=["DELETE"])
+def delete_scenario(scenario_id):
+    if not get_scenario_store().delete(scenario_id):
+        abort(404)
+    return "", 204
+
+@app.route("/download/<report_type>/<result_id>")
+def download_report(report_type, result_id):
+    # Result ids are input hashes; anything else can't name a report
+    if report_type not in REPORT_TYPES or not re.fullmatch(r"[0-9a-f]{32}", result_id):
+        abort(404)
+
+    # The input hash names the result, so it (with the report type and code version) is the ETag. It's
+    # weak: a rebuilt report is the same report, but not byte for byte (the files carry a build time)
+    etag = f"{result_id}-{report_type}-{ARTIFACT_VERSION}"
+    cached = not_modified(etag, weak=True, max_age=DOWNLOAD_CACHE_SECONDS)
+    if cached is not None:
+        return cached
 
-@app.route("/download/pdf")
-def download_pdf():
-    return send_file(PDF_PATH, as_attachment=True)
+    extension, mimetype = REPORT_TYPES[report_type]
+    data, built_at = build_report(result_id, report_type)
+    response = send_file(BytesIO(data),
+                         mimetype=mimetype,
+                         as_attachment=True,
+                         download_name=f"report-{result_id[:8]}.{extension}")
+    return cacheable(response, etag, weak=True, last_modified=built_at, max_age=DOWNLOAD_CACHE_SECONDS)
 
 if __name__ == "__main__":
     app.run(debug=True)
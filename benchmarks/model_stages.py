@@ -0,0 +1,337 @@
+"""
+Model stage benchmarks.
+
+Times every stage of the model, and the end-to-end index() POST, so a change
+to any of them can be checked for a slowdown:
+
+    lihtc, capital_stack, cash_flows, irr, underwrite
+        batch.py / utils.py versions, at every deal count
+    lihtc_scalar, capital_stack_scalar, cash_flows_scalar, irr_scalar
+        the original one-deal functions
+    charts, excel_report, pdf_report
+        one deal's charts and reports
+    index_post
+        POST / through to the rendered results page (cache cleared first)
+
+Batch stages run at 1, 1,000, 100,000 and 1,000,000 deals, and stages that
+depend on the hold period run at 10, 20, 30 and 40 years. Each result has the
+best wall time of a few runs and the peak memory allocated during one more
+run (measured with tracemalloc, separately, since tracing slows the code down).
+index_post underwrites in a job worker process, so its peak only covers the
+web process itself.
+
+Usage (from the repository root):
+    python benchmarks/model_stages.py --save baseline.json
+    python benchmarks/model_stages.py --compare baseline.json --threshold 0.2
+    python benchmarks/model_stages.py --quick --stages irr underwrite
+
+--compare exits with status 1 if any stage got slower (or used more memory)
+than the baseline by more than the threshold. A case that fails (e.g. an
+index_post job that fails or takes over JOB_TIMEOUT seconds) is reported and
+skipped, and the run exits with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.batch import build_capital_stack_batch, calculate_lihtc_equity_batch, project_cash_flows_batch, underwrite_batch
+from model.capital_stack import build_advanced_capital_stack
+from model.cashflow_model import project_cash_flows_enhanced
+from model.debt import permanent_loan_payments
+from model.inputs import get_project_inputs
+from model.lihtc_calculator import calculate_lihtc_equity_extended
+from model.utils import calculate_irr, solve_irr_batch
+
+DEAL_COUNTS = (1, 1_000, 100_000, 1_000_000)
+HOLD_PERIODS = (10, 20, 30, 40)
+QUICK_DEAL_COUNTS = (1, 1_000)
+QUICK_HOLD_PERIODS = (10, 40)
+
+# Stages that only make sense for one deal at a time
+SINGLE_DEAL_STAGES = ("lihtc_scalar", "capital_stack_scalar", "cash_flows_scalar", "irr_scalar",
+                      "charts", "excel_report", "pdf_report", "index_post")
+
+# Stages whose cost doesn't depend on the hold period
+HOLD_INDEPENDENT_STAGES = ("lihtc", "capital_stack", "lihtc_scalar", "capital_stack_scalar")
+
+# Timing runs per stage: stop after REPEAT runs or MIN_TIME seconds, whichever comes first
+REPEAT = 5
+MIN_TIME = 1.0
+
+# Seconds index_post waits for its underwriting job before failing the case
+JOB_TIMEOUT = 60
+
+# Differences below these are noise, whatever the threshold
+MIN_SECONDS = 0.001
+MIN_BYTES = 1024 * 1024
+
+
+def benchmark_inputs(hold_period):
+    # The default deal needs no equity (so has no IRR); a higher cost makes every stage do real work
+    inputs = get_project_inputs()
+    inputs["total_development_cost"] = 18_000_000
+    inputs["hold_period"] = hold_period
+    return inputs
+
+
+def benchmark_columns(n, hold_period, seed=0):
+    """n deals spread around benchmark_inputs(), as batch.py columns."""
+    rng = np.random.default_rng(seed)
+    columns = benchmark_inputs(hold_period)
+    columns["total_development_cost"] = 18_000_000 * rng.uniform(0.9, 1.1, n)
+    columns["noi_year_1"] = 600_000 * rng.uniform(0.8, 1.2, n)
+    columns["noi_growth_rate"] = rng.uniform(0.0, 0.03, n)
+    columns["exit_cap_rate"] = rng.uniform(0.045, 0.065, n)
+    columns["pricing"] = rng.uniform(0.8, 1.0, n)
+    columns["permanent_loan_rate"] = rng.uniform(0.04, 0.07, n)
+    columns["soft_subsidies"] = {name: np.full(n, float(amount)) for name, amount in columns["soft_subsidies"].items()}
+    return columns
+
+
+def _lihtc_scalar(inputs):
+    return calculate_lihtc_equity_extended(
+        eligible_basis=inputs["eligible_basis"],
+        applicable_fraction=inputs["applicable_fraction"],
+        credit_rate=inputs["credit_rate"],
+        pricing=inputs["pricing"],
+        credit_type=inputs["credit_type"],
+        include_syndication_fee=inputs["include_syndication_fee"],
+        syndication_fee_percent=inputs["syndication_fee_percent"],
+        use_bridge_loan=inputs["use_bridge_loan"],
+        bridge_loan_interest=inputs["bridge_loan_interest"],
+        bridge_loan_term_years=inputs["bridge_loan_term_years"]
+    )
+
+
+def _cash_flows_scalar(inputs, capital_stack):
+    debt_service, loan_payoff = permanent_loan_payments(inputs, capital_stack["Loan (DSCR & LTV Constrained)"])
+    return project_cash_flows_enhanced(
+        initial_noi=inputs["noi_year_1"],
+        noi_growth_rate=inputs["noi_growth_rate"],
+        debt_service=debt_service,
+        hold_period=inputs["hold_period"],
+        exit_cap_rate=inputs["exit_cap_rate"],
+        selling_cost_percent=inputs["selling_cost_percent"],
+        include_sale=True,
+        loan_payoff=loan_payoff
+    )
+
+
+def prepare(stage, n, hold_period, workdir):
+    """
+    Builds the inputs for one stage outside the timed region.
+    Returns a no-argument function that runs the stage once.
+    """
+    if stage in SINGLE_DEAL_STAGES:
+        inputs = benchmark_inputs(hold_period)
+        lihtc_info = _lihtc_scalar(inputs)
+        capital_stack = build_advanced_capital_stack(inputs, lihtc_info["Net Equity After Fees"])
+        cash_flows = _cash_flows_scalar(inputs, capital_stack)
+        irr = calculate_irr(cash_flows, capital_stack["Equity Required"])
+
+        if stage == "lihtc_scalar":
+            return lambda: _lihtc_scalar(inputs)
+        if stage == "capital_stack_scalar":
+            return lambda: build_advanced_capital_stack(inputs, lihtc_info["Net Equity After Fees"])
+        if stage == "cash_flows_scalar":
+            return lambda: _cash_flows_scalar(inputs, capital_stack)
+        if stage == "irr_scalar":
+            return lambda: calculate_irr(cash_flows, capital_stack["Equity Required"])
+        if stage == "charts":
+            from model.chart_generator import plot_capital_stack, plot_cash_flows, plot_irr_curve
+
+            def charts():
+                plot_cash_flows(cash_flows, os.path.join(workdir, "cash_flows.png"))
+                plot_irr_curve(cash_flows, capital_stack["Equity Required"], os.path.join(workdir, "irr_curve.png"))
+                plot_capital_stack(capital_stack, os.path.join(workdir, "capital_stack.png"))
+            return charts
+        if stage == "excel_report":
+            from model.report_generator import generate_excel_report
+            return lambda: generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, 1.15, BytesIO())
+        if stage == "pdf_report":
+            from model.report_generator import generate_pdf_report
+            return lambda: generate_pdf_report(capital_stack, lihtc_info, cash_flows, irr, 1.15, BytesIO())
+        if stage == "index_post":
+            return _prepare_index_post(inputs, workdir)
+
+    columns = benchmark_columns(n, hold_period)
+    results = underwrite_batch(columns)
+
+    if stage == "lihtc":
+        return lambda: calculate_lihtc_equity_batch(
+            eligible_basis=columns["eligible_basis"],
+            applicable_fraction=columns["applicable_fraction"],
+            credit_rate=columns["credit_rate"],
+            pricing=columns["pricing"]
+        )
+    if stage == "capital_stack":
+        return lambda: build_capital_stack_batch(
+            total_development_cost=columns["total_development_cost"],
+            lihtc_equity=results["net_equity"],
+            soft_subsidies=results["soft_subsidies"],
+            noi_year_1=columns["noi_year_1"],
+            dscr_required=columns["dscr_required"],
+            permanent_loan_rate=columns["permanent_loan_rate"],
+            permanent_loan_term=columns["permanent_loan_term"]
+        )
+    if stage == "cash_flows":
+        return lambda: project_cash_flows_batch(
+            initial_noi=columns["noi_year_1"],
+            noi_growth_rate=columns["noi_growth_rate"],
+            debt_service=results["debt_service"],
+            hold_period=hold_period,
+            exit_cap_rate=columns["exit_cap_rate"],
+            loan_payoff=results["loan_payoff"]
+        )
+    if stage == "irr":
+        flows = np.column_stack((-results["equity_required"], results["cash_flows"]))
+        return lambda: solve_irr_batch(flows)
+    if stage == "underwrite":
+        return lambda: underwrite_batch(columns)
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def _prepare_index_post(inputs, workdir):
+    # The full web path: POST /, wait for the underwriting job, then render the results page
+    import app
+    from model.jobs import DONE, FINISHED_STATES
+
+    app.CHART_DIR = workdir
+    app.get_project_inputs = lambda: dict(inputs)
+    client = app.app.test_client()
+    result_id = app.result_key(inputs)
+
+    def index_post():
+        # invalidate() drops the disk tier's copy too (RESULT_CACHE_DIR), so the POST really runs the model
+        app.RESULT_CACHE.invalidate(result_id)
+        response = client.post("/")
+        if response.status_code != 200:
+            raise RuntimeError(f"POST / returned {response.status_code}")
+        job = app.JOB_QUEUE.get(app.JOB_QUEUE.job_ids("underwrite")[-1])
+        deadline = time.perf_counter() + JOB_TIMEOUT
+        while job.status not in FINISHED_STATES:
+            if time.perf_counter() > deadline:
+                app.JOB_QUEUE.cancel(job.id)
+                raise RuntimeError(f"Underwriting job didn't finish within {JOB_TIMEOUT} seconds")
+            time.sleep(0.001)
+        if job.status != DONE:
+            raise RuntimeError(f"Underwriting job {job.status}: {job.error}")
+        response = client.get(f"/results/{result_id}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Results page returned {response.status_code}")
+    return index_post
+
+
+def measure(run):
+    """Best wall time (seconds) over a few runs, and peak traced memory (bytes) of one run."""
+    run()  # Warm up (imports, caches, first-touch allocations)
+    times = []
+    start = time.perf_counter()
+    while len(times) < REPEAT and (not times or time.perf_counter() - start < MIN_TIME):
+        t = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "runs": len(times), "peak_bytes": peak}
+
+
+def cases(stages, deal_counts, hold_periods):
+    for stage in stages:
+        for n in (1,) if stage in SINGLE_DEAL_STAGES else deal_counts:
+            for hold_period in hold_periods[:1] if stage in HOLD_INDEPENDENT_STAGES else hold_periods:
+                yield stage, n, hold_period
+
+
+def case_key(stage, n, hold_period):
+    if stage in HOLD_INDEPENDENT_STAGES:
+        return f"{stage}/n={n}"
+    return f"{stage}/n={n}/hold={hold_period}"
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get("results", {}).get(key)
+        if before is None:
+            continue
+        if result["seconds"] > before["seconds"] * (1 + threshold) and result["seconds"] - before["seconds"] > MIN_SECONDS:
+            regressions.append(f"{key}: {before['seconds'] * 1000:.2f} ms -> {result['seconds'] * 1000:.2f} ms")
+        if result["peak_bytes"] > before["peak_bytes"] * (1 + threshold) and result["peak_bytes"] - before["peak_bytes"] > MIN_BYTES:
+            regressions.append(f"{key}: peak {before['peak_bytes'] / 2**20:.1f} MB -> {result['peak_bytes'] / 2**20:.1f} MB")
+    return regressions
+
+
+ALL_STAGES = ("lihtc", "capital_stack", "cash_flows", "irr", "underwrite") + SINGLE_DEAL_STAGES
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every model stage at increasing deal counts and hold periods")
+    parser.add_argument("--stages", nargs="+", choices=ALL_STAGES, default=ALL_STAGES, metavar="STAGE", help=f"stages to run (default: all of {', '.join(ALL_STAGES)})")
+    parser.add_argument("--deals", nargs="+", type=int, help=f"deal counts (default: {', '.join(map(str, DEAL_COUNTS))})")
+    parser.add_argument("--hold-periods", nargs="+", type=int, help=f"hold periods (default: {', '.join(map(str, HOLD_PERIODS))})")
+    parser.add_argument("--quick", action="store_true", help="only 1 and 1,000 deals at 10 and 40 year holds")
+    parser.add_argument("--save", metavar="FILE", help="write results to a JSON baseline file")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a JSON baseline file")
+    parser.add_argument("--threshold", type=float, default=0.20, help="allowed slowdown/memory growth (fraction) before flagging")
+    args = parser.parse_args()
+
+    deal_counts = args.deals or (QUICK_DEAL_COUNTS if args.quick else DEAL_COUNTS)
+    hold_periods = args.hold_periods or (QUICK_HOLD_PERIODS if args.quick else HOLD_PERIODS)
+
+    results = {}
+    failures = []
+    print(f"{'Case':<36}{'Time (ms)':>12}{'Deals/sec':>14}{'Peak (MB)':>11}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for stage, n, hold_period in cases(args.stages, deal_counts, hold_periods):
+            key = case_key(stage, n, hold_period)
+            try:
+                result = measure(prepare(stage, n, hold_period, workdir))
+            except RuntimeError as e:
+                # One broken case is reported, not left to hang or stop the whole run
+                failures.append(key)
+                print(f"{key:<36}  FAILED: {e}")
+                continue
+            result.update({"stage": stage, "deals": n, "hold_period": hold_period})
+            results[key] = result
+            print(f"{key:<36}{result['seconds'] * 1000:>12.3f}{n / result['seconds']:>14,.0f}{result['peak_bytes'] / 2**20:>11.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "results": results,
+            }, f, indent=2)
+
+    if failures:
+        print(f"\nFailed: {', '.join(failures)}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\nRegressions (more than {args.threshold:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,153 @@
+"""
+Full-precision vs rounded model outputs.
+
+The model rounds dollar amounts to cents (and IRR/DSCR to two decimals) at
+every stage by default; with full_precision=True (see model/utils.py
+rounded()) it doesn't, and rounding happens once, for display. This
+underwrites a random set of deals both ways, with batch.py and with the
+one-deal pipeline, rounds the full-precision outputs the way the templates
+and reports do, and checks they agree with the rounded mode within:
+
+    dollar amounts   MONEY_TOLERANCE ($0.01: a value on a half-cent boundary
+                     can round the other way)
+    DSCR             RATIO_TOLERANCE (0.01)
+    IRR              IRR_TOLERANCE (0.01 percentage points) for deals with at
+                     least MIN_EQUITY of equity required. With only a few
+                     hundred dollars of equity, a cent of rounding in the
+                     equity moves the IRR by whole points; those deals are
+                     counted but not checked.
+    IRR status       identical (a deal solves in both modes or in neither)
+
+Usage (from the repository root):
+    python benchmarks/precision.py
+    python benchmarks/precision.py --deals 1000000 --seed 7
+
+Exits with status 1 if any output is outside its tolerance.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.batch import to_columns, underwrite_batch
+from model.inputs import get_project_inputs
+from model.pipeline import run_pipeline
+from model.records import DealInputs
+
+MONEY_TOLERANCE = 0.01
+RATIO_TOLERANCE = 0.01
+IRR_TOLERANCE = 0.01
+MIN_EQUITY = 10_000
+
+# Ranges the random deals are drawn from (every other input is get_project_inputs()'s)
+DEAL_RANGES = {
+    "total_development_cost": (12_000_000, 30_000_000),
+    "noi_year_1": (300_000, 1_000_000),
+    "pricing": (0.80, 0.95),
+    "permanent_loan_rate": (0.04, 0.08),
+    "exit_cap_rate": (0.04, 0.08),
+    "noi_growth_rate": (0.0, 0.04),
+}
+
+# underwrite_batch() outputs in dollars
+MONEY_FIELDS = (
+    "net_equity", "loan", "interest_reserve", "deferred_dev_fee", "equity_required",
+    "total_sources", "total_uses", "debt_service", "loan_payoff", "cash_flows",
+)
+
+
+def random_columns(n, seed):
+    rng = np.random.default_rng(seed)
+    columns = to_columns([get_project_inputs()])
+    for key, (low, high) in DEAL_RANGES.items():
+        columns[key] = rng.uniform(low, high, n)
+    columns["hold_period"] = rng.integers(5, 31, n)
+    columns["loan_payments_per_year"] = rng.choice([1, 12], n)
+    return columns
+
+
+def max_difference(rounded_values, full_values, mask=None):
+    # Largest gap between the rounded mode and full precision rounded for display
+    difference = np.abs(np.asarray(rounded_values, dtype=float) - np.round(np.asarray(full_values, dtype=float), 2))
+    if mask is not None:
+        difference = difference[mask]
+    difference = difference[np.isfinite(difference)]
+    return float(difference.max()) if difference.size else 0.0
+
+
+def compare_batch(columns):
+    """(rows of (output, max difference, tolerance), deals whose IRR was not checked, seconds rounded, seconds full precision)."""
+    start = time.perf_counter()
+    rounded = underwrite_batch(columns)
+    rounded_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    full = underwrite_batch(columns, full_precision=True)
+    full_seconds = time.perf_counter() - start
+
+    rows = [(field, max_difference(rounded[field], full[field]), MONEY_TOLERANCE) for field in MONEY_FIELDS]
+    rows.append(("dscr", max_difference(rounded["dscr"], full["dscr"]), RATIO_TOLERANCE))
+    checked = rounded["equity_required"] >= MIN_EQUITY
+    rows.append(("irr", max_difference(rounded["irr"], full["irr"], checked), IRR_TOLERANCE))
+    rows.append(("irr_status", float(np.count_nonzero(rounded["irr_status"] != full["irr_status"])), 0))
+    skipped = int(np.count_nonzero(np.isfinite(rounded["irr"]) & ~checked))
+    return rows, skipped, rounded_seconds, full_seconds
+
+
+def compare_pipeline(columns, n):
+    """The same check for the one-deal pipeline (run_pipeline), on the first n deals."""
+    deals = []
+    for i in range(n):
+        deal = get_project_inputs()
+        deal.update({key: float(columns[key][i]) for key in DEAL_RANGES})
+        deal["hold_period"] = int(columns["hold_period"][i])
+        deal["loan_payments_per_year"] = int(columns["loan_payments_per_year"][i])
+        deals.append(DealInputs.from_dict(deal))
+
+    worst = {"money": 0.0, "dscr": 0.0, "irr": 0.0}
+    for deal in deals:
+        rounded = run_pipeline(deal).result
+        full = run_pipeline(deal, full_precision=True).result
+        money = [(rounded.capital_stack.equity_required, full.capital_stack.equity_required),
+                 (rounded.capital_stack.loan, full.capital_stack.loan),
+                 (rounded.lihtc.net_equity, full.lihtc.net_equity)]
+        money += list(zip(rounded.projection.cash_flows, full.projection.cash_flows))
+        worst["money"] = max(worst["money"], max(max_difference(a, b) for a, b in money))
+        worst["dscr"] = max(worst["dscr"], max_difference(rounded.dscr, full.dscr))
+        if rounded.capital_stack.equity_required >= MIN_EQUITY:
+            worst["irr"] = max(worst["irr"], max_difference(rounded.irr, full.irr))
+    return [
+        ("pipeline money", worst["money"], MONEY_TOLERANCE),
+        ("pipeline dscr", worst["dscr"], RATIO_TOLERANCE),
+        ("pipeline irr", worst["irr"], IRR_TOLERANCE),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check full-precision outputs against the rounded model")
+    parser.add_argument("--deals", type=int, default=100_000, help="random deals underwritten with batch.py")
+    parser.add_argument("--pipeline-deals", type=int, default=1_000, help="of those, deals also run through run_pipeline")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the deals")
+    args = parser.parse_args()
+
+    columns = random_columns(args.deals, args.seed)
+    rows, skipped, rounded_seconds, full_seconds = compare_batch(columns)
+    rows += compare_pipeline(columns, min(args.pipeline_deals, args.deals))
+
+    print(f"{'Output':<24}{'Max difference':>16}{'Tolerance':>12}")
+    failures = []
+    for name, difference, tolerance in rows:
+        print(f"{name:<24}{difference:>16.6f}{tolerance:>12.2f}")
+        # (a hair over the tolerance is float noise in the last rounding, not a real difference)
+        if difference > tolerance + 1e-6:
+            failures.append(name)
+
+    print(f"\n{args.deals:,} deals; IRR not checked for {skipped:,} with less than ${MIN_EQUITY:,} of equity")
+    print(f"underwrite_batch: {rounded_seconds * 1000:.1f} ms rounded, {full_seconds * 1000:.1f} ms full precision")
+    if failures:
+        print(f"Outside tolerance: {', '.join(failures)}")
+        sys.exit(1)
+    print("Within tolerance.")
@@ -0,0 +1,105 @@
+"""
+Startup-time benchmark.
+
+Measures how long it takes to import `app`, `model.main` and every module in
+model/, each in a fresh Python process (so nothing is already cached in
+sys.modules), and which heavy libraries each import drags in.
+
+Usage (from the repository root):
+    python benchmarks/startup.py                           # print a table
+    python benchmarks/startup.py --save startup.json       # record a baseline
+    python benchmarks/startup.py --compare startup.json    # fail if anything got slower
+
+The median of several runs is reported to smooth out noise; --compare exits
+with status 1 when a module's median import time is more than --threshold
+(default 25%) and at least 50 ms above the baseline.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that should only be loaded when a chart or report is actually requested
+HEAVY_MODULES = ("matplotlib", "reportlab", "xlsxwriter", "numpy_financial")
+
+# Ignore differences smaller than this (seconds) when comparing with a baseline
+MIN_REGRESSION = 0.050
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def startup_modules():
+    modules = ["app", "model.main"]
+    for path in sorted(glob.glob(os.path.join(ROOT, "model", "*.py"))):
+        name = "model." + os.path.splitext(os.path.basename(path))[0]
+        if name not in modules and not name.endswith("__init__"):
+            modules.append(name)
+    return modules
+
+
+def time_import(module, runs):
+    times = []
+    heavy = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["seconds"])
+        heavy = result["heavy"]
+    return {"median": statistics.median(times), "min": min(times), "heavy_imports": heavy}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for module, result in results.items():
+        before = baseline.get("modules", {}).get(module)
+        if before is None:
+            continue
+        if result["median"] > before["median"] * (1 + threshold) and result["median"] - before["median"] > MIN_REGRESSION:
+            regressions.append(f"{module}: {before['median'] * 1000:.0f} ms -> {result['median'] * 1000:.0f} ms")
+        for heavy in set(result["heavy_imports"]) - set(before["heavy_imports"]):
+            regressions.append(f"{module}: now imports {heavy}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time of the app and model modules")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per module")
+    parser.add_argument("--save", metavar="FILE", help="write results to a JSON baseline file")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a JSON baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown (fraction) before flagging")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'Module':<28}{'Median (ms)':>12}{'Min (ms)':>10}  Heavy imports")
+    for module in startup_modules():
+        results[module] = time_import(module, args.runs)
+        r = results[module]
+        print(f"{module:<28}{r['median'] * 1000:>12.1f}{r['min'] * 1000:>10.1f}  {', '.join(r['heavy_imports']) or '-'}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version.split()[0], "runs": args.runs, "modules": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nStartup regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo startup regressions.")
@@ -0,0 +1,372 @@
+import numpy as np
+
+from model.debt import annual_debt_service, loan_amount, loan_balance
+from model.utils import rounded, solve_irr_batch
+
+"""
+Batch (vectorized) versions of the underwriting pipeline:
+
+    LIHTC equity -> capital stack -> cash flows
+
+The functions in lihtc_calculator.py, capital_stack.py and cashflow_model.py
+underwrite one deal at a time using Python dicts and scalars. When screening
+a pipeline of thousands of candidate deals, that means thousands of
+interpreter-bound loops. The functions here take arrays of inputs
+(one element per deal) and do the same math with NumPy, so the whole pipeline
+runs as a handful of array operations.
+
+The numbers match the scalar functions to the cent: intermediate values are
+rounded at the same points the scalar pipeline rounds them
+(e.g. net LIHTC equity is rounded before it is passed to the capital stack,
+and the loan is rounded before its debt service and payoff are computed).
+With full_precision=True nothing is rounded, matching the scalar functions'
+full-precision mode instead (see utils.rounded).
+"""
+
+
+# Per-deal results written out for every deal by the JSON API and the portfolio CLI (keys of underwrite_batch())
+RESULT_FIELDS = (
+    "net_equity",
+    "soft_subsidies",
+    "loan",
+    "interest_reserve",
+    "deferred_dev_fee",
+    "equity_required",
+    "total_sources",
+    "total_uses",
+    "debt_service",
+    "loan_payoff",
+    "dscr",
+    "irr",
+)
+
+# Results that must be finite for a deal to count as underwritten (IRR and DSCR may legitimately be NaN)
+REQUIRED_FINITE_FIELDS = ("net_equity", "loan", "equity_required", "debt_service", "loan_payoff")
+
+
+def finite_rows(results):
+    """Mask of the deals in underwrite_batch() results whose required results (and cash flows) are all finite."""
+    finite = np.ones(len(results["irr"]), dtype=bool)
+    for field in REQUIRED_FINITE_FIELDS:
+        finite &= np.isfinite(results[field])
+    return finite & np.isfinite(results["cash_flows"]).all(axis=1)
+
+
+def to_columns(deals):
+    """
+    Converts a list of deal dicts (shaped like get_project_inputs()) into a
+    dict of NumPy arrays, one array per input key.
+
+    Soft subsidies are kept as a nested dict of arrays (one per source);
+    a deal that doesn't have a given source gets 0 for it.
+    """
+    deals = list(deals)
+    keys = []
+    subsidy_names = []
+    for deal in deals:
+        for key, value in deal.items():
+            if key == "soft_subsidies":
+                for name in value:
+                    if name not in subsidy_names:
+                        subsidy_names.append(name)
+            elif key not in keys:
+                keys.append(key)
+
+    columns = {}
+    for key in keys:
+        values = [deal.get(key) for deal in deals]
+        if all(isinstance(v, str) for v in values):
+            columns[key] = np.array(values, dtype=object)
+        else:
+            columns[key] = np.array(values, dtype=float)
+
+    if subsidy_names:
+        columns["soft_subsidies"] = {
+            name: np.array([deal.get("soft_subsidies", {}).get(name, 0) for deal in deals], dtype=float)
+            for name in subsidy_names
+        }
+
+    return columns
+
+
+def set_input(columns, key, values):
+    """
+    Sets one input column. Soft subsidy sources can be addressed with a
+    dotted key, e.g. "soft_subsidies.HOME".
+    """
+    if key.startswith("soft_subsidies."):
+        name = key.split(".", 1)[1]
+        subsidies = dict(columns.get("soft_subsidies", {}))
+        subsidies[name] = values
+        columns["soft_subsidies"] = subsidies
+    else:
+        columns[key] = values
+    return columns
+
+
+def get_input(columns, key):
+    """Reads one input column, accepting dotted soft subsidy keys (see set_input)."""
+    if key.startswith("soft_subsidies."):
+        return columns.get("soft_subsidies", {})[key.split(".", 1)[1]]
+    return columns[key]
+
+
+def batch_size(columns):
+    """Number of deals in a set of columns (scalars count as broadcast values)."""
+    sizes = [np.size(v) for v in columns.values() if not isinstance(v, dict) and np.ndim(v) > 0]
+    for subsidies in (v for v in columns.values() if isinstance(v, dict)):
+        sizes += [np.size(v) for v in subsidies.values() if np.ndim(v) > 0]
+    return max(sizes, default=1)
+
+
+def input_column(columns, key, n, default=None, dtype=float):
+    """
+    One input as an array of n values (`default` if the columns don't have
+    it), broadcasting a scalar without copying it.
+    """
+    value = columns.get(key, default)
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (n,))
+
+
+def calculate_lihtc_equity_batch(
+    eligible_basis,
+    applicable_fraction,
+    credit_rate,
+    term=10,
+    pricing=0.90,
+    include_syndication_fee=True,
+    syndication_fee_percent=0.05,
+    use_bridge_loan=True,
+    bridge_loan_interest=0.06,
+    bridge_loan_term_years=2,
+    full_precision=False
+):
+    """
+    Array version of calculate_lihtc_equity_extended().
+    Every argument may be a scalar or an array (one element per deal).
+    """
+    qualified_basis = np.multiply(eligible_basis, applicable_fraction)
+    annual_credit = qualified_basis * credit_rate
+    total_credit = annual_credit * term
+    gross_equity = total_credit * pricing
+
+    syndication_fee = np.where(include_syndication_fee, gross_equity * syndication_fee_percent, 0.0)
+    net_equity = gross_equity - syndication_fee
+
+    # Bridge loan covers the 75% of equity paid after closing (see lihtc_calculator.py)
+    average_equity_gap = np.where(use_bridge_loan, net_equity * (0.75 / 2), 0.0)
+    interest_due = np.where(use_bridge_loan, average_equity_gap * bridge_loan_interest * bridge_loan_term_years, 0.0)
+
+    def cents(values):
+        return rounded(values, 2, full_precision)
+
+    return {
+        "qualified_basis": qualified_basis,
+        "annual_credit": cents(annual_credit),
+        "total_credit": cents(total_credit),
+        "gross_equity": cents(gross_equity),
+        "syndication_fee": cents(syndication_fee),
+        "net_equity": cents(net_equity),
+        "disbursement_closing": cents(net_equity * 0.25),
+        "disbursement_construction": cents(net_equity * 0.50),
+        "disbursement_stabilization": cents(net_equity * 0.25),
+        "bridge_loan_principal": cents(average_equity_gap),
+        "bridge_loan_interest": cents(interest_due),
+    }
+
+
+def build_capital_stack_batch(
+    total_development_cost,
+    lihtc_equity,
+    soft_subsidies,
+    noi_year_1,
+    dscr_required,
+    permanent_loan_rate,
+    permanent_loan_term,
+    construction_period_years=2,
+    max_deferred_dev_fee=500000,
+    loan_payments_per_year=1,
+    full_precision=False
+):
+    """
+    Array version of build_advanced_capital_stack().
+    soft_subsidies is the total of all soft sources for each deal.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        annual_debt_service_capacity = np.divide(noi_year_1, dscr_required)
+        r = np.asarray(permanent_loan_rate, dtype=float)
+        loan_limit_by_dscr = loan_amount(annual_debt_service_capacity, r, permanent_loan_term, loan_payments_per_year)
+
+    loan_limit_by_ltv = 0.75 * np.asarray(total_development_cost, dtype=float)
+    loan = np.minimum(loan_limit_by_dscr, loan_limit_by_ltv)
+
+    interest_reserve = loan * r * construction_period_years
+
+    used_sources = lihtc_equity + soft_subsidies + loan
+
+    funding_gap = total_development_cost + interest_reserve - used_sources
+    deferred_dev_fee = np.minimum(funding_gap, max_deferred_dev_fee)
+    equity = funding_gap - deferred_dev_fee
+
+    def cents(values):
+        return rounded(values, 2, full_precision)
+
+    return {
+        "loan": cents(loan),
+        "interest_reserve": cents(interest_reserve),
+        "funding_gap": funding_gap,
+        "deferred_dev_fee": cents(deferred_dev_fee),
+        "equity_required": cents(equity),
+        "total_sources": cents(used_sources + interest_reserve + deferred_dev_fee + equity),
+        "total_uses": cents(total_development_cost + interest_reserve),
+    }
+
+
+def project_cash_flows_batch(
+    initial_noi,
+    noi_growth_rate,
+    debt_service,
+    hold_period=10,
+    exit_cap_rate=0.05,
+    selling_cost_percent=0.02,
+    include_sale=True,
+    loan_payoff=0.0,
+    full_precision=False
+):
+    """
+    Array version of project_cash_flows_enhanced().
+
+    Returns an N x max(hold_period) matrix of annual cash flows to equity.
+    Deals with a shorter hold period than the widest one are padded with
+    zeros after their sale year (trailing zeros don't change IRR or NPV).
+    """
+    hold_period = np.asarray(hold_period, dtype=int)
+    n = max(np.size(initial_noi), np.size(noi_growth_rate), np.size(debt_service),
+            np.size(hold_period), np.size(exit_cap_rate), np.size(selling_cost_percent))
+    hold_period = np.broadcast_to(hold_period, (n,))
+    growth = np.broadcast_to(np.asarray(noi_growth_rate, dtype=float), (n,))
+    debt_service = np.broadcast_to(np.asarray(debt_service, dtype=float), (n,))
+    include_sale = np.broadcast_to(np.asarray(include_sale, dtype=bool), (n,))
+    loan_payoff = np.broadcast_to(np.asarray(loan_payoff, dtype=float), (n,))
+
+    # Sale proceeds are computed for every deal up front and masked in at its final year
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sale_factor = (1 - np.asarray(selling_cost_percent, dtype=float)) / np.asarray(exit_cap_rate, dtype=float)
+    sale_factor = np.broadcast_to(sale_factor, (n,))
+
+    periods = int(hold_period.max()) if n else 0
+    cash_flows = np.zeros((n, periods))
+    noi = np.array(np.broadcast_to(np.asarray(initial_noi, dtype=float), (n,)))
+
+    # Loop over years (not deals) so NOI compounds in the same order as the scalar model
+    for year in range(periods):
+        active = year < hold_period
+        cash_flows[:, year] = np.where(active, noi - debt_service, 0.0)
+        noi = noi * (1 + growth)
+
+        selling = (hold_period == year + 1) & include_sale
+        if selling.any():
+            final_noi = noi[selling] / (1 + growth[selling])  # Adjust back one year
+            cash_flows[selling, year] += final_noi * sale_factor[selling] - loan_payoff[selling]
+
+    return rounded(cash_flows, 2, full_precision)
+
+
+def underwrite_batch(columns, full_precision=False):
+    """
+    Runs the full underwriting pipeline (the same steps as model/main.py)
+    for every deal in `columns` at once.
+
+    `columns` is a dict keyed like get_project_inputs(); each value is
+    either a scalar (shared by every deal) or an array with one element per
+    deal. Soft subsidies can be a dict of arrays (one per source) or a
+    single array of totals. Use to_columns() to build it from a list of
+    deal dicts.
+
+    Returns a dict of arrays, including an N x hold_period "cash_flows" matrix
+    and the equity IRR (as a percentage, see solve_irr_batch for "irr_status").
+    full_precision=True skips every intermediate rounding (see utils.rounded).
+    """
+    n = batch_size(columns)
+
+    soft = columns.get("soft_subsidies", 0.0)
+    if isinstance(soft, dict):
+        soft_total = np.zeros(n)
+        for amount in soft.values():
+            soft_total = soft_total + np.asarray(amount, dtype=float)
+    else:
+        soft_total = np.broadcast_to(np.asarray(soft, dtype=float), (n,))
+
+    lihtc = calculate_lihtc_equity_batch(
+        eligible_basis=input_column(columns, "eligible_basis", n),
+        applicable_fraction=input_column(columns, "applicable_fraction", n),
+        credit_rate=input_column(columns, "credit_rate", n),
+        pricing=input_column(columns, "pricing", n, 0.90),
+        include_syndication_fee=input_column(columns, "include_syndication_fee", n, True, bool),
+        syndication_fee_percent=input_column(columns, "syndication_fee_percent", n, 0.05),
+        use_bridge_loan=input_column(columns, "use_bridge_loan", n, True, bool),
+        bridge_loan_interest=input_column(columns, "bridge_loan_interest", n, 0.06),
+        bridge_loan_term_years=input_column(columns, "bridge_loan_term_years", n, 2),
+        full_precision=full_precision
+    )
+
+    noi_year_1 = input_column(columns, "noi_year_1", n)
+    permanent_loan_rate = input_column(columns, "permanent_loan_rate", n)
+    permanent_loan_term = input_column(columns, "permanent_loan_term", n)
+    loan_payments_per_year = input_column(columns, "loan_payments_per_year", n, 1, int)
+    hold_period = input_column(columns, "hold_period", n, 10, int)
+
+    stack = build_capital_stack_batch(
+        total_development_cost=input_column(columns, "total_development_cost", n),
+        lihtc_equity=lihtc["net_equity"],
+        soft_subsidies=soft_total,
+        noi_year_1=noi_year_1,
+        dscr_required=input_column(columns, "dscr_required", n),
+        permanent_loan_rate=permanent_loan_rate,
+        permanent_loan_term=permanent_loan_term,
+        construction_period_years=input_column(columns, "construction_period_years", n, 2),
+        max_deferred_dev_fee=input_column(columns, "max_deferred_dev_fee", n, 500000),
+        loan_payments_per_year=loan_payments_per_year,
+        full_precision=full_precision
+    )
+
+    # Amortizing debt service, and the balance paid off from the sale at the end of the hold
+    debt_service = annual_debt_service(stack["loan"], permanent_loan_rate, permanent_loan_term, loan_payments_per_year)
+    loan_payoff = loan_balance(stack["loan"], permanent_loan_rate, permanent_loan_term, hold_period, loan_payments_per_year)
+
+    cash_flows = project_cash_flows_batch(
+        initial_noi=noi_year_1,
+        noi_growth_rate=input_column(columns, "noi_growth_rate", n),
+        debt_service=debt_service,
+        hold_period=hold_period,
+        exit_cap_rate=input_column(columns, "exit_cap_rate", n, 0.05),
+        selling_cost_percent=input_column(columns, "selling_cost_percent", n, 0.02),
+        include_sale=True,
+        loan_payoff=loan_payoff,
+        full_precision=full_precision
+    )
+
+    # IRR on the equity investment, as a percentage (same as calculate_irr)
+    irr = solve_irr_batch(np.column_stack((-stack["equity_required"], cash_flows)))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dscr = rounded(noi_year_1 / debt_service, 2, full_precision)
+
+    results = {"soft_subsidies": soft_total}
+    results.update(lihtc)
+    results.update(stack)
+    results["debt_service"] = debt_service
+    results["loan_payoff"] = loan_payoff
+    results["cash_flows"] = cash_flows
+    results["hold_period"] = hold_period
+    results["irr"] = rounded(irr.irr * 100, 2, full_precision)
+    results["irr_status"] = irr.status
+    results["dscr"] = dscr
+    return results
+
+
+# Example: screen the default deal at a few different investor pricings
+# from inputs import get_project_inputs
+# columns = to_columns([get_project_inputs()])
+# columns["pricing"] = np.array([0.85, 0.90, 0.95])
+# print(underwrite_batch(columns)["equity_required"])
@@ -0,0 +1,238 @@
+import os
+import shutil
+import uuid
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+"""
+Result buffers: model outputs that live outside any one process.
+
+A big sweep or simulation used to return its results from each worker
+process pickled, and the app then copied them again into whatever drew the
+charts or wrote the report. A ResultBuffer is a fixed set of arrays laid
+out once, up front, in memory every process can map:
+
+    - shared memory (multiprocessing.shared_memory): one segment holding
+      every array, gone when the owner unlinks it
+    - memory-mapped .npy files in a directory: survive the run, so the web
+      process (or a later one) can open them after the workers are done
+
+Workers attach by the buffer's `spec` (a small picklable tuple, not the
+data), write their rows in place with write(), and return nothing but a row
+count. Readers attach the same way and get numpy views on the same pages:
+no pickling, no copies, and a run of hundreds of millions of cash flow cells
+takes its size in RAM (or page cache) once.
+
+Layout, for N deals and a hold period of up to H years:
+
+    cash_flows                 N x H float64 (zero after each deal's sale year)
+    hold_period                N int16
+    irr_status                 N int8
+    irr, dscr, loan, ...       N float64 each (SCALAR_FIELDS)
+"""
+
+# Per-deal float64 results kept in a buffer (keys of underwrite_batch())
+SCALAR_FIELDS = (
+    "irr",
+    "dscr",
+    "net_equity",
+    "soft_subsidies",
+    "loan",
+    "interest_reserve",
+    "funding_gap",
+    "deferred_dev_fee",
+    "equity_required",
+    "total_sources",
+    "total_uses",
+    "debt_service",
+    "loan_payoff",
+)
+
+SHARED_MEMORY = "shm"
+MEMMAP = "npy"
+
+# What a process needs to attach to a buffer
+BufferSpec = namedtuple("BufferSpec", ["backend", "location", "size", "hold_period"])
+
+
+def buffer_layout(size, hold_period):
+    """(field, dtype, shape) of every array in a buffer, in storage order."""
+    layout = [("cash_flows", np.float64, (size, hold_period))]
+    layout += [(field, np.float64, (size,)) for field in SCALAR_FIELDS]
+    layout += [("hold_period", np.int16, (size,)), ("irr_status", np.int8, (size,))]
+    return layout
+
+
+def buffer_nbytes(size, hold_period):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in buffer_layout(size, hold_period))
+
+
+class ResultBuffer:
+    """
+    Named arrays (see buffer_layout()) in shared memory or .npy memmaps.
+
+        buffer = ResultBuffer.create(draws, 10)               # shared memory
+        buffer = ResultBuffer.create(draws, 10, path="runs/x") # .npy files
+        pool.submit(worker, buffer.spec, start, ...)           # worker: ResultBuffer.attach(spec)
+        buffer["irr"]                                          # a view, not a copy
+
+    The process that created a buffer owns it: unlink() frees the shared
+    memory or deletes the files. Everyone else just close()s.
+    """
+
+    def __init__(self, spec, arrays, segment=None, owner=False):
+        self.spec = spec
+        self.arrays = arrays
+        self._segment = segment
+        self._owner = owner
+
+    @classmethod
+    def create(cls, size, hold_period, path=None):
+        """A zeroed buffer for `size` deals with up to `hold_period` years of cash flows."""
+        if path is None:
+            nbytes = buffer_nbytes(size, hold_period)
+            segment = shared_memory.SharedMemory(name=f"lihtc_{uuid.uuid4().hex[:16]}", create=True, size=max(nbytes, 1))
+            spec = BufferSpec(SHARED_MEMORY, segment.name, size, hold_period)
+            buffer = cls(spec, cls._views(segment.buf, size, hold_period), segment, owner=True)
+            for array in buffer.arrays.values():
+                array.fill(0)
+            return buffer
+
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            field: np.lib.format.open_memmap(os.path.join(path, f"{field}.npy"), mode="w+", dtype=dtype, shape=shape)
+            for field, dtype, shape in buffer_layout(size, hold_period)
+        }
+        return cls(BufferSpec(MEMMAP, os.path.abspath(path), size, hold_period), arrays, owner=True)
+
+    @classmethod
+    def attach(cls, spec, readonly=False):
+        """Opens an existing buffer from its spec (in this or any other process)."""
+        spec = BufferSpec(*spec)
+        if spec.backend == SHARED_MEMORY:
+            segment = shared_memory.SharedMemory(name=spec.location)
+            arrays = cls._views(segment.buf, spec.size, spec.hold_period)
+            if readonly:
+                for array in arrays.values():
+                    array.flags.writeable = False
+            return cls(spec, arrays, segment)
+
+        mode = "r" if readonly else "r+"
+        arrays = {
+            field: np.load(os.path.join(spec.location, f"{field}.npy"), mmap_mode=mode)
+            for field, _, _ in buffer_layout(spec.size, spec.hold_period)
+        }
+        return cls(spec, arrays)
+
+    @classmethod
+    def open(cls, path, readonly=True):
+        """Opens a .npy buffer directory by path (its size is read from the files)."""
+        cash_flows = np.load(os.path.join(path, "cash_flows.npy"), mmap_mode="r")
+        size, hold_period = cash_flows.shape
+        del cash_flows
+        return cls.attach(BufferSpec(MEMMAP, os.path.abspath(path), size, hold_period), readonly)
+
+    @staticmethod
+    def _views(memory, size, hold_period):
+        arrays, offset = {}, 0
+        for field, dtype, shape in buffer_layout(size, hold_period):
+            count = int(np.prod(shape))
+            arrays[field] = np.ndarray(shape, dtype=dtype, buffer=memory, offset=offset)
+            offset += count * np.dtype(dtype).itemsize
+        return arrays
+
+    def __getitem__(self, field):
+        return self.arrays[field]
+
+    def __len__(self):
+        return self.spec.size
+
+    @property
+    def nbytes(self):
+        return buffer_nbytes(self.spec.size, self.spec.hold_period)
+
+    def write(self, start, results):
+        """
+        Copies a slice of underwrite_batch() results into rows start.. of the
+        buffer (straight from the worker's arrays into the shared pages).
+        """
+        rows = len(results["irr"])
+        stop = start + rows
+        if stop > self.spec.size:
+            raise ValueError(f"Rows {start}..{stop} don't fit in a buffer of {self.spec.size}")
+        cash_flows = results["cash_flows"]
+        if cash_flows.shape[1] > self.spec.hold_period:
+            raise ValueError(f"Cash flows of {cash_flows.shape[1]} years don't fit in a buffer of {self.spec.hold_period}")
+
+        self.arrays["cash_flows"][start:stop, :cash_flows.shape[1]] = cash_flows
+        self.arrays["cash_flows"][start:stop, cash_flows.shape[1]:] = 0.0
+        for field in SCALAR_FIELDS:
+            self.arrays[field][start:stop] = results[field]
+        self.arrays["hold_period"][start:stop] = results["hold_period"]
+        self.arrays["irr_status"][start:stop] = results["irr_status"]
+        return rows
+
+    def flush(self):
+        if self.spec.backend == MEMMAP:
+            for array in self.arrays.values():
+                if isinstance(array, np.memmap):
+                    array.flush()
+
+    def close(self):
+        """Drops this process's mapping (the data stays for everyone else)."""
+        self.flush()
+        # Views into a shared memory segment have to go before the segment can close
+        self.arrays = {}
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def unlink(self):
+        """Frees the buffer for good (owner only): shared memory is released, .npy files deleted."""
+        spec = self.spec
+        segment = self._segment
+        self.arrays = {}
+        if spec.backend == SHARED_MEMORY:
+            if segment is None:
+                segment = shared_memory.SharedMemory(name=spec.location)
+            segment.close()
+            segment.unlink()
+            self._segment = None
+        else:
+            shutil.rmtree(spec.location, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._owner:
+            self.unlink()
+        else:
+            self.close()
+
+
+def prune_buffer_dirs(directory, keep, in_use=()):
+    """
+    Deletes all but the `keep` newest .npy buffer directories under
+    `directory`. Directories named in `in_use` are never deleted (they still
+    count towards `keep`).
+    """
+    if not os.path.isdir(directory):
+        return
+    entries = [entry for entry in os.scandir(directory) if entry.is_dir()]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    in_use = set(in_use)
+    for entry in entries[keep:]:
+        if entry.name not in in_use:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def write_results(spec, start, results):
+    """For worker processes: attach to the buffer, write a slice of results, detach."""
+    buffer = ResultBuffer.attach(spec)
+    try:
+        return buffer.write(start, results)
+    finally:
+        buffer.close()
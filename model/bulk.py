@@ -0,0 +1,114 @@
+import json
+
+import numpy as np
+
+from model.batch import RESULT_FIELDS, finite_rows, to_columns, underwrite_batch
+from model.inputs import OPTIONAL_INPUTS, get_project_inputs, validate_deal
+from model.metrics import span
+from model.records import ResultBatch
+
+"""
+Bulk underwriting for the JSON API.
+
+Deals arrive as JSON objects keyed like get_project_inputs(); any key that's
+missing takes its value from get_project_inputs(). Each deal is validated on
+its own, so one bad deal in a batch of thousands is reported on its own line
+instead of failing the whole request:
+
+    validate_deal()    (inputs.py) checks keys, types and the ranges the
+                       formulas need (e.g. a zero exit cap rate divides by zero)
+    underwrite_lines() underwrites the valid deals of each chunk with
+                       batch.py and yields that chunk's NDJSON lines as soon
+                       as it is done, so a client starts reading results
+                       while later chunks are still being computed
+
+Every output line has the deal's "index" in the request (and its "deal_id"
+if it had one) and either the results or an "error".
+
+Lines are built straight from the result arrays rather than with a
+json.dumps() of a dict per deal: each result column is formatted in one
+json.dumps() call on the whole list (C code, the same repr() of each float)
+and the lines are joined from those pieces. NaN and infinity become null.
+"""
+
+DEFAULT_CHUNK_SIZE = 1_000
+
+
+# json.dumps() writes non-finite floats like this; JSON has no such numbers, so they become null
+_NON_FINITE = {"NaN": "null", "Infinity": "null", "-Infinity": "null"}
+
+
+def _json_column(values):
+    # One column of floats as JSON numbers. json.dumps() formats a whole list
+    # in C (the same repr() a float gets one at a time), then it's split up
+    text = json.dumps(np.asarray(values, dtype=float).tolist(), separators=(",", ":"))[1:-1]
+    return [_NON_FINITE.get(value, value) for value in text.split(",")] if text else []
+
+
+def _line_prefix(index, record):
+    if isinstance(record, dict) and "deal_id" in record:
+        return f'{{"index":{index},"deal_id":{json.dumps(record["deal_id"])}'
+    return f'{{"index":{index}'
+
+
+def _error_line(index, record, message):
+    return f'{_line_prefix(index, record)},"error":{json.dumps(message)}}}'
+
+
+def _result_lines(indices, records, results, cash_flows=True):
+    # Every line is the same template filled with preformatted strings
+    columns = [[_line_prefix(index, record) for index, record in zip(indices, records)]]
+    columns += [_json_column(results[field]) for field in RESULT_FIELDS]
+    template = "%s" + "".join(f',"{field}":%s' for field in RESULT_FIELDS)
+    if cash_flows:
+        # All rows (each cut to its own hold period) in one json.dumps(), split back into rows
+        rows = [row[:years] for row, years in zip(results["cash_flows"].tolist(), results["hold_period"].tolist())]
+        text = json.dumps(rows, separators=(",", ":"))[1:-1]
+        columns.append(text.replace("],[", "]\n[").split("\n") if rows else [])
+        template += ',"cash_flows":%s'
+    template += "}"
+    return {index: template % row for index, row in zip(indices, zip(*columns))}
+
+
+def underwrite_chunk(records, start=0, cash_flows=True, store=None, tags=()):
+    """
+    Validates and underwrites a list of deal records. Returns one JSON line
+    (without the newline) per record, in order; `start` is the index of the
+    first record in the whole request. With a ScenarioStore (see store.py)
+    the deals that were underwritten are saved to it, with `tags`.
+    """
+    base = dict(get_project_inputs(), **OPTIONAL_INPUTS)
+    lines = {}
+    valid_indices, valid_records, deals = [], [], []
+    for offset, record in enumerate(records):
+        try:
+            deals.append(validate_deal(record, base))
+        except ValueError as e:
+            lines[start + offset] = _error_line(start + offset, record, str(e))
+            continue
+        valid_indices.append(start + offset)
+        valid_records.append(record)
+
+    if deals:
+        results = underwrite_batch(to_columns(deals))
+        # Anything the formulas couldn't handle shows up as non-finite results
+        finite = finite_rows(results)
+
+        lines.update(_result_lines(valid_indices, valid_records, results, cash_flows))
+        for row in np.flatnonzero(~finite).tolist():
+            index = valid_indices[row]
+            lines[index] = _error_line(index, valid_records[row], "The model produced non-finite results for these inputs")
+
+        if store is not None and finite.any():
+            store.save_batch([deal for deal, ok in zip(deals, finite.tolist()) if ok],
+                             ResultBatch.from_underwrite(results)[finite], tags)
+
+    return [lines[start + offset] for offset in range(len(records))]
+
+
+def underwrite_lines(records, chunk_size=DEFAULT_CHUNK_SIZE, cash_flows=True, store=None, tags=()):
+    """Yields NDJSON text one chunk at a time (each a block of newline-terminated lines)."""
+    for start in range(0, len(records), chunk_size):
+        with span("bulk_chunk"):
+            lines = underwrite_chunk(records[start:start + chunk_size], start, cash_flows, store, tags)
+        yield "\n".join(lines) + "\n"
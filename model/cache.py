@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Content-addressed result cache.
+
+Underwriting the same inputs twice gives the same numbers, charts and
+reports, so results are cached under a hash of the inputs:
+
+    - input_hash() turns an input dict into a canonical JSON string
+      (sorted keys, no whitespace) and hashes it, so dicts that are equal
+      always get the same key, whatever order their keys were added in
+    - ResultCache is an in-process LRU: the least recently used entries are
+      evicted once there are more than `max_entries` of them or they take
+      more than `max_bytes`, and entries older than `ttl` seconds expire
+    - An optional on-disk tier (a directory of pickles) keeps entries across
+      restarts and between worker processes; memory misses fall back to it
+
+Hit/miss/eviction counters are available from stats() to help size the cache.
+"""
+
+
+def _json_default(value):
+    # NumPy scalars and arrays (e.g. from batch.py) hash like the Python values they hold
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Can't hash input value of type {type(value).__name__}")
+
+
+def canonical_json(inputs):
+    """An input dict as JSON with sorted keys and no whitespace (equal dicts -> equal strings)."""
+    return json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=_json_default)
+
+
+def json_hash(canonical):
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def input_hash(inputs):
+    """Canonical hash of an input dict (same dict contents -> same key)."""
+    return json_hash(canonical_json(inputs))
+
+
+def source_hash(*directories):
+    """
+    Hash of the .py files (and templates) under `directories`: a version for
+    cached artifacts that changes whenever the code that produces them does.
+    """
+    digest = hashlib.sha256()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for name in sorted(files):
+                if name.endswith((".py", ".html")):
+                    digest.update(name.encode("utf-8"))
+                    with open(os.path.join(root, name), "rb") as f:
+                        digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class ResultCache:
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024, ttl=3600, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()  # key -> (stored_at, size, value), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, size, value = entry
+                if self._expired(stored_at):
+                    self._remove(key)
+                    self._counters["expirations"] += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return value
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["disk_hits"] += 1
+            self._store(key, value)
+            return value
+
+    def put(self, key, value):
+        """Caches `value` (anything picklable) under `key`."""
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._store(key, value, len(payload))
+        self._disk_put(key, payload)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+        path = self._disk_path(key)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            stats = dict(self._counters)
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hit_rate": round((self._counters["hits"] + self._counters["disk_hits"]) / lookups, 4) if lookups else 0.0,
+            })
+            return stats
+
+    # Internals (callers hold self._lock)
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def _store(self, key, value, size=None):
+        if size is None:
+            size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic(), size, value)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._counters["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    # On-disk tier
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl") if self.disk_dir else None
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # Removed or half-written by another process: treat as a miss
+            return None
+
+    def _disk_put(self, key, payload):
+        path = self._disk_path(key)
+        if not path:
+            return
+        # Write then rename, so other processes never read a half-written file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
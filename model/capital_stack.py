@@ -1,5 +1,9 @@
 from pprint import pprint
 
+from model.debt import loan_amount
+from model.records import CapitalStack
+from model.utils import rounded
+
 """
 This function is used to construct the financing structure (a.k.a. capital stack)
 for a real estate development project.
@@ -53,56 +57,86 @@ The function above is a simplified version - in real development, you'd also mod
     - Bridge loan proceeds
 """
 
-def build_advanced_capital_stack(inputs, lihtc_equity):
+def size_capital_stack(
+    total_development_cost,
+    lihtc_equity,
+    soft_subsidies,
+    noi_year_1,
+    dscr_required,
+    permanent_loan_rate,
+    permanent_loan_term,
+    construction_period_years=2,
+    max_deferred_dev_fee=500000,
+    loan_payments_per_year=1,
+    full_precision=False
+) -> CapitalStack:
     """
     Enhanced capital stack builder with:
     - DSCR-based loan sizing
     - Interest reserve for loan
-    - Multiple soft subsidy sources
+    - Multiple soft subsidy sources ({source: amount})
     - Deferred developer fee placeholder
+
+    Dollar amounts are rounded to cents unless full_precision (see utils.rounded).
     """
 
     # Aggregate soft subsidies
-    soft_subsidies = sum(inputs.get("soft_subsidies", {}).values())
+    soft_subsidy_total = sum(soft_subsidies.values())
 
     # DSCR-based maximum loan sizing
-    noi = inputs["noi_year_1"]
-    required_dscr = inputs["dscr_required"]
-    annual_debt_service_capacity = noi / required_dscr
-    loan_interest_rate = inputs["permanent_loan_rate"]
-    loan_term_years = inputs["permanent_loan_term"]
+    annual_debt_service_capacity = noi_year_1 / dscr_required
 
     # Use annuity formula to estimate max loan amount based on DSCR
     # Formula: loan = (Debt service * (1 - (1 + r)^-n)) / r
-    r = loan_interest_rate
-    n = loan_term_years
-    loan_limit_by_dscr = annual_debt_service_capacity * ((1 - (1 + r) ** -n) / r)
+    # (see debt.py; payments are annual unless loan_payments_per_year says otherwise)
+    loan_limit_by_dscr = float(loan_amount(annual_debt_service_capacity, permanent_loan_rate, permanent_loan_term,
+                                           loan_payments_per_year))
 
     # Cap loan by 75% LTV as well
-    loan_limit_by_ltv = 0.75 * inputs["total_development_cost"]
+    loan_limit_by_ltv = 0.75 * total_development_cost
     loan = min(loan_limit_by_dscr, loan_limit_by_ltv)
 
     # Interest reserve for construction period (e.g., 2 years)
-    interest_reserve = loan * loan_interest_rate * inputs.get("construction_period_years", 2)
+    interest_reserve = loan * permanent_loan_rate * construction_period_years
 
     # Total sources so far
-    used_sources = lihtc_equity + soft_subsidies + loan
+    used_sources = lihtc_equity + soft_subsidy_total + loan
 
     # Remaining need is filled with developer equity and deferred dev fee (placeholder)
-    funding_gap = inputs["total_development_cost"] + interest_reserve - used_sources
-    deferred_dev_fee = min(funding_gap, inputs.get("max_deferred_dev_fee", 500000))
+    funding_gap = total_development_cost + interest_reserve - used_sources
+    deferred_dev_fee = min(funding_gap, max_deferred_dev_fee)
     equity = funding_gap - deferred_dev_fee
 
-    return {
-        "LIHTC Equity": round(lihtc_equity, 2),
-        "Soft Subsidies": {k: round(v, 2) for k, v in inputs.get("soft_subsidies", {}).items()},
-        "Loan (DSCR & LTV Constrained)": round(loan, 2),
-        "Interest Reserve": round(interest_reserve, 2),
-        "Deferred Developer Fee": round(deferred_dev_fee, 2),
-        "Equity Required": round(equity, 2),
-        "Total Sources": round(used_sources + interest_reserve + deferred_dev_fee + equity, 2),
-        "Total Uses": round(inputs["total_development_cost"] + interest_reserve, 2)
-    }
+    def cents(value):
+        return rounded(value, 2, full_precision)
+
+    return CapitalStack(
+        lihtc_equity=cents(lihtc_equity),
+        soft_subsidies=tuple((k, cents(v)) for k, v in soft_subsidies.items()),
+        loan=cents(loan),
+        interest_reserve=cents(interest_reserve),
+        funding_gap=funding_gap,
+        deferred_dev_fee=cents(deferred_dev_fee),
+        equity_required=cents(equity),
+        total_sources=cents(used_sources + interest_reserve + deferred_dev_fee + equity),
+        total_uses=cents(total_development_cost + interest_reserve)
+    )
+
+def build_advanced_capital_stack(inputs, lihtc_equity, full_precision=False):
+    # Display dict of size_capital_stack() for a get_project_inputs()-style dict (see records.py)
+    return size_capital_stack(
+        total_development_cost=inputs["total_development_cost"],
+        lihtc_equity=lihtc_equity,
+        soft_subsidies=inputs.get("soft_subsidies", {}),
+        noi_year_1=inputs["noi_year_1"],
+        dscr_required=inputs["dscr_required"],
+        permanent_loan_rate=inputs["permanent_loan_rate"],
+        permanent_loan_term=inputs["permanent_loan_term"],
+        construction_period_years=inputs.get("construction_period_years", 2),
+        max_deferred_dev_fee=inputs.get("max_deferred_dev_fee", 500000),
+        loan_payments_per_year=inputs.get("loan_payments_per_year", 1),
+        full_precision=full_precision
+    ).to_dict()
 
 # Example inputs for enhanced capital stack
 inputs_example = {
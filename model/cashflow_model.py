@@ -31,10 +31,14 @@ def project_cash_flows_enhanced(
     hold_period=10,
     exit_cap_rate=0.05,
     selling_cost_percent=0.02,
-    include_sale=True
+    include_sale=True,
+    loan_payoff=0.0,
+    full_precision=False
 ):
     """
     Projects annual cash flows to equity with NOI growth and optional terminal sale value.
+    The loan balance still owed at sale (loan_payoff, see debt.loan_balance) is repaid out of the sale proceeds.
+    Cash flows are rounded to cents unless full_precision (see utils.rounded), which skips the per-year round().
     """
     cash_flows = []
     noi = initial_noi
@@ -48,9 +52,9 @@ def project_cash_flows_enhanced(
         final_noi = noi / (1 + noi_growth_rate)  # Adjust back one year
         terminal_value = final_noi / exit_cap_rate
         net_sale_proceeds = terminal_value * (1 - selling_cost_percent)
-        cash_flows[-1] += net_sale_proceeds
+        cash_flows[-1] += net_sale_proceeds - loan_payoff
 
-    return [round(cf, 2) for cf in cash_flows]
+    return cash_flows if full_precision else [round(cf, 2) for cf in cash_flows]
 
 # Example usage with enhancements
 cash_flows = project_cash_flows_enhanced(
@@ -1,49 +1,79 @@
 """
-Matpoltlib's default backend on macOS is often set to MacOSX,
-which tries to use GUI-based rendering (NSWindow) -- not
-allowed in a background web server process.
+Charts are drawn with matplotlib's object-oriented API: each chart gets its
+own Figure attached to a non-interactive Agg canvas, instead of going through
+pyplot's global "current figure" state machine. That has two benefits:
+    - It's safe to render charts from several threads at once (pyplot isn't)
+    - No GUI backend is ever loaded (pyplot on macOS defaults to "MacOSX",
+      which isn't allowed in a background web server process)
 
-To avoid a chart rendering issue, we'll set the backend manually
-to a non-interactive, file-based backend called "Agg" (commonly
-used for server-side plotting).
+ChartRenderer runs chart rendering in a small pool of worker threads, so a
+web request can hand the charts off and return the results page right away.
+Chart files are named after a hash of the data they show, so a chart whose
+data hasn't changed is already on disk and is never rendered twice, and two
+users with different deals never overwrite each other's images.
+
+Because every new deal adds files, the renderer prunes the directory every
+PRUNE_EVERY renders: charts older than `max_age` seconds go, then the least
+recently used beyond the newest `keep` (reusing a chart refreshes its mtime).
+Charts still rendering are never pruned, and a pruned chart is simply
+rendered again the next time a page asks for it.
 """
-import matplotlib
-matplotlib.use("Agg")
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
 import numpy as np
-import os
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from model.buffers import ResultBuffer
+from model.metrics import span
+
+CHART_FORMATS = ("png", "svg")
+
+# Renders between prunes of the chart directory
+PRUNE_EVERY = 50
+
+def _new_figure():
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+def _save(fig, save_path):
+    # The format comes from the file extension (.png or .svg)
+    fig.tight_layout()
+    fig.savefig(save_path)
 
 def plot_cash_flows(cash_flows, save_path):
     years = np.arange(1, len(cash_flows) + 1)
-    plt.figure()
-    plt.bar(years, cash_flows, color='skyblue')
-    plt.title("Annual Cash Flows to Equity")
-    plt.xlabel("Year")
-    plt.ylabel("Cash Flow ($)")
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.bar(years, cash_flows, color='skyblue')
+    ax.set_title("Annual Cash Flows to Equity")
+    ax.set_xlabel("Year")
+    ax.set_ylabel("Cash Flow ($)")
+    ax.grid(True)
+    _save(fig, save_path)
 
 def plot_irr_curve(cash_flows, equity_investment, save_path):
     discount_rates = np.linspace(0.01, 0.3, 100)
-    npvs = []
-
-    for r in discount_rates:
-        npv = -equity_investment + sum(cf / (1 + r) ** i for i, cf in enumerate(cash_flows, 1))
-        npvs.append(npv)
-
-    plt.figure()
-    plt.plot(discount_rates * 100, npvs)
-    plt.axhline(0, color='red', linestyle='--')
-    plt.title("IRR Sensitivity Curve")
-    plt.xlabel("Discount Rate (%)")
-    plt.ylabel("Net Present Value ($)")
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
+    years = np.arange(1, len(cash_flows) + 1)
+
+    # NPV at every discount rate at once: rates down the rows, years across the columns
+    npvs = -equity_investment + (np.asarray(cash_flows, dtype=float) / (1 + discount_rates[:, None]) ** years).sum(axis=1)
+
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.plot(discount_rates * 100, npvs)
+    ax.axhline(0, color='red', linestyle='--')
+    ax.set_title("IRR Sensitivity Curve")
+    ax.set_xlabel("Discount Rate (%)")
+    ax.set_ylabel("Net Present Value ($)")
+    ax.grid(True)
+    _save(fig, save_path)
 
 def plot_capital_stack(capital_stack, save_path):
     labels = []
@@ -60,10 +90,168 @@ def plot_capital_stack(capital_stack, save_path):
                 if isinstance(val, (int, float)) and val > 0:
                     sum += val
             values.append(sum)
-    
-    plt.figure()
-    plt.pie(values, labels=labels, autopct='%1.1f%%', startangle=140)
-    plt.title("Capital Stack Distribution")
-    plt.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
\ No newline at end of file
+
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=140)
+    ax.set_title("Capital Stack Distribution")
+    _save(fig, save_path)
+
+def plot_irr_distribution(buffer_spec, save_path):
+    # Reads the IRRs straight from a ResultBuffer (see buffers.py): the chart's argument is the
+    # buffer's spec, not millions of values, and the histogram runs on the shared pages
+    buffer = ResultBuffer.attach(buffer_spec, readonly=True)
+    try:
+        irr = buffer["irr"]
+        solved = irr[np.isfinite(irr)]
+        counts, edges = np.histogram(solved, bins=100) if solved.size else (np.zeros(0), np.zeros(1))
+        del irr, solved
+    finally:
+        buffer.close()
+
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='skyblue')
+    ax.set_title(f"IRR Distribution ({len(buffer):,} Draws)")
+    ax.set_xlabel("IRR (%)")
+    ax.set_ylabel("Draws")
+    ax.grid(True)
+    _save(fig, save_path)
+
+def warm_up():
+    """
+    Loads matplotlib's font cache and renderers ahead of the first real chart
+    (the first chart in a fresh process otherwise pays for it).
+    Meant to run once before a server forks its workers.
+    """
+    from matplotlib import font_manager
+    import matplotlib.backends.backend_svg  # noqa: F401
+
+    font_manager.findfont("DejaVu Sans")
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.set_title("Warm Up")
+    ax.bar([1, 2], [1, 2])
+    fig.canvas.draw()
+
+CHART_FUNCTIONS = {
+    "cash_flows": plot_cash_flows,
+    "irr_curve": plot_irr_curve,
+    "capital_stack": plot_capital_stack,
+    "irr_distribution": plot_irr_distribution,
+}
+
+def chart_filename(kind, args, fmt="png"):
+    """Content-hashed file name: the same chart of the same data always gets the same name."""
+    payload = json.dumps([kind, args], sort_keys=True, default=float)
+    return f"{kind}_{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]}.{fmt}"
+
+def prune_charts(chart_dir, keep=None, max_age=None, skip=()):
+    """
+    Deletes chart files older than `max_age` seconds, then all but the `keep`
+    most recently written or reused. File names in `skip`, and temporary
+    files of renders in progress, are left alone. Returns how many were deleted.
+    """
+    if not os.path.isdir(chart_dir):
+        return 0
+    charts = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(chart_dir)
+              if entry.is_file() and entry.name not in skip and ".tmp." not in entry.name]
+    charts.sort(reverse=True)
+    if max_age is not None:
+        cutoff = time.time() - max_age
+        doomed = [path for mtime, path in charts if mtime < cutoff]
+        charts = [(mtime, path) for mtime, path in charts if mtime >= cutoff]
+    else:
+        doomed = []
+    if keep is not None:
+        doomed += [path for _, path in charts[keep:]]
+
+    removed = 0
+    for path in doomed:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+class ChartRenderer:
+    """
+    Renders charts into `chart_dir` on a pool of worker threads.
+
+    submit() returns the chart's file name immediately; wait() blocks until
+    that file has been written (or returns at once if it already exists).
+    `keep` and `max_age` bound the directory (see prune_charts()); None
+    means no limit.
+    """
+
+    def __init__(self, chart_dir, max_workers=2, keep=None, max_age=None):
+        self.chart_dir = chart_dir
+        self.keep = keep
+        self.max_age = max_age
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chart-render")
+        self._pending = {}
+        self._renders = 0
+        self._lock = threading.Lock()
+        os.makedirs(chart_dir, exist_ok=True)
+        self.prune()
+
+    def prune(self):
+        """Prunes the chart directory to `keep` files and `max_age` seconds, sparing charts being rendered."""
+        if self.keep is None and self.max_age is None:
+            return 0
+        with self._lock:
+            skip = set(self._pending)
+        return prune_charts(self.chart_dir, self.keep, self.max_age, skip)
+
+    def submit(self, kind, *args, fmt="png"):
+        if fmt not in CHART_FORMATS:
+            raise ValueError(f"Unsupported chart format: {fmt}")
+        filename = chart_filename(kind, args, fmt)
+        path = os.path.join(self.chart_dir, filename)
+
+        with self._lock:
+            if filename in self._pending:
+                return filename
+            try:
+                # Reused: mark it recently used, so pruning keeps it
+                os.utime(path)
+                return filename
+            except FileNotFoundError:
+                pass
+            self._pending[filename] = self._pool.submit(self._render, kind, args, path, filename)
+        return filename
+
+    def wait(self, filename, timeout=None):
+        """
+        Waits for a submitted chart. Returns False if the chart is unknown.
+        Raises the render's exception if it failed, or
+        concurrent.futures.TimeoutError if it isn't done within `timeout`.
+        """
+        with self._lock:
+            future = self._pending.get(filename)
+        if future is not None:
+            future.result(timeout=timeout)
+        return os.path.exists(os.path.join(self.chart_dir, filename))
+
+    def _render(self, kind, args, path, filename):
+        # Write to a temporary file and rename, so a half-written chart is never served
+        # (the temporary name keeps the extension, which picks the file format)
+        root, ext = os.path.splitext(path)
+        tmp_path = f"{root}.{threading.get_ident()}.tmp{ext}"
+        try:
+            with span(f"chart_{kind}"):
+                CHART_FUNCTIONS[kind](*args, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            # (only still there if the render or the rename failed)
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._pending.pop(filename, None)
+                self._renders += 1
+                prune_now = self._renders % PRUNE_EVERY == 0
+        if prune_now:
+            self.prune()
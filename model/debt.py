@@ -0,0 +1,155 @@
+import numpy as np
+
+"""
+Permanent loan amortization.
+
+The loan is sized with an annuity formula in capital_stack.py, so its debt
+service is the level annuity payment (principal and interest), not just the
+interest. This module has the pieces the rest of the model needs:
+
+    - annuity_factor(): present value of 1 per period, the link between a
+      payment and the loan it supports
+    - annual_debt_service(): the payments on a loan over one year
+    - loan_balance(): the balance still owed after a number of years, e.g.
+      the balloon paid off out of sale proceeds at the end of the hold period
+    - amortization_schedule(): full payment / interest / principal / balance
+      schedules, monthly or annual, for many loans at once
+
+Everything takes scalars or arrays (one element per loan) and is computed
+in closed form, so a balance at exit for 1,000,000 loans is a handful of
+array operations, and a 360-month schedule for N loans is one N x 360
+array per column. Payments are made `periods_per_year` times a year
+(1 = annual, 12 = monthly) at the annual rate divided by that.
+
+A 0% loan (common for soft funding) amortizes in equal principal payments.
+"""
+
+
+def _periodic(annual_rate, term_years, periods_per_year):
+    rate = np.asarray(annual_rate, dtype=float) / periods_per_year
+    periods = np.asarray(term_years, dtype=float) * periods_per_year
+    return rate, periods
+
+
+def annuity_factor(annual_rate, term_years, periods_per_year=1):
+    """Present value of a payment of 1 per period: loan = payment per period * annuity_factor."""
+    rate, periods = _periodic(annual_rate, term_years, periods_per_year)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(rate == 0, periods, (1 - (1 + rate) ** -periods) / rate)
+
+
+def loan_amount(annual_payment, annual_rate, term_years, periods_per_year=1):
+    """The loan that `annual_payment` a year (paid in periods_per_year instalments) fully amortizes."""
+    return np.divide(annual_payment, periods_per_year) * annuity_factor(annual_rate, term_years, periods_per_year)
+
+
+def periodic_payment(principal, annual_rate, term_years, periods_per_year=1):
+    """The level payment per period (principal and interest)."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.divide(principal, annuity_factor(annual_rate, term_years, periods_per_year))
+
+
+def annual_debt_service(principal, annual_rate, term_years, periods_per_year=1):
+    """Total payments on the loan over one year."""
+    return periodic_payment(principal, annual_rate, term_years, periods_per_year) * periods_per_year
+
+
+def loan_balance(principal, annual_rate, term_years, years_elapsed, periods_per_year=1):
+    """
+    Balance still owed after `years_elapsed` years of payments
+    (zero once the loan is paid off). At the end of the hold period this
+    is the balloon payoff due on sale.
+    """
+    rate, periods = _periodic(annual_rate, term_years, periods_per_year)
+    elapsed = np.minimum(np.asarray(years_elapsed, dtype=float) * periods_per_year, periods)
+    principal = np.asarray(principal, dtype=float)
+    payment = periodic_payment(principal, annual_rate, term_years, periods_per_year)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        growth = (1 + rate) ** elapsed
+        balance = np.where(rate == 0, principal - payment * elapsed, principal * growth - payment * (growth - 1) / rate)
+    # Paid off (and floating point dust from the closed form) is zero
+    return np.where(elapsed >= periods, 0.0, np.maximum(balance, 0.0))
+
+
+def amortization_schedule(principal, annual_rate, term_years, periods_per_year=12, periods=None):
+    """
+    Amortization schedules for one or many loans.
+
+    Returns a dict of N x P arrays ("payment", "interest", "principal" and
+    the ending "balance" of each period), where P is `periods` or the
+    longest loan's term in periods. Periods after a loan is paid off are zero.
+    For a single scalar loan the arrays are 1 x P.
+    """
+    principal = np.atleast_1d(np.asarray(principal, dtype=float))
+    rate, term_periods = _periodic(annual_rate, term_years, periods_per_year)
+    n = max(principal.size, np.size(rate), np.size(term_periods))
+    principal = np.broadcast_to(principal, (n,))
+    rate = np.broadcast_to(rate, (n,))
+    term_periods = np.broadcast_to(np.round(term_periods), (n,))
+    if periods is None:
+        periods = int(term_periods.max()) if n else 0
+
+    payment = np.broadcast_to(periodic_payment(principal, annual_rate, term_years, periods_per_year), (n,))
+
+    # Balance after k payments, k = 0..periods, for every loan at once
+    k = np.arange(periods + 1, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        growth = (1 + rate[:, None]) ** k
+        balances = np.where(
+            rate[:, None] == 0,
+            principal[:, None] - payment[:, None] * k,
+            principal[:, None] * growth - payment[:, None] * (growth - 1) / rate[:, None]
+        )
+    active = k[1:] <= term_periods[:, None]
+    balances[:, 1:] = np.where(k[1:] >= term_periods[:, None], 0.0, np.maximum(balances[:, 1:], 0.0))
+
+    interest = np.where(active, balances[:, :-1] * rate[:, None], 0.0)
+    payments = np.where(active, payment[:, None], 0.0)
+    # Principal paid is the drop in balance, so the last payment retires exactly what is left
+    principal_paid = np.where(active, balances[:, :-1] - balances[:, 1:], 0.0)
+
+    return {
+        "payment": payments,
+        "interest": interest,
+        "principal": principal_paid,
+        "balance": balances[:, 1:],
+    }
+
+
+def annual_schedule(schedule, periods_per_year=12):
+    """
+    Rolls a monthly (or other) schedule up to years: total payment, interest
+    and principal per year and the balance at each year end.
+    """
+    n, periods = schedule["payment"].shape
+    years = -(-periods // periods_per_year)
+    pad = years * periods_per_year - periods
+
+    def by_year(values):
+        return np.pad(values, ((0, 0), (0, pad))).reshape(n, years, periods_per_year)
+
+    balance = np.pad(schedule["balance"], ((0, 0), (0, pad)), mode="edge") if pad else schedule["balance"]
+    return {
+        "payment": by_year(schedule["payment"]).sum(axis=2),
+        "interest": by_year(schedule["interest"]).sum(axis=2),
+        "principal": by_year(schedule["principal"]).sum(axis=2),
+        "balance": balance.reshape(n, years, periods_per_year)[:, :, -1],
+    }
+
+
+def permanent_loan_payments(inputs, loan):
+    """
+    Annual debt service and the payoff due at sale (after hold_period years)
+    for the permanent loan of a get_project_inputs()-style deal.
+    """
+    args = (loan, inputs["permanent_loan_rate"], inputs["permanent_loan_term"])
+    periods_per_year = inputs.get("loan_payments_per_year", 1)
+    debt_service = float(annual_debt_service(*args, periods_per_year))
+    payoff = float(loan_balance(*args, inputs["hold_period"], periods_per_year))
+    return debt_service, payoff
+
+
+# Example: monthly schedule of a $8M, 5%, 30-year loan and its balance after a 10-year hold
+# schedule = amortization_schedule(8_000_000, 0.05, 30, periods_per_year=12)
+# print(schedule["balance"][0, 119], loan_balance(8_000_000, 0.05, 30, 10, periods_per_year=12))
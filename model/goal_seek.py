@@ -0,0 +1,190 @@
+import numpy as np
+
+from model.batch import batch_size, get_input, set_input, to_columns, underwrite_batch
+
+"""
+Goal seek: solve for the one input that makes an output hit a target.
+
+Examples:
+    - What credit pricing closes the gap (no developer equity required)?
+    - How much soft subsidy do we need from HOME?
+    - What eligible basis gets us to a 12% equity IRR?
+
+Two methods:
+    1. Analytic: calculate_lihtc_equity_extended() is linear in pricing,
+       eligible_basis, applicable_fraction and credit_rate, and soft
+       subsidies add straight into the sources. When solving one of those
+       inputs for a funding gap target, the answer is one division.
+    2. Bracketed: everything else is solved with the Illinois method
+       (regula falsi that halves the stale end point so it can't stall),
+       keeping a bracket [low, high] where the output crosses the target.
+
+Both run on whole portfolios at once: every deal is a row in one
+underwrite_batch() call per iteration, so a portfolio-wide
+"required pricing" column takes milliseconds.
+"""
+
+# Outputs of underwrite_batch() that can be targeted
+GOAL_SEEK_TARGETS = ("irr", "dscr", "equity_required", "funding_gap", "loan", "deferred_dev_fee")
+
+# Inputs that net LIHTC equity is directly proportional to
+LINEAR_LIHTC_INPUTS = ("pricing", "eligible_basis", "applicable_fraction", "credit_rate")
+
+
+def _target_funding_gap(columns, target, value, n):
+    # Funding gap (before deferred fee) that gives the target equity or gap
+    if target == "funding_gap":
+        return np.broadcast_to(np.asarray(value, dtype=float), (n,))
+    # The gap is covered by deferred fee first, so no equity means a gap equal to the max deferred fee
+    max_fee = np.broadcast_to(np.asarray(columns.get("max_deferred_dev_fee", 500000), dtype=float), (n,))
+    return max_fee + np.maximum(np.asarray(value, dtype=float), 0.0)
+
+
+def _solve_analytic(columns, solve_for, target, value):
+    n = batch_size(columns)
+    base = underwrite_batch(columns)
+    required_gap = _target_funding_gap(columns, target, value, n)
+
+    # funding_gap = total cost + interest reserve - LIHTC equity - soft subsidies - loan
+    # none of the loan, reserve or costs depend on LIHTC inputs or soft subsidies
+    shortfall = base["funding_gap"] - required_gap
+    current = np.broadcast_to(np.asarray(get_input(columns, solve_for), dtype=float), (n,))
+
+    if solve_for.startswith("soft_subsidies."):
+        return current + shortfall
+
+    # Net equity is proportional to the input: equity(x) = (net equity / current x) * x
+    with np.errstate(divide="ignore", invalid="ignore"):
+        equity_per_unit = base["net_equity"] / current
+        return (base["net_equity"] + shortfall) / equity_per_unit
+
+
+def _evaluate(columns, solve_for, x, target):
+    trial = dict(columns)
+    set_input(trial, solve_for, x)
+    return underwrite_batch(trial)[target]
+
+
+def _solve_bracketed(columns, solve_for, target, value, low, high, xtol, max_iter):
+    n = batch_size(columns)
+    value = np.broadcast_to(np.asarray(value, dtype=float), (n,))
+    a = np.array(np.broadcast_to(np.asarray(low, dtype=float), (n,)))
+    b = np.array(np.broadcast_to(np.asarray(high, dtype=float), (n,)))
+
+    f_a = _evaluate(columns, solve_for, a, target) - value
+    f_b = _evaluate(columns, solve_for, b, target) - value
+
+    # Some outputs are undefined over part of the range (e.g. IRR is NaN once no
+    # equity is required). Bisect between the defined end and the undefined one
+    # until the undefined end is replaced by a point past the target.
+    for _ in range(max_iter):
+        undefined_a = ~np.isfinite(f_a) & np.isfinite(f_b)
+        undefined_b = ~np.isfinite(f_b) & np.isfinite(f_a)
+        pulling = undefined_a | undefined_b
+        if not pulling.any():
+            break
+        m = (a + b) / 2
+        f_m = _evaluate(columns, solve_for, np.where(pulling, m, a), target) - value
+        defined = np.isfinite(f_m)
+        # Undefined midpoint: it becomes the new undefined end
+        a = np.where(undefined_a & ~defined, m, a)
+        b = np.where(undefined_b & ~defined, m, b)
+        # Defined midpoint on the same side as the defined end: move the defined end
+        same_as_b = undefined_a & defined & (np.sign(f_m) == np.sign(f_b))
+        same_as_a = undefined_b & defined & (np.sign(f_m) == np.sign(f_a))
+        # Defined midpoint past the target: it replaces the undefined end
+        a, f_a = np.where(undefined_a & defined & ~same_as_b, m, a), np.where(undefined_a & defined & ~same_as_b, f_m, f_a)
+        b, f_b = np.where(undefined_b & defined & ~same_as_a, m, b), np.where(undefined_b & defined & ~same_as_a, f_m, f_b)
+        b, f_b = np.where(same_as_b, m, b), np.where(same_as_b, f_m, f_b)
+        a, f_a = np.where(same_as_a, m, a), np.where(same_as_a, f_m, f_a)
+
+    solution = np.full(n, np.nan)
+    converged = np.zeros(n, dtype=bool)
+    iterations = np.zeros(n, dtype=int)
+
+    solution[f_a == 0], converged[f_a == 0] = a[f_a == 0], True
+    solution[f_b == 0], converged[f_b == 0] = b[f_b == 0], True
+    active = ~converged & (np.sign(f_a) * np.sign(f_b) < 0)
+
+    side = np.zeros(n, dtype=int)  # which end was kept last time (for the Illinois halving)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        iterations[active] += 1
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = (a * f_b - b * f_a) / (f_b - f_a)
+        x = np.where(np.isfinite(x) & (x > np.minimum(a, b)) & (x < np.maximum(a, b)), x, (a + b) / 2)
+        # Rows that are done just re-evaluate their own end point
+        x = np.where(active, x, a)
+
+        f_x = _evaluate(columns, solve_for, x, target) - value
+
+        hit = active & (f_x == 0)
+        replace_b = active & ~hit & (np.sign(f_x) == np.sign(f_b))
+        replace_a = active & ~hit & ~replace_b & np.isfinite(f_x)
+
+        # Illinois step: if the same end survives twice, halve its function value
+        f_a = np.where(replace_b & (side == -1), f_a / 2, f_a)
+        f_b = np.where(replace_a & (side == 1), f_b / 2, f_b)
+        b, f_b = np.where(replace_b, x, b), np.where(replace_b, f_x, f_b)
+        a, f_a = np.where(replace_a, x, a), np.where(replace_a, f_x, f_a)
+        side = np.where(replace_b, -1, np.where(replace_a, 1, side))
+
+        # Rows that hit a NaN output (e.g. IRR with no equity) stop without a solution
+        failed = active & ~hit & ~np.isfinite(f_x)
+        active &= ~failed
+
+        done = hit | (active & (np.abs(b - a) <= xtol * (1 + np.abs(x))))
+        solution[done] = x[done]
+        converged |= done
+        active &= ~done
+
+    return solution, converged, iterations
+
+
+def goal_seek_batch(columns, solve_for, target, value, low=None, high=None, xtol=1e-10, max_iter=100):
+    """
+    Solves `solve_for` (an input key, or "soft_subsidies.NAME") so that
+    `target` (one of GOAL_SEEK_TARGETS) equals `value`, for every deal in
+    `columns` (see batch.underwrite_batch) at once.
+
+    low/high bound the search for the bracketed method (scalars or one per deal).
+    Linear cases ("equity_required"/"funding_gap" targets solved for pricing,
+    basis, applicable fraction, credit rate or a soft subsidy) are solved
+    analytically and don't need bounds.
+
+    Returns a dict of arrays: "solution" (NaN where no solution was found in
+    the bracket), "converged", "iterations", plus the "method" used.
+    """
+    if target not in GOAL_SEEK_TARGETS:
+        raise ValueError(f"Unknown goal seek target: {target}")
+    n = batch_size(columns)
+
+    linear = solve_for in LINEAR_LIHTC_INPUTS or solve_for.startswith("soft_subsidies.")
+    if linear and target in ("equity_required", "funding_gap"):
+        solution = _solve_analytic(columns, solve_for, target, value)
+        return {
+            "solution": solution,
+            "converged": np.isfinite(solution),
+            "iterations": np.zeros(n, dtype=int),
+            "method": "analytic",
+        }
+
+    if low is None or high is None:
+        raise ValueError(f"low and high bounds are required to solve {solve_for} for {target}")
+    solution, converged, iterations = _solve_bracketed(columns, solve_for, target, value, low, high, xtol, max_iter)
+    return {"solution": solution, "converged": converged, "iterations": iterations, "method": "bracketed"}
+
+
+def goal_seek(inputs, solve_for, target, value, low=None, high=None):
+    """
+    Single-deal goal seek on a get_project_inputs()-style dict.
+    Returns the solved input value (NaN if there is no solution between low and high).
+    """
+    return float(goal_seek_batch(to_columns([inputs]), solve_for, target, value, low, high)["solution"][0])
+
+
+# Example: what pricing closes the gap with no developer equity?
+# from inputs import get_project_inputs
+# print(goal_seek(get_project_inputs(), "pricing", "equity_required", 0))
@@ -1,3 +1,6 @@
+import math
+
+
 def get_project_inputs():
     return {
         # Project Cost Structure
@@ -41,6 +44,138 @@ def get_project_inputs():
     }
 
 
+def get_simulation_distributions():
+    # Uncertain inputs for the Monte Carlo simulation (see simulation.py for the distribution types)
+    return {
+        "noi_growth_rate": {"type": "normal", "mean": 0.02, "std": 0.01},
+        "exit_cap_rate": {"type": "triangular", "low": 0.045, "mode": 0.05, "high": 0.065},
+        "pricing": {"type": "uniform", "low": 0.85, "high": 0.95},
+        "permanent_loan_rate": {"type": "normal", "mean": 0.05, "std": 0.005, "min": 0.01},
+        "construction_period_years": {"type": "choice", "values": [1.5, 2, 2.5, 3], "weights": [0.2, 0.5, 0.2, 0.1]},
+    }
+
+
+def get_sensitivity_ranges():
+    # (low, high) ranges for the two-way sensitivity tables (see sensitivity.py)
+    return {
+        "exit_cap_rate": (0.04, 0.07),
+        "noi_growth_rate": (0.0, 0.04),
+        "pricing": (0.80, 1.00),
+        "permanent_loan_rate": (0.03, 0.07),
+    }
+
+
+def get_investor_assumptions():
+    # Tax credit investor assumptions for the 15-year compliance period waterfall (see investor.py)
+    return {
+        "placed_in_service_month": 7,  # month of year 1 the building is placed in service (1 = January)
+        "investor_share": 0.9999,  # investor's share of credits and tax losses
+        "cash_flow_share": 0.9999,  # investor's share of operating cash flow distributions
+        "tax_rate": 0.21,  # investor's marginal tax rate (corporate)
+        "depreciation_years": 27.5,  # residential rental property, straight line, mid-month convention
+        "depreciable_basis_percent": 1.0,  # depreciable basis as a share of eligible basis
+        "pay_in_schedule": ((0, 0.25), (1, 0.50), (2, 0.25)),  # (year, share of equity): closing, completion, stabilization
+        "exit_price": 0.0,  # paid to the investor for its interest at the end of year 15
+    }
+
+
+"""
+Input validation, shared by everything that takes deals from outside:
+the JSON API (bulk.py), the portfolio CLI (portfolio.py) and the app's
+what-if route. validate_deal() checks the keys, types and the ranges the
+formulas need (e.g. a zero exit cap rate divides by zero); parse_input()
+turns a text value (a CSV cell) into the type validate_deal() expects.
+"""
+
+# Inputs that aren't in get_project_inputs() but may be given (see debt.py)
+OPTIONAL_INPUTS = {"loan_payments_per_year": 1}
+
+BOOLEAN_INPUTS = ("include_syndication_fee", "use_bridge_loan")
+TEXT_INPUTS = ("credit_type",)
+INTEGER_INPUTS = ("hold_period", "loan_payments_per_year")
+
+# Inputs that have to be above zero for the model's formulas to work
+POSITIVE_INPUTS = frozenset(("exit_cap_rate", "permanent_loan_term", "dscr_required", "hold_period", "loan_payments_per_year"))
+# Inputs that can't be negative
+NON_NEGATIVE_INPUTS = frozenset(("permanent_loan_rate", "noi_year_1", "total_development_cost", "eligible_basis",
+                                 "construction_period_years", "bridge_loan_term_years", "max_deferred_dev_fee"))
+
+
+class InvalidDeal(ValueError):
+    """A deal that failed validate_deal(); `errors` maps each bad input to what's wrong with it."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors.values()))
+        self.errors = errors
+
+
+def input_keys():
+    return list(get_project_inputs()) + list(OPTIONAL_INPUTS)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def parse_input(key, text):
+    """A text value (e.g. a CSV cell) as the input's type. Values that aren't strings are returned as they are."""
+    if not isinstance(text, str) or key in TEXT_INPUTS:
+        return text
+    if key in BOOLEAN_INPUTS:
+        return text.strip().lower() in ("1", "true", "yes", "y")
+    try:
+        return float(text)
+    except ValueError:
+        raise InvalidDeal({key: f"{key} must be a number"})
+
+
+def validate_deal(record, base=None):
+    """
+    Checks one deal (a dict keyed like get_project_inputs(), plus an optional
+    "deal_id") and returns the full deal with defaults filled in (`base`,
+    default get_project_inputs() plus OPTIONAL_INPUTS).
+    Raises InvalidDeal (a ValueError) listing every problem found.
+    """
+    if not isinstance(record, dict):
+        raise InvalidDeal({"deal": "A deal must be a JSON object"})
+    base = base if base is not None else dict(get_project_inputs(), **OPTIONAL_INPUTS)
+
+    errors = {}
+    deal = dict(base)
+    # Only the inputs the deal gives need checking; the defaults are known to be good
+    for key, value in record.items():
+        if key == "deal_id":
+            continue
+        if key not in base:
+            errors[key] = f"unknown input: {key}"
+        elif key == "soft_subsidies":
+            if not isinstance(value, dict) or not all(_is_number(amount) and amount >= 0 for amount in value.values()):
+                errors[key] = "soft_subsidies must be an object of non-negative amounts"
+            deal[key] = value
+        elif key in TEXT_INPUTS:
+            if not isinstance(value, str):
+                errors[key] = f"{key} must be a string"
+            deal[key] = value
+        elif key in BOOLEAN_INPUTS:
+            if not isinstance(value, bool):
+                errors[key] = f"{key} must be true or false"
+            deal[key] = value
+        elif not _is_number(value):
+            errors[key] = f"{key} must be a finite number"
+        elif key in INTEGER_INPUTS and value != int(value):
+            errors[key] = f"{key} must be a whole number"
+        elif key in POSITIVE_INPUTS and value <= 0:
+            errors[key] = f"{key} must be greater than 0"
+        elif key in NON_NEGATIVE_INPUTS and value < 0:
+            errors[key] = f"{key} can't be negative"
+        else:
+            deal[key] = int(value) if key in INTEGER_INPUTS else value
+
+    if errors:
+        raise InvalidDeal(errors)
+    return deal
+
+
 """
 total_development_costs (Total cost to complete the project):
 Includes:
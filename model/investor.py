@@ -0,0 +1,223 @@
+import numpy as np
+
+from model.batch import batch_size, input_column, to_columns, underwrite_batch
+from model.debt import loan_balance
+from model.inputs import get_investor_assumptions, get_project_inputs
+from model.utils import IRR_STATUS_MESSAGES, solve_irr_batch
+
+"""
+Tax credit investor waterfall over the 15-year compliance period.
+
+lihtc_calculator.py prices the credits as one lump ("Total Credits
+(10 years)" x pricing). The investor buying them sees a stream of benefits
+instead, year by year:
+
+    Year 0 .. 2   Equity pay-ins (by default 25% at closing, 50% at
+                  completion, 25% at stabilization, like the disbursement
+                  schedule), the gross equity: pricing x total credits
+    Year 1        First-year credit proration: the building is in service
+                  for only part of the year, so year 1 gets
+                  (13 - placed_in_service_month) / 12 of a year's credits...
+    Year 11       ...and the shortfall is delivered in year 11. The total
+                  is still 10 years of credits
+    Years 1 .. 15 Depreciation (straight line over 27.5 years, mid-month
+                  convention in year 1), mortgage interest and NOI make up
+                  the taxable income or loss; a loss saves the investor
+                  tax at `tax_rate`, income costs it
+                  Cash flow after debt service is distributed by
+                  `cash_flow_share` (only when positive)
+    Year 15       The investor exits for `exit_price` (usually nominal)
+
+The investor takes `investor_share` (typically 99.99%) of the credits and
+tax losses. Its after-tax IRR is the IRR of pay-ins against credits, tax
+benefits, distributions and the exit.
+
+Everything is an N x 16 array (years 0..15, one row per deal), so a
+portfolio of thousands of deals is priced with a few dozen array
+operations; the IRRs come from solve_irr_batch. Any assumption can be
+given per deal as a column (e.g. columns["tax_rate"] = array).
+
+Not modelled: capital account limits on losses, credit recapture, and
+adjusters for late or short credit delivery.
+"""
+
+COMPLIANCE_PERIOD = 15
+CREDIT_PERIOD = 10
+
+# Per-year N x (COMPLIANCE_PERIOD + 1) arrays returned by investor_waterfall_batch()
+SCHEDULES = (
+    "pay_in",
+    "credits",
+    "depreciation",
+    "interest",
+    "noi",
+    "taxable_income",
+    "tax_benefit",
+    "distributions",
+    "after_tax_cash_flows",
+)
+
+
+def first_year_fraction(placed_in_service_month):
+    """Share of a full year's credits delivered in year 1 (the rest comes in year 11)."""
+    month = np.clip(np.asarray(placed_in_service_month, dtype=float), 1, 12)
+    return (13 - month) / 12
+
+
+def credit_schedule(annual_credit, placed_in_service_month, years=COMPLIANCE_PERIOD):
+    """
+    Credits delivered in each of years 0..years (N x years + 1): a prorated
+    year 1, full years 2..10 and the year 1 shortfall in year 11.
+    """
+    annual_credit = np.atleast_1d(np.asarray(annual_credit, dtype=float))
+    fraction = np.broadcast_to(first_year_fraction(placed_in_service_month), annual_credit.shape)
+    year = np.arange(years + 1)
+    full_years = ((year >= 2) & (year <= CREDIT_PERIOD)).astype(float)
+
+    credits = annual_credit[:, None] * full_years
+    credits[:, 1] = annual_credit * fraction
+    if years > CREDIT_PERIOD:
+        credits[:, CREDIT_PERIOD + 1] = annual_credit * (1 - fraction)
+    return credits
+
+
+def depreciation_schedule(depreciable_basis, placed_in_service_month, recovery_years=27.5, years=COMPLIANCE_PERIOD):
+    """
+    Straight-line depreciation for years 0..years (N x years + 1), with the
+    mid-month convention in year 1 (half a month for the month placed in service).
+    """
+    basis = np.atleast_1d(np.asarray(depreciable_basis, dtype=float))
+    month = np.broadcast_to(np.clip(np.asarray(placed_in_service_month, dtype=float), 1, 12), basis.shape)
+    annual = basis / np.broadcast_to(np.asarray(recovery_years, dtype=float), basis.shape)
+
+    # Cumulative depreciation at the end of each year, capped at the basis
+    year = np.arange(years + 1)
+    first_year = (12 - month + 0.5) / 12
+    elapsed = np.where(year == 0, 0.0, first_year[:, None] + (year - 1))
+    cumulative = np.minimum(annual[:, None] * elapsed, basis[:, None])
+    depreciation = np.diff(cumulative, axis=1, prepend=0.0)
+    return depreciation
+
+
+def investor_waterfall_batch(columns, results=None, assumptions=None):
+    """
+    The investor waterfall for every deal in `columns` (keyed like
+    get_project_inputs(), scalars or one-element-per-deal arrays, see batch.py).
+
+    `results` are the deals' underwrite_batch() results (computed if not given).
+    `assumptions` override get_investor_assumptions(); a column of the same
+    name overrides both for each deal.
+
+    Returns a dict with the SCHEDULES as N x 16 arrays (years 0..15) and
+    per-deal totals: investor_equity, total_credits, total_tax_benefit,
+    total_distributions, after_tax_irr (percent), irr_status and
+    benefit_per_equity (all benefits per $1 paid in).
+    """
+    settings = get_investor_assumptions()
+    settings.update(assumptions or {})
+    if results is None:
+        results = underwrite_batch(columns)
+    n = batch_size(columns)
+    years = np.arange(COMPLIANCE_PERIOD + 1)
+
+    def assumption(name, dtype=float):
+        return input_column(columns, name, n, settings[name], dtype)[:, None]
+
+    month = input_column(columns, "placed_in_service_month", n, settings["placed_in_service_month"])
+    investor_share = assumption("investor_share")
+    tax_rate = assumption("tax_rate")
+
+    # Equity: the investor pays the gross equity (the syndication fee comes out of it)
+    investor_equity = np.broadcast_to(np.asarray(results["gross_equity"], dtype=float), (n,))
+    pay_in = np.zeros((n, years.size))
+    for year, share in settings["pay_in_schedule"]:
+        pay_in[:, year] += investor_equity * share
+
+    credits = credit_schedule(np.broadcast_to(results["annual_credit"], (n,)), month) * investor_share
+
+    depreciable_basis = input_column(columns, "eligible_basis", n) * input_column(columns, "depreciable_basis_percent", n, settings["depreciable_basis_percent"])
+    depreciation = depreciation_schedule(depreciable_basis, month, input_column(columns, "depreciation_years", n, settings["depreciation_years"]))
+
+    # Operations from year 1: NOI growing each year, the permanent loan's debt service and interest
+    noi = input_column(columns, "noi_year_1", n)[:, None] * (1 + input_column(columns, "noi_growth_rate", n)[:, None]) ** (years - 1)
+    noi[:, 0] = 0.0
+    rate = input_column(columns, "permanent_loan_rate", n)[:, None]
+    term = input_column(columns, "permanent_loan_term", n)[:, None]
+    payments_per_year = input_column(columns, "loan_payments_per_year", n, 1, int)[:, None]
+    loan = np.broadcast_to(results["loan"], (n,))[:, None]
+    balance = loan_balance(loan, rate, term, years, payments_per_year)
+    principal = np.diff(balance, axis=1, prepend=balance[:, :1]) * -1
+    debt_service = np.where((years >= 1) & (years <= term), np.broadcast_to(results["debt_service"], (n,))[:, None], 0.0)
+    interest = np.maximum(debt_service - principal, 0.0)
+
+    taxable_income = noi - interest - depreciation
+    taxable_income[:, 0] = 0.0
+    # A tax loss saves the investor tax; taxable income costs it
+    tax_benefit = -taxable_income * investor_share * tax_rate
+    tax_benefit[:, 0] = 0.0
+    distributions = np.maximum(noi - debt_service, 0.0) * assumption("cash_flow_share")
+    distributions[:, 0] = 0.0
+
+    after_tax_cash_flows = credits + tax_benefit + distributions - pay_in
+    after_tax_cash_flows[:, -1] += assumption("exit_price")[:, 0]
+
+    irr = solve_irr_batch(after_tax_cash_flows)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        benefit_per_equity = (credits.sum(axis=1) + tax_benefit.sum(axis=1) + distributions.sum(axis=1)) / investor_equity
+
+    return {
+        "pay_in": pay_in,
+        "credits": credits,
+        "depreciation": depreciation,
+        "interest": interest,
+        "noi": noi,
+        "taxable_income": taxable_income,
+        "tax_benefit": tax_benefit,
+        "distributions": distributions,
+        "after_tax_cash_flows": after_tax_cash_flows,
+        "investor_equity": investor_equity,
+        "total_credits": credits.sum(axis=1),
+        "total_tax_benefit": tax_benefit.sum(axis=1),
+        "total_distributions": distributions.sum(axis=1),
+        "after_tax_irr": np.round(irr.irr * 100, 2),
+        "irr_status": irr.status,
+        "benefit_per_equity": benefit_per_equity,
+    }
+
+
+def investor_waterfall(inputs=None, **assumptions):
+    """
+    The waterfall for one deal (a get_project_inputs() dict) as the rows of a
+    table: one dict per year plus the totals and the investor's after-tax IRR.
+    """
+    waterfall = investor_waterfall_batch(to_columns([inputs or get_project_inputs()]), assumptions=assumptions)
+    labels = {
+        "pay_in": "Equity Pay-In",
+        "credits": "Tax Credits",
+        "depreciation": "Depreciation",
+        "interest": "Mortgage Interest",
+        "taxable_income": "Taxable Income (Loss)",
+        "tax_benefit": "Tax Benefit",
+        "distributions": "Cash Distributions",
+        "after_tax_cash_flows": "After-Tax Cash Flow",
+    }
+    years = [
+        dict({"Year": year}, **{label: round(float(waterfall[key][0, year]), 2) for key, label in labels.items()})
+        for year in range(COMPLIANCE_PERIOD + 1)
+    ]
+    status = int(waterfall["irr_status"][0])
+    return {
+        "Years": years,
+        "Investor Equity": round(float(waterfall["investor_equity"][0]), 2),
+        "Total Credits": round(float(waterfall["total_credits"][0]), 2),
+        "Total Tax Benefit": round(float(waterfall["total_tax_benefit"][0]), 2),
+        "Total Distributions": round(float(waterfall["total_distributions"][0]), 2),
+        "Benefit per $1 of Equity": round(float(waterfall["benefit_per_equity"][0]), 4),
+        "After-Tax IRR": float(waterfall["after_tax_irr"][0]),
+        "IRR Status": IRR_STATUS_MESSAGES[status],
+    }
+
+
+# Example: after-tax investor IRR for the default deal placed in service in March vs. November
+# for month in (3, 11):
+#     print(month, investor_waterfall(placed_in_service_month=month)["After-Tax IRR"])
@@ -0,0 +1,207 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+"""
+Background job queue.
+
+Long runs (Monte Carlo simulations, big sensitivity grids, even a single
+underwriting with charts) shouldn't hold a web request open. submit()
+queues a run and returns a job id straight away; the run executes on a
+small local pool of threads, and its status, progress and partial results
+can be polled with get().
+
+    - No broker: jobs live in the memory of the process that created them,
+      so the app should run as one process with several threads
+      (e.g. gunicorn --workers 1 --threads 8), or with sticky sessions
+    - Backpressure: at most `max_pending` jobs can be queued or running;
+      submit() raises QueueFull beyond that, and the app answers 429
+    - CPU-bound work runs in a process pool (Job.run_in_process, or the
+      simulation's own pool), so the threads here mostly wait and the web
+      server's threads are never starved by model code holding the GIL
+    - Cancellation: a queued job is dropped; a running job stops the next
+      time it reports progress or checks Job.cancelled (between chunks)
+
+A job function is called as fn(job, *args, **kwargs) and returns the result.
+It reports progress with job.report(done, total, partial=None), which also
+raises JobCancelled if the job has been cancelled.
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, queue):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.progress = 0.0
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._queue = queue
+        self._future = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    def report(self, done, total, partial=None):
+        """Records progress (and optionally partial results); raises JobCancelled if the job was cancelled."""
+        self.progress = min(done / total, 1.0) if total else 1.0
+        if partial is not None:
+            self.partial = partial
+        self.check_cancelled()
+
+    def run_in_process(self, fn, *args, poll=0.1):
+        """Runs fn(*args) in the queue's process pool, giving up early if the job is cancelled."""
+        future = self._queue.process_pool().submit(fn, *args)
+        while True:
+            try:
+                return future.result(timeout=poll)
+            except TimeoutError:
+                if self._cancel.is_set():
+                    future.cancel()
+                    raise JobCancelled(self.id)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": round(self.progress * 100, 1),
+            "partial": self.partial,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    def __init__(self, workers=2, max_pending=16, keep_finished=256, processes=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.processes = processes
+        self._threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._processes = None
+        self._jobs = OrderedDict()  # job id -> Job, oldest first
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Queues fn(job, *args, **kwargs). Returns the Job, or raises QueueFull."""
+        with self._lock:
+            if self._pending_count() >= self.max_pending:
+                raise QueueFull(f"{self.max_pending} jobs are already queued or running")
+            job = Job(kind, self)
+            self._jobs[job.id] = job
+            self._prune()
+            job._future = self._threads.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def job_ids(self, kind=None):
+        """Ids of the jobs the queue still holds (queued, running or kept after finishing), of one kind or all."""
+        with self._lock:
+            return [job.id for job in self._jobs.values() if kind is None or job.kind == kind]
+
+    def cancel(self, job_id):
+        """Cancels a job. Returns the Job (None if unknown); finished jobs are left as they are."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return job
+            job._cancel.set()
+            if job._future.cancel():
+                # Never started
+                self._finish(job, CANCELLED)
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING) + FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            counts.update({"workers": self.workers, "max_pending": self.max_pending})
+            return counts
+
+    def process_pool(self):
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.processes)
+            return self._processes
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            self.cancel(job.id)
+        self._threads.shutdown(wait=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=True)
+
+    # Internals
+
+    def _run(self, job, fn, args, kwargs):
+        with self._lock:
+            if job._cancel.is_set():
+                self._finish(job, CANCELLED)
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+        try:
+            result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            with self._lock:
+                self._finish(job, CANCELLED)
+        except Exception as e:
+            with self._lock:
+                job.error = f"{type(e).__name__}: {e}"
+                self._finish(job, FAILED)
+        else:
+            with self._lock:
+                job.result = result
+                job.progress = 1.0
+                self._finish(job, DONE)
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+
+    def _pending_count(self):
+        return sum(1 for job in self._jobs.values() if job.status not in FINISHED_STATES)
+
+    def _prune(self):
+        # Forget the oldest finished jobs once more than keep_finished are held
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[job_id]
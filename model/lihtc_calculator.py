@@ -1,5 +1,8 @@
 from pprint import pprint # Pretty printing for objects
 
+from model.records import LihtcEquity
+from model.utils import rounded
+
 """
 This function is used to estimate how much equity a developer can raise using
 Low-Income Housing Tax Credits (LIHTC) - specifically the 9% credit.
@@ -67,7 +70,7 @@ This model reflects the real-world cash flow challenges in LIHTC deals:
     - Syndicators charge fees that reduce usable equity
     - Developers often need short-term bridge loans, increasing cost and risk.
 """
-def calculate_lihtc_equity_extended(
+def lihtc_equity(
     eligible_basis: float,
     applicable_fraction: float,
     credit_rate: float,
@@ -78,8 +81,13 @@ def calculate_lihtc_equity_extended(
     syndication_fee_percent: float = 0.05,
     use_bridge_loan: bool = True,
     bridge_loan_interest: float = 0.06,
-    bridge_loan_term_years: int = 2
-):
+    bridge_loan_term_years: int = 2,
+    full_precision: bool = False
+) -> LihtcEquity:
+    # Dollar amounts are rounded to cents unless full_precision (see utils.rounded)
+    def cents(value):
+        return rounded(value, 2, full_precision)
+
     qualified_basis = eligible_basis * applicable_fraction
     annual_credit = qualified_basis * credit_rate
     total_credit = annual_credit * term
@@ -89,36 +97,50 @@ def calculate_lihtc_equity_extended(
     syndication_fee = gross_equity * syndication_fee_percent if include_syndication_fee else 0
     net_equity = gross_equity - syndication_fee
 
-    # Disbursement schedule (assumes: 25% at closing, 50% during construction, 25% at stabilization)
-    disbursement_schedule = {
-        "Closing": round(net_equity * 0.25, 2),
-        "Construction Completion": round(net_equity * 0.50, 2),
-        "Stabilization": round(net_equity * 0.25, 2),
-    }
-
     # Bridge loan if equity not paid upfront
-    bridge_loan = {}
+    average_equity_gap = interest_due = 0.0
     if use_bridge_loan:
         average_equity_gap = net_equity * (0.75 / 2)  # 75% paid after closing, so average over 2 years
         interest_due = average_equity_gap * bridge_loan_interest * bridge_loan_term_years
-        bridge_loan = {
-            "Bridge Loan Principal Needed": round(average_equity_gap, 2),
-            "Interest Over Term": round(interest_due, 2),
-            "Total Repayment": round(average_equity_gap + interest_due, 2)
-        }
-
-    return {
-        "Credit Type": credit_type,
-        "Qualified Basis": qualified_basis,
-        "Annual Credit": round(annual_credit, 2),
-        "Total Credits (10 years)": round(total_credit, 2),
-        "Investor Pricing": pricing,
-        "Gross Equity Raised": round(gross_equity, 2),
-        "Syndication Fee": round(syndication_fee, 2),
-        "Net Equity After Fees": round(net_equity, 2),
-        "Disbursement Schedule": disbursement_schedule,
-        "Bridge Loan (if used)": bridge_loan
-    }
+
+    return LihtcEquity(
+        credit_type=credit_type,
+        qualified_basis=qualified_basis,
+        annual_credit=cents(annual_credit),
+        total_credit=cents(total_credit),
+        pricing=pricing,
+        gross_equity=cents(gross_equity),
+        syndication_fee=cents(syndication_fee),
+        net_equity=cents(net_equity),
+        # Disbursement schedule (assumes: 25% at closing, 50% during construction, 25% at stabilization)
+        disbursement_closing=cents(net_equity * 0.25),
+        disbursement_construction=cents(net_equity * 0.50),
+        disbursement_stabilization=cents(net_equity * 0.25),
+        use_bridge_loan=bool(use_bridge_loan),
+        bridge_loan_principal=cents(average_equity_gap),
+        bridge_loan_interest=cents(interest_due),
+        bridge_loan_total=cents(average_equity_gap + interest_due)
+    )
+
+def calculate_lihtc_equity_extended(
+    eligible_basis: float,
+    applicable_fraction: float,
+    credit_rate: float,
+    term: int = 10,
+    pricing: float = 0.90,
+    credit_type: str = "9%",
+    include_syndication_fee: bool = True,
+    syndication_fee_percent: float = 0.05,
+    use_bridge_loan: bool = True,
+    bridge_loan_interest: float = 0.06,
+    bridge_loan_term_years: int = 2,
+    full_precision: bool = False
+):
+    # Display dict of lihtc_equity() (see records.py)
+    return lihtc_equity(
+        eligible_basis, applicable_fraction, credit_rate, term, pricing, credit_type, include_syndication_fee,
+        syndication_fee_percent, use_bridge_loan, bridge_loan_interest, bridge_loan_term_years, full_precision
+    ).to_dict()
 
 # Run an example with extended modeling
 # pprint(calculate_lihtc_equity_extended(
@@ -1,44 +1,28 @@
-from inputs import get_project_inputs
-from lihtc_calculator import calculate_lihtc_equity_extended
-from capital_stack import build_advanced_capital_stack
-from cashflow_model import project_cash_flows_enhanced
-from utils import calculate_irr, calculate_dscr
+import argparse
 
-def main():
+from model.inputs import get_project_inputs, get_simulation_distributions
+from model.pipeline import run_pipeline, what_if
+from model.records import DealInputs
+from model.metrics import enable as enable_metrics, end_trace, span, start_trace
+
+def main(changes=None, full_precision=False):
     # 1. Gather user-defined assumptions
     inputs = get_project_inputs()
 
-    # 2. Calculate LIHTC equity and disbursement
-    lihtc_info = calculate_lihtc_equity_extended(
-        eligible_basis=inputs["eligible_basis"],
-        applicable_fraction=inputs["applicable_fraction"],
-        credit_rate=inputs["credit_rate"],
-        pricing=inputs["pricing"],
-        credit_type=inputs["credit_type"],
-        include_syndication_fee=inputs["include_syndication_fee"],
-        syndication_fee_percent=inputs["syndication_fee_percent"],
-        use_bridge_loan=inputs["use_bridge_loan"],
-        bridge_loan_interest=inputs["bridge_loan_interest"],
-        bridge_loan_term_years=inputs["bridge_loan_term_years"]
-    )
-
-    # 3. Build full capital stack using LIHTC equity
-    capital_stack = build_advanced_capital_stack(inputs, lihtc_info["Net Equity After Fees"])
-
-    # 4. Project 10-year cash flows
-    cash_flows = project_cash_flows_enhanced(
-        initial_noi=inputs["noi_year_1"],
-        noi_growth_rate=inputs["noi_growth_rate"],
-        debt_service=capital_stack["Loan (DSCR & LTV Constrained)"] * inputs["permanent_loan_rate"],
-        hold_period=inputs["hold_period"],
-        exit_cap_rate=inputs["exit_cap_rate"],
-        selling_cost_percent=inputs["selling_cost_percent"],
-        include_sale=True
-    )
-
-    # 5. Calculate IRR and DSCR
-    irr = calculate_irr(cash_flows, equity_investment=capital_stack["Equity Required"])
-    dscr = calculate_dscr(inputs["noi_year_1"], capital_stack["Loan (DSCR & LTV Constrained)"] * inputs["permanent_loan_rate"])
+    # 2-5. LIHTC equity, capital stack, debt, cash flows, IRR and DSCR
+    # (the stages and their inputs are declared in pipeline.py)
+    # (full_precision: no rounding until the numbers are printed, see utils.rounded)
+    run = run_pipeline(DealInputs.from_dict(inputs), full_precision=full_precision)
+
+    # What-if: change some inputs and rerun only the stages that depend on them
+    if changes:
+        run = what_if(run.result, **changes)
+        print(f"What-if {changes}: recomputed {', '.join(run.recomputed) or 'nothing'}")
+
+    result = run.result.to_dict()
+    lihtc_info, capital_stack, cash_flows = result["lihtc_info"], result["capital_stack"], result["cash_flows"]
+    irr, dscr, debt_service, loan_payoff = result["irr"], result["dscr"], result["debt_service"], result["loan_payoff"]
+    hold_period = run.result.deal.hold_period
 
     # 6. Print Results
     print("\nCapital Stack:")
@@ -46,8 +30,10 @@ def main():
         print(f"{k}: ${v:,.2f}" if isinstance(v, (int, float)) else f"{k}: {v}")
 
     print("\nFinancial Metrics:")
-    print(f"IRR: {irr}%")
-    print(f"DSCR (Year 1): {dscr}")
+    print(f"IRR: {irr:.2f}%")
+    print(f"DSCR (Year 1): {dscr:.2f}")
+    print(f"Annual Debt Service: ${debt_service:,.2f}")
+    print(f"Loan Payoff at Sale (Year {hold_period}): ${loan_payoff:,.2f}")
 
     print("\nLIHTC Equity Disbursement Schedule:")
     for k, v in lihtc_info["Disbursement Schedule"].items():
@@ -57,5 +43,79 @@ def main():
     for i, cf in enumerate(cash_flows, 1):
         print(f"Year {i}: ${cf:,.2f}")
 
+def parse_change(text):
+    # KEY=VALUE, with the value converted to the input's type (e.g. exit_cap_rate=0.055)
+    key, _, value = text.partition("=")
+    default = getattr(DealInputs(), key, None)
+    if default is None or isinstance(default, tuple):
+        raise argparse.ArgumentTypeError(f"unknown input: {key}")
+    if isinstance(default, bool):
+        return key, value.lower() in ("1", "true", "yes")
+    try:
+        return key, type(default)(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid value for {key}: {value}")
+
+def investor(inputs=None):
+    # Tax credit investor's view: credits, tax benefits and distributions over the compliance period
+    from model.investor import investor_waterfall
+
+    with span("investor"):
+        waterfall = investor_waterfall(inputs)
+
+    print("\nInvestor Waterfall (15-Year Compliance Period):")
+    for row in waterfall["Years"]:
+        print(f"Year {row['Year']}: " + ", ".join(f"{k} ${v:,.2f}" for k, v in row.items() if k != "Year"))
+    for k, v in waterfall.items():
+        if k != "Years":
+            print(f"{k}: {v}")
+
+def print_timings(trace):
+    print("\nStage Timings:")
+    for stage, seconds in trace.stage_totals().items():
+        print(f"{stage}: {seconds * 1000:.3f} ms")
+
+def simulate(draws, seed, workers):
+    # Monte Carlo mode: distributions of IRR, DSCR and funding gap instead of a single scenario
+    from model.simulation import run_simulation
+
+    with span("simulation"):
+        summary = run_simulation(
+            get_project_inputs(),
+            get_simulation_distributions(),
+            draws=draws,
+            seed=seed,
+            workers=workers,
+            progress=lambda done, total: print(f"Simulated {done:,} / {total:,} draws", end="\r")
+        )
+
+    print("\n\nMonte Carlo Results:")
+    for k, v in summary.items():
+        print(f"{k}: {v:,}" if isinstance(v, int) else f"{k}: {v}")
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Affordable housing finance model")
+    parser.add_argument("--simulate", type=int, metavar="DRAWS", help="run a Monte Carlo simulation with this many draws")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the simulation")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the simulation (default: CPU count)")
+    parser.add_argument("--what-if", type=parse_change, action="append", metavar="KEY=VALUE",
+                        help="change an input and recompute only what depends on it (repeatable)")
+    parser.add_argument("--investor", action="store_true", help="print the tax credit investor's 15-year benefit waterfall")
+    parser.add_argument("--full-precision", action="store_true", help="underwrite without rounding intermediate results")
+    parser.add_argument("--timings", action="store_true", help="print how long each model stage took")
+    args = parser.parse_args()
+
+    if args.timings:
+        enable_metrics()
+    trace, token = start_trace()
+
+    if args.simulate:
+        simulate(args.simulate, args.seed, args.workers)
+    else:
+        main(dict(args.what_if or ()), args.full_precision)
+        if args.investor:
+            investor(dict(get_project_inputs(), **dict(args.what_if or ())))
+
+    end_trace(token)
+    if args.timings:
+        print_timings(trace)
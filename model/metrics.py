@@ -0,0 +1,260 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+"""
+Timing spans and Prometheus metrics.
+
+    with span("capital_stack"):
+        capital_stack = build_advanced_capital_stack(inputs, equity)
+
+records how long the stage took in the model_stage_duration_seconds
+histogram, and in the current trace (if there is one) for per-request
+timing logs. Spans are off until enable() is called: span() then hands
+back one shared no-op context manager, so instrumented code costs a
+function call and nothing else (batch runs and the CLI pay nothing).
+
+render() writes every metric in the Prometheus text exposition format for
+the app's /metrics route. No client library is needed.
+
+Spans recorded in another process (e.g. a job's worker process) don't reach
+this process's metrics; return trace.spans from the worker and pass them to
+record_spans() here.
+"""
+
+# Seconds; stages range from microseconds (LIHTC) to seconds (charts, large batches)
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = False
+_current_trace = contextvars.ContextVar("model_trace", default=None)
+_registry = []
+_registry_lock = threading.Lock()
+
+logger = logging.getLogger("model.metrics")
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            # Counts per bucket (not cumulative); render() accumulates them
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    A counter or gauge whose values are read when metrics are rendered,
+    e.g. from ResultCache.stats(). `read` returns {label values tuple: value}.
+    """
+
+    def __init__(self, name, help, kind, labels, read):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.read = read
+        _register(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.read().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+
+
+def render():
+    """Every registered metric, in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("model_stage_duration_seconds", "Time spent in each model stage", ("stage",))
+
+
+class Trace:
+    """The spans recorded while this trace is active (see start_trace)."""
+
+    def __init__(self):
+        self.spans = []
+        self.started = time.perf_counter()
+
+    def stage_totals(self):
+        totals = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+def start_trace():
+    """Starts collecting spans for the current thread/context. Returns (trace, token) for end_trace()."""
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, stage=self.stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append((self.stage, elapsed))
+        return False
+
+
+class _NoOpSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+def span(stage):
+    """Times the block as `stage` (does nothing unless enable() has been called)."""
+    if not _enabled:
+        return _NO_OP_SPAN
+    return _Span(stage)
+
+
+def record_spans(spans):
+    """Records spans timed in another process (a list of (stage, seconds) pairs)."""
+    trace = _current_trace.get()
+    for stage, seconds in spans:
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if trace is not None:
+            trace.spans.append((stage, seconds))
+
+
+def enable_logging(stream=None):
+    """Sends log_trace() lines to stderr (or `stream`), one JSON object per line."""
+    if not logger.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+def log_trace(trace, **fields):
+    """Writes one structured (JSON) log line with the trace's total time and time per stage."""
+    record = dict(fields)
+    record["duration_ms"] = round((time.perf_counter() - trace.started) * 1000, 3)
+    record["stages_ms"] = {stage: round(seconds * 1000, 3) for stage, seconds in trace.stage_totals().items()}
+    logger.info(json.dumps(record))
@@ -0,0 +1,218 @@
+import math
+from collections import namedtuple
+from dataclasses import fields, is_dataclass, replace
+
+from model.capital_stack import size_capital_stack
+from model.cashflow_model import project_cash_flows_enhanced
+from model.debt import annual_debt_service, loan_balance
+from model.lihtc_calculator import lihtc_equity
+from model.metrics import span
+from model.records import CashFlowProjection, DealInputs, UnderwritingResult
+from model.utils import calculate_dscr, calculate_irr
+
+"""
+The underwriting pipeline as a graph of stages.
+
+Each stage declares the deal inputs it reads and the stages it depends on:
+
+    lihtc          <- LIHTC inputs (basis, credit rate, pricing, fees, bridge loan)
+    capital_stack  <- lihtc + costs, soft subsidies, NOI, DSCR and loan terms
+    debt           <- capital_stack + loan terms and hold period
+    cash_flows     <- debt + NOI, growth, hold period, exit cap rate, selling costs
+    irr            <- capital_stack + cash_flows
+    dscr           <- debt + NOI
+
+run_pipeline(deal, previous=result) reruns only the stages whose inputs
+changed, plus anything downstream of a stage whose output actually changed,
+and reuses everything else from the previous result. Changing only
+exit_cap_rate reruns cash flows and IRR and keeps the LIHTC equity, capital
+stack and debt. A stage that reruns but produces the same output (e.g. a
+cost change that doesn't move an LTV-capped loan) doesn't dirty its
+dependents.
+
+ARTIFACTS says which charts and reports each stage's output feeds, so
+callers know which ones have to be re-rendered.
+
+run_pipeline(deal, full_precision=True) runs every stage without rounding
+(see utils.rounded); a previous result computed in the other mode is not
+reused.
+"""
+
+Stage = namedtuple("Stage", ["name", "inputs", "depends", "compute"])
+
+PipelineRun = namedtuple("PipelineRun", ["result", "recomputed", "changed"])
+
+
+def _lihtc(deal, done, full_precision):
+    return lihtc_equity(
+        eligible_basis=deal.eligible_basis,
+        applicable_fraction=deal.applicable_fraction,
+        credit_rate=deal.credit_rate,
+        pricing=deal.pricing,
+        credit_type=deal.credit_type,
+        include_syndication_fee=deal.include_syndication_fee,
+        syndication_fee_percent=deal.syndication_fee_percent,
+        use_bridge_loan=deal.use_bridge_loan,
+        bridge_loan_interest=deal.bridge_loan_interest,
+        bridge_loan_term_years=deal.bridge_loan_term_years,
+        full_precision=full_precision
+    )
+
+
+def _capital_stack(deal, done, full_precision):
+    return size_capital_stack(
+        total_development_cost=deal.total_development_cost,
+        lihtc_equity=done["lihtc"].net_equity,
+        soft_subsidies=dict(deal.soft_subsidies),
+        noi_year_1=deal.noi_year_1,
+        dscr_required=deal.dscr_required,
+        permanent_loan_rate=deal.permanent_loan_rate,
+        permanent_loan_term=deal.permanent_loan_term,
+        construction_period_years=deal.construction_period_years,
+        max_deferred_dev_fee=deal.max_deferred_dev_fee,
+        loan_payments_per_year=deal.loan_payments_per_year,
+        full_precision=full_precision
+    )
+
+
+def _debt(deal, done, full_precision):
+    # (annual debt service, loan payoff at sale); see debt.py
+    args = (done["capital_stack"].loan, deal.permanent_loan_rate, deal.permanent_loan_term)
+    return (
+        float(annual_debt_service(*args, deal.loan_payments_per_year)),
+        float(loan_balance(*args, deal.hold_period, deal.loan_payments_per_year)),
+    )
+
+
+def _cash_flows(deal, done, full_precision):
+    debt_service, loan_payoff = done["debt"]
+    return tuple(project_cash_flows_enhanced(
+        initial_noi=deal.noi_year_1,
+        noi_growth_rate=deal.noi_growth_rate,
+        debt_service=debt_service,
+        hold_period=deal.hold_period,
+        exit_cap_rate=deal.exit_cap_rate,
+        selling_cost_percent=deal.selling_cost_percent,
+        include_sale=True,
+        loan_payoff=loan_payoff,
+        full_precision=full_precision
+    ))
+
+
+def _irr(deal, done, full_precision):
+    return calculate_irr(done["cash_flows"], done["capital_stack"].equity_required, full_precision)
+
+
+def _dscr(deal, done, full_precision):
+    return calculate_dscr(deal.noi_year_1, done["debt"][0], full_precision)
+
+
+# In dependency order
+STAGES = (
+    Stage("lihtc", ("eligible_basis", "applicable_fraction", "credit_rate", "pricing", "credit_type",
+                    "include_syndication_fee", "syndication_fee_percent", "use_bridge_loan",
+                    "bridge_loan_interest", "bridge_loan_term_years"), (), _lihtc),
+    Stage("capital_stack", ("total_development_cost", "soft_subsidies", "noi_year_1", "dscr_required",
+                            "permanent_loan_rate", "permanent_loan_term", "construction_period_years",
+                            "max_deferred_dev_fee", "loan_payments_per_year"), ("lihtc",), _capital_stack),
+    Stage("debt", ("permanent_loan_rate", "permanent_loan_term", "hold_period", "loan_payments_per_year"),
+          ("capital_stack",), _debt),
+    Stage("cash_flows", ("noi_year_1", "noi_growth_rate", "hold_period", "exit_cap_rate", "selling_cost_percent"),
+          ("debt",), _cash_flows),
+    Stage("irr", (), ("capital_stack", "cash_flows"), _irr),
+    Stage("dscr", ("noi_year_1",), ("debt",), _dscr),
+)
+
+# Charts and reports, and the stages whose outputs they show
+ARTIFACTS = {
+    "cash_flows_chart": ("cash_flows",),
+    "irr_chart": ("cash_flows", "capital_stack"),
+    "capital_stack_chart": ("capital_stack",),
+    "excel_report": tuple(stage.name for stage in STAGES),
+    "pdf_report": tuple(stage.name for stage in STAGES),
+}
+
+
+def changed_inputs(deal, previous_deal):
+    """Names of the inputs that differ between two DealInputs."""
+    return {field.name for field in fields(DealInputs) if getattr(deal, field.name) != getattr(previous_deal, field.name)}
+
+
+def same_output(a, b):
+    """Stage outputs are equal, with NaN equal to NaN (an unsolved IRR is the same unsolved IRR)."""
+    if is_dataclass(a) and type(a) is type(b):
+        return all(same_output(getattr(a, field.name), getattr(b, field.name)) for field in fields(a))
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(same_output(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return a == b
+
+
+def _stage_outputs(result):
+    projection = result.projection
+    return {
+        "lihtc": result.lihtc,
+        "capital_stack": result.capital_stack,
+        "debt": (projection.debt_service, projection.loan_payoff),
+        "cash_flows": projection.cash_flows,
+        "irr": result.irr,
+        "dscr": result.dscr,
+    }
+
+
+def run_pipeline(deal, previous=None, full_precision=False):
+    """
+    Underwrites `deal` (DealInputs). With `previous` (an UnderwritingResult),
+    only stages affected by the inputs that changed are recomputed.
+    full_precision: skip intermediate rounding (see utils.rounded).
+
+    Returns a PipelineRun: the UnderwritingResult, the stages that were
+    recomputed, and the stages whose output changed.
+    """
+    if previous is not None and previous.full_precision != full_precision:
+        previous = None
+    changed = changed_inputs(deal, previous.deal) if previous is not None else None
+    previous_outputs = _stage_outputs(previous) if previous is not None else {}
+
+    outputs = {}
+    recomputed = []
+    changed_stages = set()
+    for stage in STAGES:
+        dirty = (
+            previous is None
+            or any(key in changed for key in stage.inputs)
+            or any(name in changed_stages for name in stage.depends)
+        )
+        if not dirty:
+            outputs[stage.name] = previous_outputs[stage.name]
+            continue
+
+        with span(stage.name):
+            outputs[stage.name] = stage.compute(deal, outputs, full_precision)
+        recomputed.append(stage.name)
+        if previous is None or not same_output(outputs[stage.name], previous_outputs[stage.name]):
+            changed_stages.add(stage.name)
+
+    result = UnderwritingResult(
+        deal=deal,
+        lihtc=outputs["lihtc"],
+        capital_stack=outputs["capital_stack"],
+        projection=CashFlowProjection(outputs["cash_flows"], *outputs["debt"]),
+        irr=outputs["irr"],
+        dscr=outputs["dscr"],
+        full_precision=full_precision
+    )
+    return PipelineRun(result, recomputed, changed_stages)
+
+
+def what_if(previous, **changes):
+    """Re-underwrites a previous result with some inputs changed (e.g. exit_cap_rate=0.055)."""
+    if isinstance(changes.get("soft_subsidies"), dict):
+        changes["soft_subsidies"] = tuple(changes["soft_subsidies"].items())
+    return run_pipeline(replace(previous.deal, **changes), previous, previous.full_precision)
+
+
+def affected_artifacts(changed_stages):
+    """The charts and reports that show the output of any of `changed_stages`."""
+    return [name for name, stages in ARTIFACTS.items() if any(stage in changed_stages for stage in stages)]
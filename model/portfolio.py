@@ -0,0 +1,259 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+from model.batch import RESULT_FIELDS, finite_rows, to_columns, underwrite_batch
+from model.inputs import OPTIONAL_INPUTS, InvalidDeal, get_project_inputs, parse_input, validate_deal
+
+"""
+Portfolio underwriting CLI.
+
+Streams deals from a CSV or JSON Lines file, underwrites them in fixed-size
+chunks with batch.py and appends each chunk's results to the output file as
+soon as it's done. Only one chunk is in memory at a time, so memory use stays
+the same for a hundred deals or a few million.
+
+Input:
+    - One deal per CSV row / JSON line, keyed like get_project_inputs().
+      Any key that's missing takes its value from get_project_inputs().
+    - Soft subsidies are "soft_subsidies.HOME", "soft_subsidies.CDBG", ...
+      columns in CSV, or a nested "soft_subsidies" object in JSON Lines.
+    - Soft subsidy columns are merged over the default sources; a nested
+      "soft_subsidies" object replaces them.
+    - An optional "deal_id" column is copied to the output.
+    - Every deal is checked with inputs.validate_deal(). A row that fails
+      (or whose inputs give non-finite results) gets a message in the
+      "error" column and empty results, and the run carries on.
+
+Output: CSV, NDJSON or Parquet (Parquet needs pyarrow installed).
+
+Usage:
+    python -m model.portfolio pipeline.csv -o results.csv
+    python -m model.portfolio pipeline.jsonl -o results.parquet --cash-flows
+"""
+
+DEFAULT_CHUNK_SIZE = 10_000
+
+# Columns written as text rather than numbers
+TEXT_COLUMNS = ("deal_id", "error")
+
+
+def _deal_from_record(record, base, line_number):
+    """(deal_id, deal, None) for a valid record, or (deal_id, None, error message)."""
+    deal_id = record.get("deal_id", line_number) if isinstance(record, dict) else line_number
+    if not isinstance(record, dict):
+        return deal_id, None, "A deal must be a JSON object"
+    if None in record:
+        # csv.DictReader puts the cells past the header under None
+        return deal_id, None, "more values than header columns"
+
+    inputs, errors = {}, {}
+    # Soft subsidy columns are merged over the default sources rather than replacing them all
+    subsidies = dict(base["soft_subsidies"])
+    given_subsidies = False
+    for key, value in record.items():
+        if key == "deal_id" or value is None or value == "":
+            continue
+        try:
+            if key.startswith("soft_subsidies."):
+                subsidies[key.split(".", 1)[1]] = parse_input(key, value)
+                given_subsidies = True
+            else:
+                inputs[key] = parse_input(key, value)
+        except InvalidDeal as e:
+            errors.update(e.errors)
+    if given_subsidies:
+        if "soft_subsidies" in inputs:
+            errors["soft_subsidies"] = "give soft subsidies as one object or as soft_subsidies.<source> columns, not both"
+        inputs["soft_subsidies"] = subsidies
+
+    try:
+        deal = validate_deal(inputs, base)
+    except InvalidDeal as e:
+        errors.update(e.errors)
+    if errors:
+        return deal_id, None, "; ".join(errors.values())
+    return deal_id, deal, None
+
+
+def read_deals(path):
+    """
+    Yields (deal_id, deal dict, error) one at a time from a .csv or
+    .jsonl/.ndjson file; deal is None and error says why for a bad row.
+    """
+    base = dict(get_project_inputs(), **OPTIONAL_INPUTS)
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            # Line 1 is the header
+            for line_number, record in enumerate(csv.DictReader(f), 2):
+                yield _deal_from_record(record, base, line_number)
+        else:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, None, f"invalid JSON: {e.msg}"
+                    continue
+                yield _deal_from_record(record, base, line_number)
+
+
+def read_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    deals = read_deals(path)
+    while True:
+        chunk = list(islice(deals, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def underwrite_chunk(chunk, cash_flow_years=0):
+    """
+    Underwrites a list of (deal_id, deal, error) rows (see read_deals()).
+    Returns a dict of output columns (one value per row); rows with an
+    error get NaN results.
+    """
+    errors = [error for _, _, error in chunk]
+    valid = [row for row, error in enumerate(errors) if error is None]
+    output = {"deal_id": [deal_id for deal_id, _, _ in chunk]}
+    for field in RESULT_FIELDS:
+        output[field] = np.full(len(chunk), np.nan)
+    cash_flows = np.full((len(chunk), cash_flow_years), np.nan)
+
+    if valid:
+        results = underwrite_batch(to_columns(chunk[row][1] for row in valid))
+        for field in RESULT_FIELDS:
+            output[field][valid] = results[field]
+        if cash_flow_years:
+            years = results["cash_flows"].shape[1]
+            too_long = np.flatnonzero(results["hold_period"] > cash_flow_years)
+            cash_flows[valid, :min(years, cash_flow_years)] = results["cash_flows"][:, :cash_flow_years]
+            cash_flows[valid, years:] = 0.0
+            for row in too_long.tolist():
+                errors[valid[row]] = f"hold period over {cash_flow_years} years; raise --cash-flow-years"
+        # Anything the formulas couldn't handle shows up as non-finite results
+        for row in np.flatnonzero(~finite_rows(results)).tolist():
+            errors[valid[row]] = "The model produced non-finite results for these inputs"
+
+    failed = [row for row, error in enumerate(errors) if error is not None]
+    for field in RESULT_FIELDS:
+        output[field][failed] = np.nan
+    cash_flows[failed] = np.nan
+    output["error"] = errors
+    for year in range(cash_flow_years):
+        output[f"cash_flow_year_{year + 1}"] = cash_flows[:, year]
+    return output
+
+
+def _json_number(value):
+    return value if np.isfinite(value) else None
+
+
+class CsvResultWriter:
+    def __init__(self, path):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._header = None
+
+    def write(self, output):
+        if self._header is None:
+            self._header = list(output)
+            self._writer.writerow(self._header)
+        columns = [output[name] if name in TEXT_COLUMNS else np.asarray(output[name]).tolist() for name in self._header]
+        self._writer.writerows(zip(*columns))
+
+    def close(self):
+        self._file.close()
+
+
+class NdjsonResultWriter:
+    def __init__(self, path):
+        self._file = open(path, "w")
+
+    def write(self, output):
+        names = list(output)
+        columns = [output[name] if name in TEXT_COLUMNS else np.asarray(output[name]).tolist() for name in names]
+        lines = []
+        for values in zip(*columns):
+            record = {name: (value if name in TEXT_COLUMNS else _json_number(value)) for name, value in zip(names, values)}
+            lines.append(json.dumps(record))
+        self._file.write("\n".join(lines) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._path = path
+        self._writer = None
+
+    def write(self, output):
+        # Each chunk becomes a row group
+        table = self._pa.table({name: [str(v) for v in values] if name == "deal_id" else values for name, values in output.items()})
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+RESULT_WRITERS = {
+    "csv": CsvResultWriter,
+    "ndjson": NdjsonResultWriter,
+    "parquet": ParquetResultWriter,
+}
+
+
+def run_portfolio(input_path, output_path, output_format=None, chunk_size=DEFAULT_CHUNK_SIZE, cash_flow_years=0, log=sys.stderr):
+    """
+    Underwrites every deal in input_path and writes the results to output_path.
+    Returns the deal count (rows with an error included).
+    """
+    output_format = output_format or output_path.rsplit(".", 1)[-1].replace("jsonl", "ndjson")
+    if output_format not in RESULT_WRITERS:
+        raise ValueError(f"Unknown output format: {output_format} (use one of {', '.join(RESULT_WRITERS)})")
+
+    writer = RESULT_WRITERS[output_format](output_path)
+    start = time.perf_counter()
+    total = failed = 0
+    try:
+        for chunk in read_chunks(input_path, chunk_size):
+            output = underwrite_chunk(chunk, cash_flow_years)
+            writer.write(output)
+            total += len(chunk)
+            failed += sum(error is not None for error in output["error"])
+            elapsed = time.perf_counter() - start
+            if log:
+                print(f"{total:,} deals underwritten, {failed:,} with errors ({total / elapsed:,.0f} deals/sec)", file=log)
+    finally:
+        writer.close()
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Underwrite a portfolio of deals from a CSV or JSON Lines file")
+    parser.add_argument("input", help="deals file (.csv, .jsonl or .ndjson)")
+    parser.add_argument("-o", "--output", required=True, help="results file (.csv, .ndjson or .parquet)")
+    parser.add_argument("--format", choices=sorted(RESULT_WRITERS), help="output format (default: from the output file extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="deals underwritten at a time")
+    parser.add_argument("--cash-flows", action="store_true", help="include annual cash flows in the output")
+    parser.add_argument("--cash-flow-years", type=int, default=40, help="number of cash flow columns with --cash-flows")
+    args = parser.parse_args()
+
+    run_portfolio(args.input, args.output, args.format, args.chunk_size, args.cash_flow_years if args.cash_flows else 0)
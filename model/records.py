@@ -0,0 +1,312 @@
+from dataclasses import dataclass, fields
+
+import numpy as np
+
+"""
+Typed deal and result records.
+
+The model's functions have always passed dicts keyed by display strings
+("Loan (DSCR & LTV Constrained)", "Net Equity After Fees", ...). Those are
+what the templates and reports print, but they are slow to build, take a
+lot of memory when 100,000 results are held at once, and a typo in a key
+is only found at run time.
+
+One deal:
+    DealInputs, LihtcEquity, CapitalStack, CashFlowProjection and
+    UnderwritingResult are frozen dataclasses with __slots__: attribute
+    access, no per-instance dict, and they can't be changed by accident
+    after they are computed. Each result type has to_dict(), which returns
+    exactly the display dict the original functions returned, so
+    calculate_lihtc_equity_extended() and build_advanced_capital_stack()
+    are now thin adapters over lihtc_equity() and size_capital_stack().
+
+Many deals:
+    DealBatch and ResultBatch hold one row per deal in a NumPy structured
+    array (one fixed-size record per deal), so 100,000 results take about
+    11 MB (plus their cash flow matrix), can be sliced, sorted and masked
+    like any array, and deals feed straight into batch.underwrite_batch().
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class DealInputs:
+    """One deal's assumptions (the same keys and defaults as get_project_inputs())."""
+
+    total_development_cost: float = 12_000_000
+    eligible_basis: float = 10_000_000
+    applicable_fraction: float = 1.0
+    credit_rate: float = 0.09
+    pricing: float = 0.90
+    credit_type: str = "9%"
+    include_syndication_fee: bool = True
+    syndication_fee_percent: float = 0.05
+    use_bridge_loan: bool = True
+    bridge_loan_interest: float = 0.06
+    bridge_loan_term_years: int = 2
+    permanent_loan_rate: float = 0.05
+    permanent_loan_term: int = 30
+    dscr_required: float = 1.15
+    noi_year_1: float = 600_000
+    noi_growth_rate: float = 0.02
+    hold_period: int = 10
+    exit_cap_rate: float = 0.05
+    selling_cost_percent: float = 0.02
+    construction_period_years: float = 2
+    soft_subsidies: tuple = (("HOME", 1_000_000), ("CDBG", 750_000))  # (source, amount) pairs
+    max_deferred_dev_fee: float = 500_000
+    loan_payments_per_year: int = 1
+
+    @classmethod
+    def from_dict(cls, inputs):
+        """From a get_project_inputs()-style dict. Unknown keys raise TypeError."""
+        values = dict(inputs)
+        if "soft_subsidies" in values:
+            values["soft_subsidies"] = tuple(values["soft_subsidies"].items())
+        return cls(**values)
+
+    def to_dict(self):
+        inputs = {field.name: getattr(self, field.name) for field in fields(self)}
+        inputs["soft_subsidies"] = dict(self.soft_subsidies)
+        return inputs
+
+    @property
+    def soft_subsidy_total(self):
+        return sum(amount for _, amount in self.soft_subsidies)
+
+
+@dataclass(frozen=True, slots=True)
+class LihtcEquity:
+    credit_type: str
+    qualified_basis: float
+    annual_credit: float
+    total_credit: float
+    pricing: float
+    gross_equity: float
+    syndication_fee: float
+    net_equity: float
+    disbursement_closing: float
+    disbursement_construction: float
+    disbursement_stabilization: float
+    use_bridge_loan: bool
+    bridge_loan_principal: float = 0.0
+    bridge_loan_interest: float = 0.0
+    bridge_loan_total: float = 0.0
+
+    def to_dict(self):
+        """The calculate_lihtc_equity_extended() dict."""
+        bridge_loan = {}
+        if self.use_bridge_loan:
+            bridge_loan = {
+                "Bridge Loan Principal Needed": self.bridge_loan_principal,
+                "Interest Over Term": self.bridge_loan_interest,
+                "Total Repayment": self.bridge_loan_total
+            }
+        return {
+            "Credit Type": self.credit_type,
+            "Qualified Basis": self.qualified_basis,
+            "Annual Credit": self.annual_credit,
+            "Total Credits (10 years)": self.total_credit,
+            "Investor Pricing": self.pricing,
+            "Gross Equity Raised": self.gross_equity,
+            "Syndication Fee": self.syndication_fee,
+            "Net Equity After Fees": self.net_equity,
+            "Disbursement Schedule": {
+                "Closing": self.disbursement_closing,
+                "Construction Completion": self.disbursement_construction,
+                "Stabilization": self.disbursement_stabilization,
+            },
+            "Bridge Loan (if used)": bridge_loan
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class CapitalStack:
+    lihtc_equity: float
+    soft_subsidies: tuple  # (source, amount) pairs
+    loan: float
+    interest_reserve: float
+    funding_gap: float  # before deferred fee, unrounded
+    deferred_dev_fee: float
+    equity_required: float
+    total_sources: float
+    total_uses: float
+
+    def to_dict(self):
+        """The build_advanced_capital_stack() dict."""
+        return {
+            "LIHTC Equity": self.lihtc_equity,
+            "Soft Subsidies": dict(self.soft_subsidies),
+            "Loan (DSCR & LTV Constrained)": self.loan,
+            "Interest Reserve": self.interest_reserve,
+            "Deferred Developer Fee": self.deferred_dev_fee,
+            "Equity Required": self.equity_required,
+            "Total Sources": self.total_sources,
+            "Total Uses": self.total_uses
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class CashFlowProjection:
+    cash_flows: tuple  # annual cash flows to equity, sale (net of loan payoff) in the last year
+    debt_service: float
+    loan_payoff: float
+
+
+@dataclass(frozen=True, slots=True)
+class UnderwritingResult:
+    deal: DealInputs
+    lihtc: LihtcEquity
+    capital_stack: CapitalStack
+    projection: CashFlowProjection
+    irr: float
+    dscr: float
+    full_precision: bool = False  # computed without intermediate rounding (see utils.rounded)
+
+    def to_dict(self):
+        """The dict the templates and reports use."""
+        return {
+            "lihtc_info": self.lihtc.to_dict(),
+            "capital_stack": self.capital_stack.to_dict(),
+            "cash_flows": list(self.projection.cash_flows),
+            "irr": self.irr,
+            "dscr": self.dscr,
+            "debt_service": self.projection.debt_service,
+            "loan_payoff": self.projection.loan_payoff,
+            "inputs": self.deal.to_dict(),
+        }
+
+
+"""
+Columnar batches.
+"""
+
+# Integer and flag inputs; every other numeric input is a float64
+_DEAL_FIELD_TYPES = {
+    "credit_type": "U8",
+    "include_syndication_fee": "?",
+    "use_bridge_loan": "?",
+    "hold_period": "i4",
+    "loan_payments_per_year": "i4",
+}
+
+DEAL_FIELDS = tuple(field.name for field in fields(DealInputs) if field.name != "soft_subsidies")
+_DEFAULT_DEAL = DealInputs()
+
+
+def deal_dtype(subsidy_names):
+    subsidies = [(name, "f8") for name in subsidy_names]
+    return np.dtype([(name, _DEAL_FIELD_TYPES.get(name, "f8")) for name in DEAL_FIELDS] + [("soft_subsidies", subsidies)])
+
+
+class DealBatch:
+    """
+    Many deals as one structured array (`data`), one record per deal.
+    Soft subsidies are a nested record with one field per source.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_deals(cls, deals):
+        """From dicts (get_project_inputs() style) or DealInputs; missing inputs take DealInputs' defaults."""
+        deals = [deal.to_dict() if isinstance(deal, DealInputs) else deal for deal in deals]
+        subsidy_names = []
+        for deal in deals:
+            for name in deal.get("soft_subsidies", dict(_DEFAULT_DEAL.soft_subsidies)):
+                if name not in subsidy_names:
+                    subsidy_names.append(name)
+
+        data = np.zeros(len(deals), dtype=deal_dtype(subsidy_names))
+        for name in DEAL_FIELDS:
+            default = getattr(_DEFAULT_DEAL, name)
+            data[name] = [deal.get(name, default) for deal in deals]
+        for name in subsidy_names:
+            data["soft_subsidies"][name] = [
+                deal.get("soft_subsidies", dict(_DEFAULT_DEAL.soft_subsidies)).get(name, 0) for deal in deals
+            ]
+        return cls(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            record = self.data[index]
+            values = {name: record[name].item() for name in DEAL_FIELDS}
+            values["soft_subsidies"] = {name: record["soft_subsidies"][name].item() for name in self.subsidy_names}
+            return DealInputs.from_dict(values)
+        return DealBatch(self.data[index])
+
+    @property
+    def subsidy_names(self):
+        return self.data.dtype["soft_subsidies"].names or ()
+
+    def columns(self):
+        """The batch.py columns dict (views of `data`, nothing is copied)."""
+        columns = {name: self.data[name] for name in DEAL_FIELDS}
+        columns["soft_subsidies"] = {name: self.data["soft_subsidies"][name] for name in self.subsidy_names}
+        return columns
+
+    def underwrite(self):
+        """Underwrites every deal (see batch.underwrite_batch) into a ResultBatch."""
+        from model.batch import underwrite_batch
+        return ResultBatch.from_underwrite(underwrite_batch(self.columns()))
+
+
+# Per-deal outputs of underwrite_batch() kept in a ResultBatch
+RESULT_DTYPE = np.dtype([
+    ("net_equity", "f8"),
+    ("soft_subsidies", "f8"),
+    ("loan", "f8"),
+    ("interest_reserve", "f8"),
+    ("funding_gap", "f8"),
+    ("deferred_dev_fee", "f8"),
+    ("equity_required", "f8"),
+    ("total_sources", "f8"),
+    ("total_uses", "f8"),
+    ("debt_service", "f8"),
+    ("loan_payoff", "f8"),
+    ("irr", "f8"),
+    ("irr_status", "i1"),
+    ("dscr", "f8"),
+    ("hold_period", "i4"),
+])
+
+
+class ResultBatch:
+    """
+    Underwriting results for many deals: one RESULT_DTYPE record per deal in
+    `data`, and the N x max(hold_period) zero-padded `cash_flows` matrix.
+    """
+
+    __slots__ = ("data", "cash_flows")
+
+    def __init__(self, data, cash_flows):
+        self.data = data
+        self.cash_flows = cash_flows
+
+    @classmethod
+    def from_underwrite(cls, results):
+        """From the dict of arrays returned by batch.underwrite_batch()."""
+        data = np.empty(len(results["irr"]), dtype=RESULT_DTYPE)
+        for name in RESULT_DTYPE.names:
+            data[name] = results[name]
+        return cls(data, results["cash_flows"])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            record = self.data[index]
+            row = {name: record[name].item() for name in RESULT_DTYPE.names}
+            row["cash_flows"] = self.cash_flows[index, :row["hold_period"]].tolist()
+            return row
+        return ResultBatch(self.data[index], self.cash_flows[index])
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.cash_flows.nbytes
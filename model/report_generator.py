@@ -4,11 +4,26 @@ from reportlab.pdfgen import canvas
 import os
 import math
 
-def generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, dscr, filepath):
-    workbook = xlsxwriter.Workbook(filepath)
+import numpy as np
+
+def generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, dscr, filepath, sensitivity_tables=None, tornado_rows=None):
+    """
+    filepath can be a file path or a file-like object (e.g. io.BytesIO).
+
+    The workbook is written in xlsxwriter's constant_memory mode: each row is
+    flushed to disk as soon as the next row is started, so large multi-deal
+    workbooks don't have to be held in RAM. The catch is that rows must be
+    written in order (a cell in an earlier row can't be written later).
+
+    Numbers are written as they are and shown rounded by the cells' number
+    formats, so full-precision results keep their precision in the workbook.
+    """
+    workbook = xlsxwriter.Workbook(filepath, {"constant_memory": True})
     sheet = workbook.add_worksheet("Summary")
 
     bold = workbook.add_format({'bold': True})
+    money = workbook.add_format({'num_format': '#,##0.00'})
+    two_decimals = workbook.add_format({'num_format': '0.00'})
 
     row = 0
     sheet.write(row, 0, "Capital Stack", bold)
@@ -16,47 +31,108 @@ def generate_excel_report(capital_stack, lihtc_info, cash_flows, irr, dscr, file
         row += 1
         sheet.write(row, 0, key)
         if type(value) is dict:
-            start_row = row
-            sub_cells = []
+            # The total goes on this row and sums the sub-rows written below it
+            sub_cells = [f"C{row + 1 + i + 1}" for i in range(len(value))]
+            sheet.write(row, 1, f"={'+'.join(sub_cells)}")
             for k, v in value.items():
                 row += 1
                 sheet.write(row, 1, k)
-                sheet.write(row, 2, f"{v}")
-                sub_cells.append(f"C{row + 1}")
-            
-            sheet.write(start_row, 1, f"={'+'.join(sub_cells)}")
+                _write_number(sheet, row, 2, v, money)
         else:
-            sheet.write(row, 1, f"{value}")
+            _write_number(sheet, row, 1, value, money)
     
     row += 2
     sheet.write(row, 0, "LIHTC Disbursement", bold)
     for key, value in lihtc_info["Disbursement Schedule"].items():
         row += 1
         sheet.write(row, 0, key)
-        sheet.write(row, 0, value)
-
-    # row += 2
-    # sheet.write(row, 0, "Add Test")
-    # sheet.write(row, 1, "=2+2")
-    # sheet.write(row, 2, f"=B{row + 1}+3")
-    # sheet.write(row, 3, f"=C{row + 1}+3")
+        sheet.write(row, 1, value, money)
 
     row += 2
     sheet.write(row, 0, "Annual Cash Flows", bold)
-    for i, cf in enumerate(cash_flows):
-        sheet.write(row + i, 0, f"Year {i + 1}")
-        sheet.write(row + i, 1, cf)
+    for i, cf in enumerate(cash_flows, 1):
+        sheet.write(row + i, 0, f"Year {i}")
+        sheet.write(row + i, 1, cf, money)
     
     row += len(cash_flows) + 2
     sheet.write(row, 0, "IRR", bold)
-    sheet.write(row, 1, "NaN%") if math.isnan(irr) else sheet.write(row, 1, irr)
+    sheet.write(row, 1, "NaN%") if math.isnan(irr) else sheet.write(row, 1, irr, two_decimals)
     row += 1
     sheet.write(row, 0, "DSCR", bold)
-    sheet.write(row, 1, dscr)
+    sheet.write(row, 1, dscr, two_decimals)
+
+    for i, table in enumerate(sensitivity_tables or [], 1):
+        write_sensitivity_sheet(workbook, f"Sensitivity {i}", table, bold)
+
+    if tornado_rows:
+        write_tornado_sheet(workbook, tornado_rows, bold)
+
+    workbook.close()
+
+def _write_number(sheet, row, col, value, cell_format=None):
+    # Excel has no NaN, so unsolved values (e.g. IRR with no equity) are written as text
+    if isinstance(value, float) and math.isnan(value):
+        sheet.write(row, col, "NaN")
+    else:
+        sheet.write(row, col, value, cell_format)
+
+def write_sensitivity_sheet(workbook, name, table, bold):
+    """Two-way table: x_key values across the top, y_key values down the side."""
+    sheet = workbook.add_worksheet(name)
+    sheet.write(0, 0, f"{table['metric']} by {table['y_key']} (rows) x {table['x_key']} (columns)", bold)
+    sheet.write(1, 0, f"{table['y_key']} \\ {table['x_key']}", bold)
+    for col, x in enumerate(table["x_values"], 1):
+        sheet.write(1, col, float(x), bold)
+    for row, (y, values) in enumerate(zip(table["y_values"], table["values"]), 2):
+        sheet.write(row, 0, float(y), bold)
+        for col, value in enumerate(values, 1):
+            _write_number(sheet, row, col, float(value))
+
+def write_tornado_sheet(workbook, tornado_rows, bold):
+    """One-way sensitivities, largest swing first."""
+    sheet = workbook.add_worksheet("Tornado")
+    headers = ["Input", "Base Value", "Low Value", "High Value", "Result at Low", "Result at High", "Spread"]
+    for col, header in enumerate(headers):
+        sheet.write(0, col, header, bold)
+    for row, item in enumerate(tornado_rows, 1):
+        sheet.write(row, 0, item["input"])
+        for col, key in enumerate(["base_value", "low_value", "high_value", "low", "high", "spread"], 1):
+            _write_number(sheet, row, col, item[key])
+
+def generate_simulation_report(summary, buffer, filepath, max_rows=100_000):
+    """
+    Monte Carlo workbook: the summary, then one row per draw read straight
+    from the run's ResultBuffer (see buffers.py), up to `max_rows` draws.
+    Rows are written a block at a time from the buffer's arrays, so only
+    one block is ever copied out of it.
+    """
+    workbook = xlsxwriter.Workbook(filepath, {"constant_memory": True, "nan_inf_to_errors": True})
+    bold = workbook.add_format({'bold': True})
+
+    sheet = workbook.add_worksheet("Summary")
+    for row, (key, value) in enumerate(summary.items()):
+        sheet.write(row, 0, key, bold)
+        _write_number(sheet, row, 1, value)
+
+    fields = ["irr", "dscr", "equity_required", "funding_gap", "loan", "debt_service", "loan_payoff"]
+    headers = ["Draw", "IRR", "DSCR", "Equity Required", "Funding Gap", "Loan", "Debt Service", "Loan Payoff"]
+    hold_period = buffer.spec.hold_period
+    sheet = workbook.add_worksheet("Draws")
+    for col, header in enumerate(headers + [f"Year {year}" for year in range(1, hold_period + 1)]):
+        sheet.write(0, col, header, bold)
+
+    rows = min(len(buffer), max_rows)
+    for start in range(0, rows, 10_000):
+        stop = min(start + 10_000, rows)
+        block = np.column_stack([buffer[field][start:stop] for field in fields] + [buffer["cash_flows"][start:stop]])
+        for offset, values in enumerate(block.tolist()):
+            sheet.write(start + offset + 1, 0, start + offset + 1)
+            sheet.write_row(start + offset + 1, 1, values)
 
     workbook.close()
 
 def generate_pdf_report(capital_stack, lihtc_info,  cash_flows, irr, dscr, filepath):
+    # filepath can be a file path or a file-like object (e.g. io.BytesIO)
     c = canvas.Canvas(filepath, pagesize=letter)
     width, height = letter
     x = 40
@@ -97,8 +173,8 @@ def generate_pdf_report(capital_stack, lihtc_info,  cash_flows, irr, dscr, filep
     
     y -= 25
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(x, y, f"IRR: {irr}%")
+    c.drawString(x, y, f"IRR: {irr:.2f}%")
     y -= 15
-    c.drawString(x, y, f"DSCR: {dscr}")
+    c.drawString(x, y, f"DSCR: {dscr:.2f}")
     
     c.save()
\ No newline at end of file
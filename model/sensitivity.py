@@ -0,0 +1,124 @@
+import numpy as np
+
+from model.batch import to_columns, get_input, set_input, underwrite_batch
+from model.inputs import get_sensitivity_ranges
+
+"""
+Sensitivity analysis.
+
+Two-way tables ("exit cap rate x NOI growth", "credit pricing x loan rate")
+and one-way tornado rankings, computed with the batch pipeline in batch.py:
+every cell of a grid is just another row in one underwrite_batch() call,
+so a 200 x 200 table (40,000 scenarios) is a single vectorized pass.
+
+Any numeric key from get_project_inputs() can be varied, and soft subsidy
+sources can be addressed as "soft_subsidies.HOME".
+"""
+
+# Outputs of underwrite_batch() that can be tabulated
+SENSITIVITY_METRICS = ("irr", "dscr", "equity_required", "loan", "deferred_dev_fee", "funding_gap")
+
+# The two tables analysts used to rebuild by hand in Excel
+DEFAULT_TABLES = (("exit_cap_rate", "noi_growth_rate"), ("pricing", "permanent_loan_rate"))
+
+# Inputs that must stay whole numbers
+INTEGER_INPUTS = ("hold_period", "permanent_loan_term", "bridge_loan_term_years")
+
+# Conventions rather than assumptions: never swept
+FIXED_INPUTS = ("loan_payments_per_year",)
+
+
+def _scenario_columns(inputs, overrides):
+    columns = to_columns([inputs])
+    for key, values in overrides.items():
+        if key in INTEGER_INPUTS:
+            values = np.round(values)
+        set_input(columns, key, np.asarray(values, dtype=float))
+    return columns
+
+
+def numeric_input_keys(inputs):
+    """Every input that can be varied: numbers (not flags or labels), plus each soft subsidy source."""
+    keys = [k for k, v in inputs.items() if isinstance(v, (int, float)) and not isinstance(v, bool) and k not in FIXED_INPUTS]
+    keys += [f"soft_subsidies.{name}" for name in inputs.get("soft_subsidies", {})]
+    return keys
+
+
+def sensitivity_table(inputs, x_key, x_values, y_key, y_values, metric="irr"):
+    """
+    Two-way sensitivity table of `metric` for every combination of
+    x_key in x_values and y_key in y_values.
+
+    Returns a dict with the axes and a len(y_values) x len(x_values) "values" array.
+    """
+    if metric not in SENSITIVITY_METRICS:
+        raise ValueError(f"Unknown sensitivity metric: {metric}")
+
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    x_grid, y_grid = np.meshgrid(x_values, y_values)
+
+    columns = _scenario_columns(inputs, {x_key: x_grid.ravel(), y_key: y_grid.ravel()})
+    results = underwrite_batch(columns)
+
+    return {
+        "metric": metric,
+        "x_key": x_key,
+        "x_values": x_values,
+        "y_key": y_key,
+        "y_values": y_values,
+        "values": results[metric].reshape(y_grid.shape),
+    }
+
+
+def default_sensitivity_tables(inputs, steps=11, metric="irr"):
+    """The DEFAULT_TABLES over the ranges from get_sensitivity_ranges()."""
+    ranges = get_sensitivity_ranges()
+    return [
+        sensitivity_table(inputs, x_key, np.linspace(*ranges[x_key], steps), y_key, np.linspace(*ranges[y_key], steps), metric)
+        for x_key, y_key in DEFAULT_TABLES
+    ]
+
+
+def tornado(inputs, keys=None, swing=0.10, metric="irr"):
+    """
+    One-way sensitivity of `metric` to each input moved down and up by `swing`
+    (e.g. 10%) from its base value, with every other input held at base.
+
+    Returns one dict per input, ranked by the size of the swing in the metric
+    (largest first, inputs that produce NaN last).
+    """
+    if metric not in SENSITIVITY_METRICS:
+        raise ValueError(f"Unknown sensitivity metric: {metric}")
+    keys = keys or numeric_input_keys(inputs)
+
+    # Row 0 is the base case, then a low and a high row for each input
+    size = 1 + 2 * len(keys)
+    overrides = {}
+    for i, key in enumerate(keys):
+        base = float(get_input(inputs, key))
+        values = np.full(size, base)
+        values[1 + 2 * i] = base * (1 - swing)
+        values[2 + 2 * i] = base * (1 + swing)
+        overrides[key] = values
+
+    columns = _scenario_columns(inputs, overrides)
+    output = underwrite_batch(columns)[metric]
+
+    rows = []
+    for i, key in enumerate(keys):
+        low, high = output[1 + 2 * i], output[2 + 2 * i]
+        rows.append({
+            "input": key,
+            "base_value": get_input(inputs, key),
+            "low_value": float(get_input(columns, key)[1 + 2 * i]),
+            "high_value": float(get_input(columns, key)[2 + 2 * i]),
+            "base": float(output[0]),
+            "low": float(low),
+            "high": float(high),
+            "spread": float(abs(high - low)),
+        })
+
+    rows.sort(key=lambda row: -row["spread"] if np.isfinite(row["spread"]) else np.inf)
+    return rows
+
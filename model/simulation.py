@@ -0,0 +1,250 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model.batch import to_columns, underwrite_batch
+from model.buffers import ResultBuffer, write_results
+
+"""
+Monte Carlo risk simulation.
+
+Instead of one deterministic IRR and DSCR, this draws the uncertain inputs
+(NOI growth, exit cap rate, credit pricing, permanent loan rate and
+construction period) from distributions and runs the batch underwriting
+pipeline for every draw, producing distributions of the results.
+
+How it scales:
+    - Draws are processed in chunks (e.g. 100,000 at a time) with batch.py
+    - Chunks run across a process pool (one per CPU core by default)
+    - Each chunk has its own seed spawned from the run's seed, so results
+      are reproducible no matter how many workers are used
+    - Each chunk is reduced to a small, fixed-size summary (counts, sums and
+      an IRR histogram) that is folded into the running totals, so memory
+      stays flat whether we run 10,000 or 10,000,000 draws
+
+Percentiles are read off the IRR histogram, so they are accurate to the
+histogram's bin width (0.01 percentage points).
+
+To keep every draw (for charts, reports or drill-down), pass a ResultBuffer
+(see buffers.py) with a row per draw: each worker writes its chunk's results
+straight into the buffer's shared pages, at the chunk's own rows, so the
+per-draw arrays are never pickled back to the parent.
+"""
+
+# IRR histogram, in percent
+IRR_HISTOGRAM_MIN = -100.0
+IRR_HISTOGRAM_MAX = 200.0
+IRR_HISTOGRAM_BIN = 0.01
+IRR_HISTOGRAM_BINS = int(round((IRR_HISTOGRAM_MAX - IRR_HISTOGRAM_MIN) / IRR_HISTOGRAM_BIN))
+
+DEFAULT_CHUNK_SIZE = 100_000
+
+
+def draw_samples(distributions, size, rng):
+    """
+    Draws `size` samples for every input in `distributions`.
+
+    Each distribution is a dict with a "type" and its parameters:
+        {"type": "normal", "mean": 0.02, "std": 0.01}            (optional "min"/"max" clip)
+        {"type": "uniform", "low": 0.85, "high": 0.95}
+        {"type": "triangular", "low": 0.045, "mode": 0.05, "high": 0.065}
+        {"type": "choice", "values": [1.5, 2, 3], "weights": [0.3, 0.5, 0.2]}
+        {"type": "fixed", "value": 0.05}
+    """
+    samples = {}
+    for key, spec in distributions.items():
+        kind = spec["type"]
+        if kind == "normal":
+            values = rng.normal(spec["mean"], spec["std"], size)
+        elif kind == "uniform":
+            values = rng.uniform(spec["low"], spec["high"], size)
+        elif kind == "triangular":
+            values = rng.triangular(spec["low"], spec["mode"], spec["high"], size)
+        elif kind == "choice":
+            weights = spec.get("weights")
+            if weights is not None:
+                weights = np.asarray(weights, dtype=float) / np.sum(weights)
+            values = rng.choice(np.asarray(spec["values"], dtype=float), size, p=weights)
+        elif kind == "fixed":
+            values = np.full(size, float(spec["value"]))
+        else:
+            raise ValueError(f"Unknown distribution type for {key}: {kind}")
+
+        if "min" in spec or "max" in spec:
+            values = np.clip(values, spec.get("min", -np.inf), spec.get("max", np.inf))
+        samples[key] = values
+    return samples
+
+
+def max_hold_period(inputs, distributions):
+    """Longest hold period any draw can have (the width of a buffer for the run's cash flows)."""
+    spec = distributions.get("hold_period")
+    if spec is None:
+        return int(inputs.get("hold_period", 10))
+    values = spec.get("values", [spec.get("value"), spec.get("high"), spec.get("max")])
+    return int(max(value for value in values if value is not None))
+
+
+def _empty_stats():
+    return {
+        "draws": 0,
+        "irr_count": 0,
+        "irr_mean": 0.0,
+        "irr_m2": 0.0,
+        "irr_not_solved": 0,
+        "irr_histogram": np.zeros(IRR_HISTOGRAM_BINS + 2, dtype=np.int64),  # + underflow/overflow bins
+        "dscr_breaches": 0,
+        "funding_gap_breaches": 0,
+        "equity_required_sum": 0.0,
+    }
+
+
+def _merge_stats(total, chunk):
+    """Folds one chunk's summary into the running totals (Chan's parallel mean/variance)."""
+    n_a, n_b = total["irr_count"], chunk["irr_count"]
+    if n_b:
+        n = n_a + n_b
+        delta = chunk["irr_mean"] - total["irr_mean"]
+        total["irr_mean"] += delta * n_b / n
+        total["irr_m2"] += chunk["irr_m2"] + delta ** 2 * n_a * n_b / n
+        total["irr_count"] = n
+    for key in ("draws", "irr_not_solved", "dscr_breaches", "funding_gap_breaches", "equity_required_sum"):
+        total[key] += chunk[key]
+    total["irr_histogram"] += chunk["irr_histogram"]
+    return total
+
+
+def simulate_chunk(inputs, distributions, size, seed, buffer=None, start=0):
+    """
+    Underwrites `size` random draws and returns their summary statistics.
+    `seed` is a numpy SeedSequence (or int) unique to this chunk.
+    With a buffer spec (ResultBuffer.spec) the draws' results are also
+    written to rows start..start + size of that buffer.
+    """
+    rng = np.random.default_rng(seed)
+    columns = to_columns([inputs])
+    columns.update(draw_samples(distributions, size, rng))
+    results = underwrite_batch(columns)
+    if buffer is not None:
+        write_results(buffer, start, results)
+
+    stats = _empty_stats()
+    stats["draws"] = size
+
+    irr = results["irr"]
+    solved = irr[np.isfinite(irr)]
+    stats["irr_not_solved"] = size - solved.size
+    if solved.size:
+        stats["irr_count"] = solved.size
+        stats["irr_mean"] = float(solved.mean())
+        stats["irr_m2"] = float(((solved - solved.mean()) ** 2).sum())
+        bins = np.floor((solved - IRR_HISTOGRAM_MIN) / IRR_HISTOGRAM_BIN).astype(np.int64) + 1
+        stats["irr_histogram"] = np.bincount(np.clip(bins, 0, IRR_HISTOGRAM_BINS + 1), minlength=IRR_HISTOGRAM_BINS + 2)
+
+    # Lowest DSCR over the hold: with negative NOI growth that's the last year, otherwise year 1
+    growth = np.broadcast_to(np.asarray(columns.get("noi_growth_rate"), dtype=float), (size,))
+    hold_period = results["hold_period"]
+    lowest_noi = inputs["noi_year_1"] * np.minimum(1.0, (1 + growth) ** (hold_period - 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lowest_dscr = lowest_noi / results["debt_service"]
+    dscr_required = np.broadcast_to(np.asarray(columns["dscr_required"], dtype=float), (size,))
+    stats["dscr_breaches"] = int(np.count_nonzero(lowest_dscr < dscr_required))
+
+    max_deferred_dev_fee = np.broadcast_to(np.asarray(columns.get("max_deferred_dev_fee", 500000), dtype=float), (size,))
+    stats["funding_gap_breaches"] = int(np.count_nonzero(results["funding_gap"] > max_deferred_dev_fee))
+    stats["equity_required_sum"] = float(results["equity_required"].sum())
+    return stats
+
+
+def _irr_percentile(histogram, count, q):
+    # Linear interpolation inside the bin that holds the q-th percentile
+    if count == 0:
+        return float("nan")
+    target = q / 100 * count
+    cumulative = np.cumsum(histogram)
+    index = int(np.searchsorted(cumulative, target))
+    if index == 0:
+        return IRR_HISTOGRAM_MIN
+    if index > IRR_HISTOGRAM_BINS:
+        return IRR_HISTOGRAM_MAX
+    below = cumulative[index - 1]
+    fraction = (target - below) / histogram[index] if histogram[index] else 0.0
+    return float(IRR_HISTOGRAM_MIN + (index - 1 + fraction) * IRR_HISTOGRAM_BIN)
+
+
+def summarize(stats):
+    """Turns the running totals into the report shown to the investment committee."""
+    draws = stats["draws"]
+    count = stats["irr_count"]
+    return {
+        "Draws": draws,
+        "Mean IRR (%)": round(stats["irr_mean"], 2) if count else float("nan"),
+        "IRR Std Dev (%)": round((stats["irr_m2"] / (count - 1)) ** 0.5, 2) if count > 1 else float("nan"),
+        "IRR P5 (%)": round(_irr_percentile(stats["irr_histogram"], count, 5), 2),
+        "IRR P50 (%)": round(_irr_percentile(stats["irr_histogram"], count, 50), 2),
+        "IRR P95 (%)": round(_irr_percentile(stats["irr_histogram"], count, 95), 2),
+        "IRR Not Solved": stats["irr_not_solved"],
+        "Probability DSCR Below Required": round(stats["dscr_breaches"] / draws, 4) if draws else float("nan"),
+        "Probability Funding Gap Over Max Deferred Fee": round(stats["funding_gap_breaches"] / draws, 4) if draws else float("nan"),
+        "Mean Equity Required": round(stats["equity_required_sum"] / draws, 2) if draws else float("nan"),
+    }
+
+
+def run_simulation(inputs, distributions, draws, seed=0, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, progress=None, partial=None,
+                   buffer=None):
+    """
+    Runs a Monte Carlo simulation of `draws` scenarios around the base deal `inputs`.
+
+    workers: number of processes (defaults to the CPU count; 1 runs in-process).
+    progress: optional callback called with (draws_done, draws_total) after each chunk.
+        An exception raised by the callback stops the run (chunks not yet started are dropped).
+    partial: optional callback called with the summarize() dict of the draws so far after each chunk.
+    buffer: optional ResultBuffer (or its spec) with room for `draws` rows; draw i's results are written to row i.
+
+    Returns the summarize() dict. The same seed always gives the same result,
+    regardless of the number of workers or chunk completion order.
+    """
+    starts = list(range(0, draws, chunk_size))
+    sizes = [min(chunk_size, draws - start) for start in starts]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    workers = workers or os.cpu_count() or 1
+    spec = buffer.spec if isinstance(buffer, ResultBuffer) else buffer
+    if spec is not None and spec.size < draws:
+        raise ValueError(f"The buffer has room for {spec.size} draws, not {draws}")
+
+    stats = _empty_stats()
+    done = 0
+    if workers == 1 or len(sizes) == 1:
+        for start, size, chunk_seed in zip(starts, sizes, seeds):
+            _merge_stats(stats, simulate_chunk(inputs, distributions, size, chunk_seed, spec, start))
+            done += size
+            if partial:
+                partial(summarize(stats))
+            if progress:
+                progress(done, draws)
+        return summarize(stats)
+
+    # Keep a bounded number of chunks in flight and fold them in chunk order,
+    # so memory stays flat and floating point sums are reproducible
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        next_submit = 0
+        try:
+            for index in range(len(sizes)):
+                while next_submit < len(sizes) and next_submit < index + 2 * workers:
+                    pending[next_submit] = pool.submit(simulate_chunk, inputs, distributions, sizes[next_submit],
+                                                       seeds[next_submit], spec, starts[next_submit])
+                    next_submit += 1
+                _merge_stats(stats, pending.pop(index).result())
+                done += sizes[index]
+                if partial:
+                    partial(summarize(stats))
+                if progress:
+                    progress(done, draws)
+        except BaseException:
+            for future in pending.values():
+                future.cancel()
+            raise
+
+    return summarize(stats)
@@ -0,0 +1,303 @@
+import numpy as np
+
+from model.batch import batch_size, calculate_lihtc_equity_batch, input_column, to_columns
+from model.debt import annual_debt_service
+from model.inputs import get_project_inputs
+
+"""
+Multi-source capital stack optimizer.
+
+build_advanced_capital_stack() fills the funding gap in a fixed order: one
+DSCR/LTV-sized loan, then deferred developer fee, then equity. Real deals
+layer more sources than that, each with its own limits and price:
+
+    - Senior permanent loan:  DSCR and LTV tested, amortizing
+    - Tax-exempt bonds:       cheaper, same DSCR/LTV tests
+    - Mezzanine debt:         combined DSCR/LTV tests (counting the senior
+                              debt ahead of it), expensive
+    - Seller note:            paid from surplus cash flow, so no DSCR test
+    - Deferred developer fee: capped, no debt service
+
+A source is a dict (see SOURCE_DEFAULTS), e.g.
+
+    {"name": "Mezzanine", "kind": "debt", "rate": 0.09, "term": 10,
+     "min_dscr": 1.05, "max_ltv": 0.85, "max_amount": 1500000, "priority": 1}
+
+    kind        "debt" (debt service counts in DSCR tests and the amount in LTV
+                tests), "cash_flow_debt" (paid from surplus cash: LTV only) or
+                "equity" (neither)
+    max_amount  cap on the source
+    min_dscr    combined DSCR this source's lender requires, counting the
+                debt service of every source placed ahead of it
+    max_ltv     combined loan-to-cost limit (of total_development_cost, the
+                same basis as the 75% rule in capital_stack.py)
+    rate, term  for its debt service (payments_per_year per year)
+    cost        cost of capital used by objective="cost" (defaults to rate)
+    priority    lien / funding order: lower fills first, whatever it costs
+    interest_reserve  whether a construction interest reserve (amount x rate x
+                construction_period_years) is added to uses, as for the
+                permanent loan today
+
+Every value may be a scalar or an array with one element per deal.
+
+The gap left after LIHTC equity and soft subsidies is filled greedily: sources
+in order of priority, then by the objective:
+
+    objective="cost"    cheapest first, minimizing the weighted cost of capital
+    objective="equity"  least debt service per dollar funded first, so the DSCR
+                        capacity stretches furthest and the equity left over is
+                        as small as it can be
+
+Each source takes the smallest of its cap, the gap still open, and the room
+left under its DSCR and LTV tests after the sources ahead of it. With one
+binding resource (the gap, or a single DSCR or LTV test) this is a fractional
+knapsack and the greedy fill is the exact optimum of the linear program; with
+several it is the lien-order sizing lenders use. Whatever is still open is
+equity.
+
+All deals are solved together: sources are columns of an N x k array, the
+order is one lexsort per row and the fill is a loop over the k sources (not
+over deals), so restructuring thousands of deals is a handful of array
+operations.
+"""
+
+SOURCE_KINDS = ("debt", "cash_flow_debt", "equity")
+
+SOURCE_DEFAULTS = {
+    "kind": "debt",
+    "max_amount": np.inf,
+    "min_dscr": None,
+    "max_ltv": None,
+    "rate": 0.0,
+    "term": 30,
+    "payments_per_year": 1,
+    "cost": None,
+    "priority": 0,
+    "interest_reserve": None,  # True for "debt", False otherwise
+}
+
+OBJECTIVES = ("cost", "equity")
+
+# Why each source stopped where it did ("limits" in the results)
+LIMITS = ("gap filled", "cap", "DSCR", "LTV")
+LIMIT_GAP, LIMIT_CAP, LIMIT_DSCR, LIMIT_LTV = range(len(LIMITS))
+
+
+def default_sources(inputs=None):
+    """
+    Sources like build_advanced_capital_stack()'s: the DSCR/LTV-sized
+    permanent loan, then the deferred developer fee.
+
+    The results only match it while the loan's DSCR and LTV limits fall short
+    of the gap. build_advanced_capital_stack() always takes the full
+    DSCR/LTV-sized loan, so an overfunded deal gets a negative funding gap and
+    deferred fee; here every source is also capped at the gap still open, so
+    the loan stops there ("gap filled"). On the default deal that is a loan of
+    $2,838,888.89 here against $8,020,409.23 (and a -$4,663,368.31 deferred
+    fee) in the scalar model.
+    """
+    inputs = inputs or get_project_inputs()
+    return [
+        {
+            "name": "Permanent Loan",
+            "kind": "debt",
+            "rate": inputs["permanent_loan_rate"],
+            "term": inputs["permanent_loan_term"],
+            "payments_per_year": inputs.get("loan_payments_per_year", 1),
+            "min_dscr": inputs["dscr_required"],
+            "max_ltv": 0.75,
+            "priority": 0,
+        },
+        {
+            "name": "Deferred Developer Fee",
+            "kind": "equity",
+            "max_amount": inputs.get("max_deferred_dev_fee", 500000),
+            "priority": 1,
+        },
+    ]
+
+
+def _source_arrays(sources, n):
+    # Each field of every source as an N x k array
+    specs = []
+    for source in sources:
+        spec = dict(SOURCE_DEFAULTS, **source)
+        if spec["kind"] not in SOURCE_KINDS:
+            raise ValueError(f"Unknown kind for source {spec.get('name')!r}: {spec['kind']} (use one of {', '.join(SOURCE_KINDS)})")
+        if spec["cost"] is None:
+            spec["cost"] = spec["rate"]
+        if spec["interest_reserve"] is None:
+            spec["interest_reserve"] = spec["kind"] == "debt"
+        # No test is the same as a test that never binds
+        spec["min_dscr"] = 0.0 if spec["min_dscr"] is None else spec["min_dscr"]
+        spec["max_ltv"] = np.inf if spec["max_ltv"] is None else spec["max_ltv"]
+        specs.append(spec)
+
+    def field(name, dtype=float):
+        return np.stack([np.broadcast_to(np.asarray(spec[name], dtype=dtype), (n,)) for spec in specs], axis=1)
+
+    kind = np.array([SOURCE_KINDS.index(spec["kind"]) for spec in specs])
+    return {
+        "max_amount": field("max_amount"),
+        "min_dscr": field("min_dscr"),
+        "max_ltv": field("max_ltv"),
+        "rate": field("rate"),
+        "term": field("term"),
+        "payments_per_year": field("payments_per_year", int),
+        "cost": field("cost"),
+        "priority": field("priority"),
+        "interest_reserve": field("interest_reserve", bool),
+        "is_debt": np.broadcast_to(kind == 0, (n, len(specs))),
+        "counts_in_ltv": np.broadcast_to(kind < 2, (n, len(specs))),
+    }
+
+
+def optimize_capital_stack_batch(columns, sources=None, objective="cost", equity_cost=0.15):
+    """
+    Allocates `sources` (see above; default_sources() if not given) to every
+    deal in `columns` (keyed like get_project_inputs(), see batch.py).
+
+    Returns a dict of arrays: "amounts" (N x k, in the order of `sources`),
+    "limits" (N x k codes into LIMITS), "order" (the fill order per deal), the
+    debt_service, interest_reserve, dscr, ltv, equity_required, total_sources,
+    total_uses and weighted_cost (cost of all sources including equity at
+    `equity_cost`, per dollar of uses) of each deal, and "names".
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective: {objective} (use one of {', '.join(OBJECTIVES)})")
+    if sources is None:
+        sources = default_sources(dict(get_project_inputs(), **{
+            key: value for key, value in columns.items() if key != "soft_subsidies"
+        }))
+    n = batch_size(columns)
+    k = len(sources)
+    spec = _source_arrays(sources, n)
+
+    soft = columns.get("soft_subsidies", 0.0)
+    soft_total = sum(np.asarray(amount, dtype=float) for amount in soft.values()) if isinstance(soft, dict) else soft
+    soft_total = np.broadcast_to(np.asarray(soft_total, dtype=float), (n,))
+    lihtc = calculate_lihtc_equity_batch(
+        eligible_basis=input_column(columns, "eligible_basis", n),
+        applicable_fraction=input_column(columns, "applicable_fraction", n),
+        credit_rate=input_column(columns, "credit_rate", n),
+        pricing=input_column(columns, "pricing", n, 0.90),
+        include_syndication_fee=input_column(columns, "include_syndication_fee", n, True, bool),
+        syndication_fee_percent=input_column(columns, "syndication_fee_percent", n, 0.05),
+        use_bridge_loan=input_column(columns, "use_bridge_loan", n, True, bool),
+        bridge_loan_interest=input_column(columns, "bridge_loan_interest", n, 0.06),
+        bridge_loan_term_years=input_column(columns, "bridge_loan_term_years", n, 2)
+    )
+    total_development_cost = input_column(columns, "total_development_cost", n)
+    noi_year_1 = input_column(columns, "noi_year_1", n)
+    construction_period_years = input_column(columns, "construction_period_years", n, 2)
+
+    # Per dollar of each source: annual debt service, and how much of it funds the gap
+    # (the rest goes to its own interest reserve)
+    debt_constant = np.where(spec["is_debt"], annual_debt_service(1.0, spec["rate"], spec["term"], spec["payments_per_year"]), 0.0)
+    reserve_rate = np.where(spec["interest_reserve"], spec["rate"] * construction_period_years[:, None], 0.0)
+    funded = 1 - reserve_rate
+
+    if objective == "cost":
+        preference = spec["cost"]
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            preference = np.where(funded > 0, debt_constant / funded, np.inf)
+    order = np.lexsort((preference, spec["priority"]), axis=-1)
+
+    amounts = np.zeros((n, k))
+    limits = np.zeros((n, k), dtype=np.int8)
+    gap = total_development_cost - lihtc["net_equity"] - soft_total
+    debt_service = np.zeros(n)
+    ltv_debt = np.zeros(n)
+    rows = np.arange(n)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for position in range(k):
+            j = order[:, position]
+            constant = debt_constant[rows, j]
+            share = funded[rows, j]
+
+            room = np.empty((n, len(LIMITS)))
+            room[:, LIMIT_GAP] = np.where(share > 0, np.maximum(gap, 0.0) / share, 0.0)
+            room[:, LIMIT_CAP] = spec["max_amount"][rows, j]
+            # Debt service capacity left under this lender's combined DSCR test
+            capacity = noi_year_1 / spec["min_dscr"][rows, j] - debt_service
+            room[:, LIMIT_DSCR] = np.where(constant > 0, np.maximum(capacity, 0.0) / constant, np.inf)
+            room[:, LIMIT_LTV] = np.where(
+                spec["counts_in_ltv"][rows, j],
+                np.maximum(spec["max_ltv"][rows, j] * total_development_cost - ltv_debt, 0.0),
+                np.inf
+            )
+
+            limit = np.argmin(room, axis=1)
+            amount = np.maximum(room[rows, limit], 0.0)
+            amounts[rows, j] = amount
+            limits[rows, j] = limit
+
+            gap = gap - amount * share
+            debt_service = debt_service + amount * constant
+            ltv_debt = ltv_debt + np.where(spec["counts_in_ltv"][rows, j], amount, 0.0)
+
+        interest_reserve = (amounts * reserve_rate).sum(axis=1)
+        equity_required = np.maximum(gap, 0.0)
+        total_uses = total_development_cost + interest_reserve
+        total_sources = lihtc["net_equity"] + soft_total + amounts.sum(axis=1) + equity_required
+        dscr = noi_year_1 / debt_service
+        weighted_cost = ((amounts * spec["cost"]).sum(axis=1) + equity_required * equity_cost) / total_uses
+
+    return {
+        "names": [source.get("name", f"Source {i + 1}") for i, source in enumerate(sources)],
+        "amounts": amounts,
+        "limits": limits,
+        "order": order,
+        "net_equity": lihtc["net_equity"],
+        "soft_subsidies": soft_total,
+        "interest_reserve": interest_reserve,
+        "debt_service": debt_service,
+        "dscr": dscr,
+        "ltv": ltv_debt / total_development_cost,
+        "equity_required": equity_required,
+        "total_sources": total_sources,
+        "total_uses": total_uses,
+        "weighted_cost": weighted_cost,
+    }
+
+
+def optimize_capital_stack(inputs=None, sources=None, objective="cost", equity_cost=0.15):
+    """
+    The optimized stack for one deal (a get_project_inputs() dict) as a display
+    dict like build_advanced_capital_stack()'s: one line per source plus the
+    limit that stopped it.
+    """
+    inputs = inputs or get_project_inputs()
+    if sources is None:
+        sources = default_sources(inputs)
+    stack = optimize_capital_stack_batch(to_columns([inputs]), sources, objective, equity_cost)
+
+    result = {
+        "LIHTC Equity": round(float(stack["net_equity"][0]), 2),
+        "Soft Subsidies": {k: round(v, 2) for k, v in inputs.get("soft_subsidies", {}).items()},
+    }
+    for i in stack["order"][0].tolist():
+        result[stack["names"][i]] = round(float(stack["amounts"][0, i]), 2)
+    result["Interest Reserve"] = round(float(stack["interest_reserve"][0]), 2)
+    result["Equity Required"] = round(float(stack["equity_required"][0]), 2)
+    result["Total Sources"] = round(float(stack["total_sources"][0]), 2)
+    result["Total Uses"] = round(float(stack["total_uses"][0]), 2)
+    result["Annual Debt Service"] = round(float(stack["debt_service"][0]), 2)
+    result["DSCR"] = round(float(stack["dscr"][0]), 2)
+    result["LTV"] = round(float(stack["ltv"][0]), 4)
+    result["Weighted Cost of Capital"] = round(float(stack["weighted_cost"][0]), 4)
+    result["Limits"] = {stack["names"][i]: LIMITS[stack["limits"][0, i]] for i in stack["order"][0].tolist()}
+    return result
+
+
+# Example: add tax-exempt bonds, mezzanine debt and a seller note to the default deal
+# sources = [
+#     {"name": "Tax-Exempt Bonds", "rate": 0.045, "term": 35, "min_dscr": 1.15, "max_ltv": 0.75, "max_amount": 4000000},
+#     {"name": "Senior Loan", "rate": 0.06, "term": 30, "min_dscr": 1.15, "max_ltv": 0.75},
+#     {"name": "Mezzanine", "rate": 0.09, "term": 10, "min_dscr": 1.05, "max_ltv": 0.85, "priority": 1},
+#     {"name": "Seller Note", "kind": "cash_flow_debt", "rate": 0.03, "max_amount": 750000, "max_ltv": 0.90, "priority": 2},
+#     {"name": "Deferred Developer Fee", "kind": "equity", "max_amount": 500000, "cost": 0.0, "priority": 3},
+# ]
+# print(optimize_capital_stack(dict(get_project_inputs(), total_development_cost=18000000), sources))
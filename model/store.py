@@ -0,0 +1,341 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from model.cache import canonical_json, json_hash
+from model.records import ResultBatch
+
+"""
+Scenario store: saved runs in a local SQLite database.
+
+Each scenario keeps its inputs, capital stack and cash flows, with the
+headline numbers (IRR, DSCR, equity required, ...) and the capital stack as
+plain columns, so they can be filtered and sorted with SQL:
+
+    store = ScenarioStore("scenarios.db")
+    store.save(result, tags=["downtown"])
+    store.query(min_dscr=1.15, min_irr=10, order_by="equity_required", limit=50)
+
+Speed:
+    - IRR, DSCR and equity required are indexed, and tags live in their own
+      (tag, scenario) table whose primary key is the index. The equity
+      indexes also hold DSCR and IRR, so "DSCR >= 1.15 and IRR >= 10%
+      sorted by equity required" walks one index in order and stops at the
+      limit without reading the scenarios themselves. Deals that need no
+      equity have no IRR (NULL) and would come first in that order, so the
+      index used when filtering on IRR leaves them out (a partial index):
+      the query takes well under a millisecond over 1,000,000 scenarios.
+    - save_batch() inserts `batch_size` rows per transaction with
+      executemany(); committing row by row would be 1,000x slower.
+    - Each thread keeps its own connection open and reuses it, so a Flask
+      worker thread connects once, not once per request. The database is
+      in WAL mode, so readers don't wait for a writer.
+
+Inputs are stored as canonical JSON (see cache.canonical_json) and cash
+flows as float64 bytes, 8 bytes a year. IRRs are percentages, like
+everywhere else in the model; an IRR that couldn't be solved is NULL.
+"""
+
+DEFAULT_BATCH_SIZE = 10_000
+
+# Capital stack columns (RESULT_DTYPE names) and their labels in CapitalStack.to_dict()
+CAPITAL_STACK_COLUMNS = {
+    "net_equity": "LIHTC Equity",
+    "soft_subsidies": "Soft Subsidies",
+    "loan": "Loan (DSCR & LTV Constrained)",
+    "interest_reserve": "Interest Reserve",
+    "deferred_dev_fee": "Deferred Developer Fee",
+    "equity_required": "Equity Required",
+    "total_sources": "Total Sources",
+    "total_uses": "Total Uses",
+}
+
+# Columns query() can filter and sort on
+SUMMARY_COLUMNS = (
+    "irr",
+    "dscr",
+    "equity_required",
+    "funding_gap",
+    "loan",
+    "net_equity",
+    "debt_service",
+    "total_development_cost",
+    "hold_period",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    id INTEGER PRIMARY KEY,
+    result_id TEXT NOT NULL,
+    name TEXT,
+    created REAL NOT NULL,
+    irr REAL,
+    dscr REAL,
+    funding_gap REAL,
+    net_equity REAL,
+    soft_subsidies REAL,
+    loan REAL,
+    interest_reserve REAL,
+    deferred_dev_fee REAL,
+    equity_required REAL,
+    total_sources REAL,
+    total_uses REAL,
+    debt_service REAL,
+    loan_payoff REAL,
+    total_development_cost REAL,
+    hold_period INTEGER,
+    inputs TEXT NOT NULL,
+    cash_flows BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scenario_tags (
+    tag TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL REFERENCES scenarios(id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, scenario_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scenarios_result_id ON scenarios(result_id);
+CREATE INDEX IF NOT EXISTS scenarios_irr ON scenarios(irr);
+CREATE INDEX IF NOT EXISTS scenarios_dscr ON scenarios(dscr);
+CREATE INDEX IF NOT EXISTS scenarios_equity_required ON scenarios(equity_required, id, dscr);
+CREATE INDEX IF NOT EXISTS scenarios_equity_irr ON scenarios(equity_required, id, dscr, irr) WHERE irr IS NOT NULL;
+CREATE INDEX IF NOT EXISTS scenario_tags_scenario ON scenario_tags(scenario_id);
+"""
+
+# Result columns in table order, after id, result_id, name and created
+_RESULT_COLUMNS = ("irr", "dscr", "funding_gap", *CAPITAL_STACK_COLUMNS, "debt_service", "loan_payoff")
+_COLUMNS = ("id", "result_id", "name", "created", *_RESULT_COLUMNS,
+            "total_development_cost", "hold_period", "inputs", "cash_flows")
+_INSERT = f"INSERT INTO scenarios ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+_INSERT_TAG = "INSERT OR IGNORE INTO scenario_tags (tag, scenario_id) VALUES (?, ?)"
+
+_SUMMARY_SELECT = "SELECT id, result_id, name, created, " + ", ".join(SUMMARY_COLUMNS) + " FROM scenarios"
+
+
+def _number(value):
+    # NaN/inf can't be compared in SQL; they are stored as NULL
+    return value if value is not None and math.isfinite(value) else None
+
+
+def _after_segments(column, descending, value, scenario_id):
+    # The rows after (value, id) in ORDER BY column, id, as consecutive ranges that each start
+    # with an index seek: the rest of value's ties, then the values past it, then (descending)
+    # the NULLs, which SQLite sorts first ascending and last descending.
+    # (A single "(column, id) > (?, ?)" or an OR makes SQLite walk every tie of the value.)
+    if value is None:
+        if descending:
+            return [(f"{column} IS NULL AND id < ?", [scenario_id])]
+        return [(f"{column} IS NULL AND id > ?", [scenario_id]), (f"{column} IS NOT NULL", [])]
+    if descending:
+        return [(f"{column} = ? AND id < ?", [value, scenario_id]), (f"{column} < ?", [value]), (f"{column} IS NULL", [])]
+    return [(f"{column} = ? AND id > ?", [value, scenario_id]), (f"{column} > ?", [value])]
+
+
+def _tag_list(tags):
+    return [tags] if isinstance(tags, str) else list(tags or ())
+
+
+class ScenarioStore:
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connection(self):
+        # One connection per thread, opened on first use and kept for the life of the store
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _insert(self, rows, tags):
+        # Ids are assigned here so the tags go in the same transaction;
+        # BEGIN IMMEDIATE takes the write lock first, so no other writer can take them
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            first_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM scenarios").fetchone()[0]
+            connection.executemany(_INSERT, ((first_id + i, *row) for i, row in enumerate(rows)))
+            connection.executemany(_INSERT_TAG, ((tag, first_id + i) for i in range(len(rows)) for tag in tags))
+        return first_id
+
+    def save(self, result, tags=(), name=None):
+        """Saves an UnderwritingResult. Returns the new scenario id."""
+        stack = result.capital_stack
+        inputs = canonical_json(result.deal.to_dict())
+        row = (
+            json_hash(inputs), name, time.time(),
+            _number(result.irr), _number(result.dscr), stack.funding_gap,
+            stack.lihtc_equity, sum(amount for _, amount in stack.soft_subsidies), stack.loan, stack.interest_reserve,
+            stack.deferred_dev_fee, stack.equity_required, stack.total_sources, stack.total_uses,
+            result.projection.debt_service, result.projection.loan_payoff,
+            result.deal.total_development_cost, result.deal.hold_period,
+            inputs, np.asarray(result.projection.cash_flows, dtype=float).tobytes(),
+        )
+        return self._insert([row], _tag_list(tags))
+
+    def save_batch(self, deals, results, tags=(), name=None):
+        """
+        Saves many scenarios: `deals` is a DealBatch (or a list of
+        get_project_inputs()-style dicts) and `results` the matching
+        ResultBatch (or batch.underwrite_batch() dict). Rows are written
+        `batch_size` at a time, one transaction each. Returns the number saved.
+        """
+        if isinstance(results, dict):
+            results = ResultBatch.from_underwrite(results)
+        tags = _tag_list(tags)
+        created = time.time()
+
+        for start in range(0, len(results), self.batch_size):
+            stop = min(start + self.batch_size, len(results))
+            data = results.data[start:stop]
+            if isinstance(deals, list):
+                inputs = [canonical_json(deal) for deal in deals[start:stop]]
+                costs = [deal.get("total_development_cost") for deal in deals[start:stop]]
+            else:
+                inputs = [canonical_json(deals[i].to_dict()) for i in range(start, stop)]
+                costs = deals.data["total_development_cost"][start:stop].tolist()
+
+            columns = [data[name].tolist() for name in _RESULT_COLUMNS]
+            columns[0] = [_number(value) for value in columns[0]]  # irr
+            columns[1] = [_number(value) for value in columns[1]]  # dscr
+            hold_periods = data["hold_period"].tolist()
+            cash_flows = [row[:years].tobytes() for row, years in zip(results.cash_flows[start:stop], hold_periods)]
+
+            self._insert([
+                (json_hash(text), name, created, *values, cost, years, text, flows)
+                for text, values, cost, years, flows in zip(inputs, zip(*columns), costs, hold_periods, cash_flows)
+            ], tags)
+
+        # Keeps the query planner's statistics current after a large insert
+        self._connection().execute("PRAGMA optimize")
+        return len(results)
+
+    def tag(self, scenario_id, *tags):
+        with self._connection() as connection:
+            connection.executemany(_INSERT_TAG, [(tag, scenario_id) for tag in tags])
+
+    def untag(self, scenario_id, *tags):
+        with self._connection() as connection:
+            connection.executemany("DELETE FROM scenario_tags WHERE tag = ? AND scenario_id = ?",
+                                   [(tag, scenario_id) for tag in tags])
+
+    def delete(self, scenario_id):
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM scenarios WHERE id = ?", (scenario_id,)).rowcount > 0
+
+    def get(self, scenario_id):
+        """One scenario in full (inputs, capital stack, cash flows and tags), or None."""
+        connection = self._connection()
+        row = connection.execute("SELECT * FROM scenarios WHERE id = ?", (scenario_id,)).fetchone()
+        if row is None:
+            return None
+        scenario = {name: row[name] for name in ("id", "result_id", "name", "created", "irr", "dscr",
+                                                 "funding_gap", "debt_service", "loan_payoff")}
+        scenario["inputs"] = json.loads(row["inputs"])
+        # The capital stack as CapitalStack.to_dict() shows it
+        scenario["capital_stack"] = {label: row[name] for name, label in CAPITAL_STACK_COLUMNS.items()}
+        scenario["capital_stack"]["Soft Subsidies"] = scenario["inputs"].get("soft_subsidies", {})
+        scenario["cash_flows"] = np.frombuffer(row["cash_flows"], dtype=float).tolist()
+        scenario["tags"] = [tag for (tag,) in connection.execute(
+            "SELECT tag FROM scenario_tags WHERE scenario_id = ? ORDER BY tag", (scenario_id,))]
+        return scenario
+
+    def find(self, result_id):
+        """The id of the latest scenario saved with these inputs (see cache.input_hash), or None."""
+        return self._connection().execute("SELECT MAX(id) FROM scenarios WHERE result_id = ?", (result_id,)).fetchone()[0]
+
+    def _where(self, min_irr, min_dscr, max_equity, tags, filters):
+        bounds = dict(filters or {})
+        for column in bounds:
+            if column not in SUMMARY_COLUMNS:
+                raise ValueError(f"Can't filter on {column}")
+        for column, low, high in [("irr", min_irr, None), ("dscr", min_dscr, None), ("equity_required", None, max_equity)]:
+            # Both given for one column: a scenario has to meet both, so keep the tighter bound
+            old_low, old_high = bounds.get(column, (None, None))
+            lows = [bound for bound in (old_low, low) if bound is not None]
+            highs = [bound for bound in (old_high, high) if bound is not None]
+            bounds[column] = (max(lows) if lows else None, min(highs) if highs else None)
+
+        clauses, params = [], []
+        for column, (low, high) in bounds.items():
+            if low is not None:
+                clauses.append(f"{column} >= ?")
+                params.append(low)
+            if high is not None:
+                clauses.append(f"{column} <= ?")
+                params.append(high)
+        for tag in _tag_list(tags):
+            clauses.append("EXISTS (SELECT 1 FROM scenario_tags WHERE tag = ? AND scenario_id = scenarios.id)")
+            params.append(tag)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def query(self, min_irr=None, min_dscr=None, max_equity=None, tags=(), filters=None,
+              order_by="equity_required", descending=False, limit=100, offset=0, after=None):
+        """
+        Scenario summaries (SUMMARY_COLUMNS; see get() for the rest) matching
+        every condition, sorted by `order_by` (one of SUMMARY_COLUMNS).
+        `filters` maps summary columns to (low, high) bounds, None for an open end.
+        A scenario has to have every tag in `tags` to match.
+        """
+        return list(self.iter_query(min_irr, min_dscr, max_equity, tags, filters, order_by, descending, limit, offset, after))
+
+    def iter_query(self, min_irr=None, min_dscr=None, max_equity=None, tags=(), filters=None,
+                   order_by="equity_required", descending=False, limit=100, offset=0, after=None):
+        """
+        query(), as a generator reading rows from the cursor as they're used.
+
+        `after` is the (order_by value, id) of the last row of the previous
+        page (keyset pagination): the next page starts from the index
+        position right after it, so page 1,000 is as quick as page 1, where
+        an OFFSET has to walk past every earlier row.
+        """
+        if order_by not in SUMMARY_COLUMNS:
+            raise ValueError(f"Can't sort by {order_by}")
+        if after is not None and offset:
+            raise ValueError("Page with either offset or after, not both")
+        where, params = self._where(min_irr, min_dscr, max_equity, tags, filters)
+        direction = "DESC" if descending else "ASC"
+        order = f" ORDER BY {order_by} {direction}, id {direction} LIMIT ? OFFSET ?"
+        segments = [(where, params)]
+        if after is not None:
+            joiner = f"{where} AND " if where else " WHERE "
+            segments = [(joiner + clause, params + clause_params)
+                        for clause, clause_params in _after_segments(order_by, descending, *after)]
+
+        connection = self._connection()
+        for segment_where, segment_params in segments:
+            for row in connection.execute(f"{_SUMMARY_SELECT}{segment_where}{order}", segment_params + [limit, offset]):
+                limit -= 1
+                yield dict(row)
+            if limit <= 0:
+                return
+
+    def count(self, min_irr=None, min_dscr=None, max_equity=None, tags=(), filters=None):
+        where, params = self._where(min_irr, min_dscr, max_equity, tags, filters)
+        return self._connection().execute(f"SELECT COUNT(*) FROM scenarios{where}", params).fetchone()[0]
+
+    def tags(self):
+        """Every tag and how many scenarios have it."""
+        rows = self._connection().execute("SELECT tag, COUNT(*) FROM scenario_tags GROUP BY tag ORDER BY tag")
+        return {tag: count for tag, count in rows}
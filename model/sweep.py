@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from model.batch import set_input, to_columns, underwrite_batch
+from model.cache import canonical_json, json_hash
+from model.inputs import get_project_inputs
+
+"""
+Out-of-core parameter sweeps.
+
+A full-factorial grid over a handful of inputs (hold period x exit cap x
+NOI growth x pricing x loan rate x DSCR requirement x a soft subsidy amount)
+is easily billions of scenarios: too many to hold in memory, and hours of
+work that shouldn't be lost if the run dies. A sweep here:
+
+    - never builds the grid: scenario i is decoded from its flat index
+      (np.unravel_index over the grid's shape), so a chunk of scenarios is
+      one arange and a gather per input
+    - underwrites chunks of `chunk_size` scenarios across a process pool
+      with batch.py; each worker writes its chunk straight to disk as
+      chunk_<n>.npz (a column per grid input and per result, plus the
+      scenario's flat "index"), written to a temporary name and renamed, so
+      a chunk file is either complete or absent
+    - records finished chunks in manifest.json (also replaced atomically)
+      after each one, with the grid, base inputs and settings the run was
+      started with
+
+Running the same sweep into the same directory again resumes it: finished
+chunks (in the manifest, or on disk but finished after the last manifest
+write) are skipped. A different grid in the same directory is an error.
+
+Results are readable while the sweep runs: iter_chunks() and query_sweep()
+read whatever chunks are finished so far, one chunk at a time.
+
+Usage:
+    python -m model.sweep sweeps/run1 --grid exit_cap_rate=0.04:0.07:31 \\
+        --grid pricing=0.80,0.85,0.90,0.95 --grid soft_subsidies.HOME=0:2000000:21
+    python -m model.sweep sweeps/run1 --status
+"""
+
+DEFAULT_CHUNK_SIZE = 100_000
+MANIFEST = "manifest.json"
+
+# Per-scenario results written for every chunk (keys of underwrite_batch())
+RESULT_FIELDS = (
+    "irr",
+    "irr_status",
+    "dscr",
+    "net_equity",
+    "loan",
+    "funding_gap",
+    "deferred_dev_fee",
+    "equity_required",
+    "debt_service",
+    "loan_payoff",
+)
+
+
+def grid_size(grid):
+    return int(np.prod([len(values) for values in grid.values()], dtype=np.int64)) if grid else 0
+
+
+def chunk_filename(chunk):
+    return f"chunk_{chunk:06d}.npz"
+
+
+def grid_columns(base, grid, start, stop):
+    """Batch columns for scenarios start..stop of the grid (in C order: the last input varies fastest)."""
+    keys = list(grid)
+    index = np.arange(start, stop, dtype=np.int64)
+    positions = np.unravel_index(index, [len(grid[key]) for key in keys])
+    columns = to_columns([base])
+    values = {}
+    for key, position in zip(keys, positions):
+        values[key] = np.asarray(grid[key], dtype=float)[position]
+        set_input(columns, key, values[key])
+    return index, columns, values
+
+
+def sweep_chunk(directory, base, grid, chunk, start, stop, cash_flows=False):
+    """
+    Underwrites one chunk of the grid and writes it to chunk_<n>.npz in
+    `directory`. Runs in a worker process; only the row count goes back.
+    """
+    index, columns, values = grid_columns(base, grid, start, stop)
+    results = underwrite_batch(columns)
+
+    arrays = {"index": index}
+    arrays.update({f"input.{key}": value for key, value in values.items()})
+    arrays.update({field: results[field] for field in RESULT_FIELDS})
+    if cash_flows:
+        arrays["cash_flows"] = results["cash_flows"]
+
+    path = os.path.join(directory, chunk_filename(chunk))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+    return chunk, stop - start
+
+
+def _write_manifest(directory, manifest):
+    manifest["updated"] = time.time()
+    path = os.path.join(directory, MANIFEST)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def _new_manifest(base, grid, chunk_size, cash_flows):
+    settings = {"base": base, "grid": grid, "chunk_size": chunk_size, "cash_flows": cash_flows}
+    total = grid_size(grid)
+    return dict(
+        settings,
+        sweep_id=json_hash(canonical_json(settings)),
+        scenarios=total,
+        chunks=-(-total // chunk_size),
+        completed=[],
+        started=time.time(),
+    )
+
+
+def _open_manifest(directory, manifest):
+    # A new sweep, or the one that was started in this directory before
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        _write_manifest(directory, manifest)
+        return manifest
+
+    existing = load_manifest(directory)
+    if existing["sweep_id"] != manifest["sweep_id"]:
+        raise ValueError(f"{directory} holds a different sweep (other grid, inputs or settings); use a new directory")
+    # Chunks a dead run was halfway through writing
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".tmp"):
+            os.remove(entry.path)
+    # Chunks that were written after the last manifest update count as done too
+    finished = set(existing["completed"])
+    finished.update(chunk for chunk in range(existing["chunks"]) if os.path.exists(os.path.join(directory, chunk_filename(chunk))))
+    existing["completed"] = sorted(finished)
+    return existing
+
+
+def run_sweep(directory, grid, base=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, cash_flows=False, progress=None):
+    """
+    Runs (or resumes) the full-factorial sweep of `grid` ({input key: list
+    of values}, dotted soft subsidy keys allowed) around `base` (default
+    get_project_inputs()), writing chunk files and the manifest to `directory`.
+
+    workers: number of processes (defaults to the CPU count; 1 runs in-process).
+    progress: optional callback called with (scenarios_done, scenarios_total) after each chunk.
+
+    Returns the manifest.
+    """
+    base = base or get_project_inputs()
+    grid = {key: [float(value) for value in values] for key, values in grid.items()}
+    if not grid or not all(grid.values()):
+        raise ValueError("The grid needs at least one input with at least one value")
+    manifest = _open_manifest(directory, _new_manifest(base, grid, chunk_size, cash_flows))
+
+    total = manifest["scenarios"]
+    completed = set(manifest["completed"])
+    todo = [chunk for chunk in range(manifest["chunks"]) if chunk not in completed]
+    done = sum(min(chunk_size, total - chunk * chunk_size) for chunk in completed)
+
+    def finished(chunk, rows):
+        nonlocal done
+        manifest["completed"].append(chunk)
+        _write_manifest(directory, manifest)
+        done += rows
+        if progress:
+            progress(done, total)
+
+    def bounds(chunk):
+        return chunk * chunk_size, min((chunk + 1) * chunk_size, total)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(todo) <= 1:
+        for chunk in todo:
+            finished(*sweep_chunk(directory, base, grid, chunk, *bounds(chunk), cash_flows))
+        return manifest
+
+    # A bounded number of chunks in flight; the manifest is updated as each one lands
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        queue = iter(todo)
+        try:
+            for chunk in queue:
+                pending.add(pool.submit(sweep_chunk, directory, base, grid, chunk, *bounds(chunk), cash_flows))
+                if len(pending) >= 2 * workers:
+                    landed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in landed:
+                        finished(*future.result())
+            for future in pending:
+                finished(*future.result())
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    return manifest
+
+
+def sweep_status(directory):
+    manifest = load_manifest(directory)
+    total, chunk_size = manifest["scenarios"], manifest["chunk_size"]
+    done = sum(min(chunk_size, total - chunk * chunk_size) for chunk in manifest["completed"])
+    return {
+        "Scenarios": total,
+        "Scenarios Done": done,
+        "Chunks Done": f"{len(manifest['completed'])} / {manifest['chunks']}",
+        "Complete": len(manifest["completed"]) == manifest["chunks"],
+    }
+
+
+def iter_chunks(directory, columns=None):
+    """
+    Yields the finished chunks so far (in grid order) as dicts of arrays:
+    "index", "input.<key>" for each grid input, and the RESULT_FIELDS.
+    `columns` limits which arrays are read.
+    """
+    manifest = load_manifest(directory)
+    for chunk in sorted(manifest["completed"]):
+        with np.load(os.path.join(directory, chunk_filename(chunk))) as data:
+            yield {name: data[name] for name in (columns or data.files)}
+
+
+def query_sweep(directory, filters=None, columns=None, limit=None):
+    """
+    Scenarios of the finished chunks that pass `filters` ({column: (min, max)},
+    either bound may be None), e.g. {"irr": (12, None), "dscr": (1.15, None)}.
+    Read one chunk at a time; returns a dict of arrays (at most `limit` rows).
+    """
+    filters = filters or {}
+    needed = None if columns is None else list(dict.fromkeys(list(columns) + list(filters)))
+    parts, rows = [], 0
+    for data in iter_chunks(directory, needed):
+        keep = np.ones(len(next(iter(data.values()))), dtype=bool)
+        for name, (low, high) in filters.items():
+            if low is not None:
+                keep &= data[name] >= low
+            if high is not None:
+                keep &= data[name] <= high
+        part = {name: data[name][keep] for name in (columns or data)}
+        parts.append(part)
+        rows += int(keep.sum())
+        if limit is not None and rows >= limit:
+            break
+
+    if not parts:
+        return {}
+    result = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    return {name: values[:limit] for name, values in result.items()} if limit is not None else result
+
+
+def parse_grid_values(text):
+    # "start:stop:steps" (inclusive, like np.linspace) or "v1,v2,..."
+    if ":" in text:
+        start, stop, steps = text.split(":")
+        return np.linspace(float(start), float(stop), int(steps)).tolist()
+    return [float(value) for value in text.split(",")]
+
+
+def parse_grid(text):
+    key, _, values = text.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"expected KEY=START:STOP:STEPS or KEY=V1,V2,...: {text}")
+    base = get_project_inputs()
+    if not key.startswith("soft_subsidies.") and key not in base:
+        raise argparse.ArgumentTypeError(f"unknown input: {key}")
+    try:
+        return key, parse_grid_values(values)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid values for {key}: {values}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run (or resume) a full-factorial parameter sweep, chunked to disk")
+    parser.add_argument("directory", help="sweep directory (manifest.json and chunk files)")
+    parser.add_argument("--grid", type=parse_grid, action="append", metavar="KEY=VALUES",
+                        help="input and its values: START:STOP:STEPS or V1,V2,... (repeatable)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="scenarios per chunk file")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--cash-flows", action="store_true", help="also store each scenario's annual cash flows")
+    parser.add_argument("--status", action="store_true", help="print the sweep's progress and exit")
+    args = parser.parse_args()
+
+    if args.status:
+        for k, v in sweep_status(args.directory).items():
+            print(f"{k}: {v:,}" if isinstance(v, int) and not isinstance(v, bool) else f"{k}: {v}")
+        sys.exit(0)
+    if not args.grid:
+        parser.error("at least one --grid is required")
+
+    grid = dict(args.grid)
+    start = time.perf_counter()
+
+    def report(done, total):
+        elapsed = time.perf_counter() - start
+        print(f"{done:,} / {total:,} scenarios ({done / total:.1%}, {elapsed:,.0f}s)", file=sys.stderr)
+
+    print(f"Sweeping {grid_size(grid):,} scenarios into {args.directory}", file=sys.stderr)
+    run_sweep(args.directory, grid, chunk_size=args.chunk_size, workers=args.workers, cash_flows=args.cash_flows, progress=report)
@@ -1,10 +1,27 @@
-import numpy_financial as npf
+import numpy as np
+from collections import namedtuple
 
 """
 These functions provide metrics, like IRR and DSCR, that investors
 and lenders rely on to assess deal performance and risk.
 """
 
+"""
+Rounding.
+
+By default the model rounds its dollar outputs to cents and IRR/DSCR to two
+decimals as it goes, and later stages use those rounded values (the
+numbers every report and saved scenario has always shown). With
+full_precision=True every stage returns raw float64 instead, and rounding is
+left to the templates and report writers, once, at display time.
+benchmarks/precision.py checks how far the two modes drift apart.
+"""
+def rounded(value, digits=2, full_precision=False):
+    # A float or an array, rounded to `digits` unless full precision was asked for
+    if full_precision:
+        return value
+    return np.round(value, digits) if isinstance(value, np.ndarray) else round(value, digits)
+
 """
 IRR (Internal Rate of Return) is the discount rate that makes the
 Net Present Value (NPV) of all cash flows = 0.
@@ -14,11 +31,194 @@ It accounts for:
     - Initial outlay
     - Annual income or losses
 """
-def calculate_irr(cash_flows, equity_investment):
+def calculate_irr(cash_flows, equity_investment, full_precision=False):
     # Prepends the initial equity investment (negative) to the list of future positive cash flows.
-    full_flows = [-equity_investment] + cash_flows
-    # Calculate IRR and express it as a percentage
-    return round(npf.irr(full_flows) * 100, 2)
+    full_flows = [-equity_investment] + list(cash_flows)
+    result = solve_irr_batch([full_flows])
+    if result.converged[0]:
+        irr = result.irr[0]
+    else:
+        # Unusual flows (e.g. several sign changes): fall back to numpy-financial's polynomial solver
+        import numpy_financial as npf
+        irr = npf.irr(full_flows)
+    # Express IRR as a percentage
+    return rounded(irr * 100, 2, full_precision)
+
+"""
+Batched IRR solver.
+
+numpy_financial.irr finds the IRR by computing the roots of a polynomial
+(an eigenvalue problem) for one list of cash flows at a time. When looping
+over many deals or scenarios, that is the slowest step in the model.
+
+solve_irr_batch() solves every row of an N x T cash flow matrix at once with
+a safeguarded Newton method:
+    - Each row starts with a bracket [lo, hi] where NPV changes sign
+    - A Newton step is taken when it lands inside the bracket
+    - Otherwise the row falls back to bisection, so it can't diverge
+    - The bracket shrinks every iteration, whichever step was taken
+
+It reports, for each row, whether it converged, how many iterations it took
+and why it failed if it didn't (instead of a silent NaN).
+
+Warm start: during sweeps, neighbouring scenarios have similar IRRs, so pass
+the previous result as `guess` and most rows converge in 2-3 Newton steps.
+"""
+
+IRR_CONVERGED = 0
+IRR_NO_SIGN_CHANGE = 1  # NPV doesn't change sign: no IRR in the search range
+IRR_MAX_ITERATIONS = 2
+IRR_INVALID_FLOWS = 3  # NaN/inf cash flows
+
+IRR_STATUS_MESSAGES = {
+    IRR_CONVERGED: "converged",
+    IRR_NO_SIGN_CHANGE: "no sign change in NPV (no IRR between -100% and the search limit)",
+    IRR_MAX_ITERATIONS: "did not converge within max_iter iterations",
+    IRR_INVALID_FLOWS: "cash flows contain NaN or infinite values",
+}
+
+# Interior rates scanned for a sign change before iterating
+SCAN_RATES = np.array([-0.9, -0.5, -0.25, -0.1, 0.0, 0.05, 0.1, 0.2, 0.35, 0.5])
+
+IRRResult = namedtuple("IRRResult", ["irr", "converged", "iterations", "status"])
+
+
+def _npv_and_derivative(flows, rates):
+    # Horner's rule in v = 1 / (1 + r): one pass over the periods instead of N x T powers
+    v = 1 / (1 + rates)
+    npv = np.zeros_like(v)
+    dnpv_dv = np.zeros_like(v)
+    for t in range(flows.shape[1] - 1, -1, -1):
+        dnpv_dv = dnpv_dv * v + npv
+        npv = npv * v + flows[:, t]
+    return npv, -dnpv_dv * v * v
+
+
+def _solve_brackets(flows, lo, hi, f_lo, x, tol, max_iter):
+    """
+    Safeguarded Newton on each row's bracket [lo, hi] (NPV changes sign
+    across it), starting from x. Returns (roots, NaN where not converged,
+    and iterations per row).
+    """
+    n = flows.shape[0]
+    roots = np.full(n, np.nan)
+    iterations = np.zeros(n, dtype=int)
+    active = np.arange(n)
+    sign_lo = np.sign(f_lo)
+    x = np.where((x > lo) & (x < hi), x, (lo + hi) / 2)
+
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        for _ in range(max_iter):
+            if active.size == 0:
+                break
+            iterations[active] += 1
+            f, df = _npv_and_derivative(flows[active], x)
+
+            # Shrink the bracket around the root
+            below = np.sign(f) == sign_lo
+            lo = np.where(below, x, lo)
+            hi = np.where(below, hi, x)
+
+            # Newton step if it stays inside the bracket, bisection otherwise
+            newton = x - f / df
+            x_new = np.where(np.isfinite(newton) & (newton > lo) & (newton < hi), newton, (lo + hi) / 2)
+
+            done = (f == 0) | (np.abs(x_new - x) <= tol * (1 + np.abs(x))) | (hi - lo <= tol * (1 + np.abs(x)))
+            roots[active[done]] = np.where(f[done] == 0, x[done], x_new[done])
+
+            keep = ~done
+            active, x, lo, hi, sign_lo = active[keep], x_new[keep], lo[keep], hi[keep], sign_lo[keep]
+
+    return roots, iterations
+
+
+def solve_irr_batch(cash_flows, guess=None, tol=1e-12, max_iter=100, lower=-0.999999, upper=1.0, max_upper=1e6):
+    """
+    Solves the IRR of every row of an N x T cash flow matrix
+    (period 0 first, e.g. the negative equity investment).
+
+    guess: optional scalar or array of starting rates (warm start).
+    Returns an IRRResult of arrays: irr (as a decimal, NaN when not solved),
+    converged (bool), iterations (int) and status (IRR_* codes).
+
+    Rows with several IRRs get the one closest to 0%, like numpy_financial.irr,
+    as long as each root sits in its own interval of the scan grid
+    (lower, SCAN_RATES, upper); two roots inside one interval give no sign
+    change there and can be missed. Rows that are all zeros, or whose NPV
+    never changes sign up to max_upper, have no IRR (IRR_NO_SIGN_CHANGE).
+    """
+    flows = np.atleast_2d(np.asarray(cash_flows, dtype=float))
+    n = flows.shape[0]
+
+    irr = np.full(n, np.nan)
+    iterations = np.zeros(n, dtype=int)
+    status = np.full(n, IRR_MAX_ITERATIONS)
+
+    valid = np.isfinite(flows).all(axis=1)
+    status[~valid] = IRR_INVALID_FLOWS
+    # NPV is zero at every rate: there's no single IRR to report
+    valid &= (flows != 0).any(axis=1)
+
+    # Scan a grid of rates for sign changes in NPV. Start with the bracket
+    # closest to 0%; rows with more than one are compared root by root below.
+    grid = np.concatenate(([float(lower)], SCAN_RATES[(SCAN_RATES > lower) & (SCAN_RATES < upper)], [float(upper)]))
+    with np.errstate(over="ignore", invalid="ignore"):
+        npv_grid = np.stack([_npv_and_derivative(flows, np.full(n, rate))[0] for rate in grid], axis=1)
+        crossing = np.sign(npv_grid[:, :-1]) != np.sign(npv_grid[:, 1:])
+        distance = np.where(crossing, np.minimum(np.abs(grid[:-1]), np.abs(grid[1:])), np.inf)
+        pick = distance.argmin(axis=1)
+        rows = np.arange(n)
+        lo, hi = grid[pick], grid[pick + 1]
+        f_lo, f_hi = npv_grid[rows, pick], npv_grid[rows, pick + 1]
+
+        # Widen the upper end for very high IRRs
+        unbracketed = valid & ~crossing.any(axis=1)
+        lo[unbracketed], f_lo[unbracketed] = grid[-1], npv_grid[unbracketed, -1]
+        hi[unbracketed], f_hi[unbracketed] = grid[-1], npv_grid[unbracketed, -1]
+        while unbracketed.any() and hi[unbracketed][0] < max_upper:
+            hi[unbracketed] = hi[unbracketed] * 4 + 1
+            f_hi[unbracketed], _ = _npv_and_derivative(flows[unbracketed], hi[unbracketed])
+            unbracketed = valid & (np.sign(f_lo) == np.sign(f_hi))
+
+    bracketed = valid & (np.sign(f_lo) != np.sign(f_hi))
+    status[(status == IRR_MAX_ITERATIONS) & ~bracketed] = IRR_NO_SIGN_CHANGE
+    exact_lo = bracketed & (f_lo == 0)
+    exact_hi = bracketed & (f_hi == 0) & ~exact_lo
+    irr[exact_lo], irr[exact_hi] = lo[exact_lo], hi[exact_hi]
+    status[exact_lo | exact_hi] = IRR_CONVERGED
+
+    active = np.flatnonzero(status == IRR_MAX_ITERATIONS)
+    if guess is None:
+        x = np.full(active.size, 0.1)
+    else:
+        x = np.broadcast_to(np.asarray(guess, dtype=float), (n,))[active].copy()
+        x[~np.isfinite(x)] = 0.1
+    roots, steps = _solve_brackets(flows[active], lo[active], hi[active], f_lo[active], x, tol, max_iter)
+    iterations[active] += steps
+    solved = np.isfinite(roots)
+    irr[active[solved]] = roots[solved]
+    status[active[solved]] = IRR_CONVERGED
+
+    # Several IRRs: solve every other bracket too and keep the root closest to 0%
+    multiple = valid & (crossing.sum(axis=1) > 1)
+    for k in range(grid.size - 1):
+        rows_k = np.flatnonzero(multiple & crossing[:, k] & (pick != k))
+        if rows_k.size == 0:
+            continue
+        # (an interval starting on an exact root needs no solving)
+        f_k = npv_grid[rows_k, k]
+        roots = np.full(rows_k.size, grid[k])
+        inner = f_k != 0
+        if inner.any():
+            size = int(inner.sum())
+            roots[inner], steps = _solve_brackets(flows[rows_k[inner]], np.full(size, grid[k]), np.full(size, grid[k + 1]),
+                                                  f_k[inner], np.full(size, (grid[k] + grid[k + 1]) / 2), tol, max_iter)
+            iterations[rows_k[inner]] += steps
+        closer = np.isfinite(roots) & ~(np.abs(irr[rows_k]) <= np.abs(roots))
+        irr[rows_k[closer]] = roots[closer]
+        status[rows_k[closer]] = IRR_CONVERGED
+
+    return IRRResult(irr=irr, converged=status == IRR_CONVERGED, iterations=iterations, status=status)
 
 """
 DSCR = Debt Service Coverage Ratio
@@ -30,5 +230,5 @@ Interpreted as:
     - >1.15 = healthy buffer (typical lender minimum)
     - < 1.0 = cannot cover debt - red flag
 """
-def calculate_dscr(noi, debt_service):
-    return round(noi / debt_service, 2)
\ No newline at end of file
+def calculate_dscr(noi, debt_service, full_precision=False):
+    return rounded(noi / debt_service, 2, full_precision)
\ No newline at end of file
@@ -0,0 +1,31 @@
+from model.inputs import get_project_inputs
+from model.pipeline import run_pipeline
+from model.records import DealInputs
+from model.store import ScenarioStore
+
+
+def save_deals(store, nois):
+    irrs = []
+    for noi in nois:
+        deal = get_project_inputs()
+        deal["total_development_cost"] = 20_000_000  # enough equity required for an IRR
+        deal["noi_year_1"] = noi
+        result = run_pipeline(DealInputs.from_dict(deal)).result
+        store.save(result)
+        irrs.append(result.irr)
+    return sorted(irrs)
+
+
+def test_keyword_bounds_and_filters_on_one_column_both_apply(tmp_path):
+    store = ScenarioStore(str(tmp_path / "scenarios.db"))
+    low, middle, high = save_deals(store, [500_000, 600_000, 700_000])
+
+    def irrs(**kwargs):
+        return sorted(row["irr"] for row in store.query(**kwargs))
+
+    # min_irr is tighter than the filter's low end: it isn't dropped
+    assert irrs(min_irr=middle, filters={"irr": (low, None)}) == [middle, high]
+    # the filter's low end is the tighter one
+    assert irrs(min_irr=low, filters={"irr": (middle, None)}) == [middle, high]
+    # a filter's high end and min_irr on the same column combine into a range
+    assert irrs(min_irr=middle, filters={"irr": (None, middle)}) == [middle]
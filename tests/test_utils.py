@@ -0,0 +1,38 @@
+import numpy as np
+import numpy_financial as npf
+
+from model.utils import IRR_CONVERGED, IRR_NO_SIGN_CHANGE, solve_irr_batch
+
+
+def flows_with_irrs(*rates):
+    # NPV is a polynomial in v = 1 / (1 + r); these flows have a root at each rate
+    return np.poly([1 / (1 + rate) for rate in rates])[::-1]
+
+
+def test_all_zero_flows_have_no_irr():
+    result = solve_irr_batch([[0.0, 0.0, 0.0], [-1.0, 0.0, 0.0]])
+    assert np.isnan(result.irr).all()
+    assert not result.converged.any()
+    assert (result.status == IRR_NO_SIGN_CHANGE).all()
+
+
+def test_several_irrs_picks_the_one_closest_to_zero():
+    # -20% and +15% both sit 10 points from the nearest scan rate; +15% is the root closest to 0%
+    flows = flows_with_irrs(-0.20, 0.15)
+    result = solve_irr_batch([flows])
+    assert result.status[0] == IRR_CONVERGED
+    assert np.isclose(result.irr[0], 0.15)
+    assert np.isclose(result.irr[0], npf.irr(flows))
+
+
+def test_root_on_a_scan_rate_is_exact():
+    result = solve_irr_batch([[-100.0, 10.0, 110.0]])
+    assert result.irr[0] == 0.1
+    assert result.iterations[0] == 0
+
+
+def test_matches_numpy_financial_for_ordinary_flows():
+    rng = np.random.default_rng(0)
+    flows = np.column_stack((-rng.uniform(500, 1500, 200), rng.uniform(0, 300, (200, 10))))
+    expected = np.array([npf.irr(row) for row in flows])
+    assert np.allclose(solve_irr_batch(flows).irr, expected, equal_nan=True)